@@ -11,6 +11,10 @@ if [[ ${SERVICE} == "ws" ]]; then
     echo "Running ws..."
     ${SCRIPT_DIR}/run_ws.sh
 
+elif [[ ${SERVICE} == "ws-asgi" ]]; then
+    echo "Running asgi ws..."
+    ${SCRIPT_DIR}/run_ws_asgi.sh
+
 elif [[ ${SERVICE} == "eat-together-bot" ]]; then
     echo "Running eat-together-bot..."
     ${SCRIPT_DIR}/run_eat-together-bot.sh
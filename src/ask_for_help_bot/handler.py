@@ -2,20 +2,24 @@ from __future__ import absolute_import, annotations
 
 import json
 import logging
+import math
 import os
 import random
+import time
 import uuid
 from datetime import datetime, timedelta
 from json import JSONDecodeError
 from typing import Optional, List
 
-import requests
 from chatbot_core.model.user_context import UserConversationContext
 from emoji import emojize, demojize
 from wenet.interface.service_api import ServiceApiInterface
 
 from ask_for_help_bot.pending_conversations import PendingQuestionToAnswer, PendingWenetMessage
 from ask_for_help_bot.pending_messages_job import PendingMessagesJob
+from ask_for_help_bot.pending_queue_store import PendingQueueStore
+from ask_for_help_bot.pending_users_index import PendingUsersIndex
+from ask_for_help_bot.reminder_scheduler import Reminder, ReminderScheduler
 from chatbot_core.model.context import ConversationContext
 from chatbot_core.model.details import TelegramDetails, SocialDetails
 from chatbot_core.model.event import IncomingSocialEvent
@@ -33,6 +37,12 @@ from chatbot_core.v3.model.outgoing_event import OutgoingEvent, NotificationEven
 
 from ask_for_help_bot.state_mixin import StateMixin
 from common.button_payload import ButtonPayload
+from common.cache import ButtonAlreadyConsumedError, is_group_button
+from common.signed_callback import InvalidCallbackDataError, SignedCallbackCodec, is_signed_button
+from common.single_flight import SingleFlight
+from common.shard_lease import ShardLeaseManager
+from common.outbound_scheduler import OutboundScheduler
+from common.telegram_api import TelegramApiClient
 from common.wenet_event_handler import WenetEventHandler
 from uhopper.utils.alert.module import AlertModule
 from common.authentication_event import CreationError
@@ -150,7 +160,17 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
     LABEL_BEST_ANSWER_TRANSACTION = "bestAnswerTransaction"
     # keys used in Redis cache
     CACHE_LOCALE = "locale-{}"
+    CACHE_TELEGRAM_USERNAME = "telegram-username-{}"
     FIRST_ANSWER = "first-answer-{}"
+    # fields of the payloads of the buttons that can be signed in their callback data, new intents must be appended
+    SIGNED_BUTTON_SCHEMAS = {
+        INTENT_BEST_ANSWER: ["task_id", "transaction_id", "order"],
+        INTENT_ASK_MORE_ANSWERS: ["task_id"],
+        INTENT_CLOSE_QUESTION: ["task_id"],
+        INTENT_REPORT_ABUSIVE: ["task_id", "transaction_id"],
+        INTENT_REPORT_SPAM: ["task_id", "transaction_id"],
+        INTENT_ANSWER_PICKED_QUESTION: ["task_id", "sensitive", "questioner_name"],
+    }
 
     def __init__(self, instance_namespace: str, bot_id: str, handler_id: str, telegram_id: str, wenet_instance_url: str,
                  wenet_hub_url: str, app_id: str, client_secret: str, redirect_url: str, wenet_authentication_url: str,
@@ -159,11 +179,11 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
                  channel_id: Optional[str], publication_language: str, alert_module: AlertModule,
                  connector: SocialConnector, nlp_handler: Optional[NLPHandler], translator: Optional[Translator],
                  delay_between_messages_sec: Optional[int] = None, delay_between_text_sec: Optional[float] = None,
-                 logger_connectors: Optional[List[LoggerConnector]] = None) -> None:
+                 logger_connectors: Optional[List[LoggerConnector]] = None, telegram_api_client: Optional[TelegramApiClient] = None) -> None:
         super().__init__(instance_namespace, bot_id, handler_id, telegram_id, wenet_instance_url, wenet_hub_url, app_id,
                          client_secret, redirect_url, wenet_authentication_url, wenet_authentication_management_url,
                          task_type_id, community_id, alert_module, connector, nlp_handler, translator,
-                         delay_between_messages_sec, delay_between_text_sec, logger_connectors)
+                         delay_between_messages_sec, delay_between_text_sec, logger_connectors, telegram_api_client)
 
         self.max_users = max_users
         self.max_answers = max_answers
@@ -173,8 +193,20 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         self.helper_url = helper_url
         self.channel_id = channel_id
         self.publication_language = publication_language
-
-        JobManager.instance().add_job(PendingMessagesJob("wenet_ask_for_help_pending_messages_job", self._instance_namespace, self._connector, logger_connectors, self.app_id, self.client_secret, self.oauth_cache, self.wenet_authentication_management_url, self.wenet_instance_url))
+        self.pending_users_index = PendingUsersIndex.build_from_env()
+        self.pending_queue_store = PendingQueueStore.build_from_env()
+        self.reminder_scheduler = ReminderScheduler.build_from_env()
+        self.callback_codec = SignedCallbackCodec.build_from_env(self.telegram_id, self.SIGNED_BUTTON_SCHEMAS, max_length=64 - len(self.INTENT_BUTTON_WITH_PAYLOAD.format("")))
+        self.locale_flight = SingleFlight()
+        self.flushed_pending_wenet_messages = 0
+
+        pending_messages_job = PendingMessagesJob("wenet_ask_for_help_pending_messages_job", self._instance_namespace, self._connector, logger_connectors, self.app_id, self.client_secret, self.oauth_cache, self.wenet_authentication_management_url, self.wenet_instance_url,
+                                                  log_shipper=self.log_shipper, service_api_pool=self.service_api_pool, pending_users_index=self.pending_users_index,
+                                                  full_scan_interval_sec=float(os.getenv("PENDING_USERS_FULL_SCAN_INTERVAL", 3600)), reminder_scheduler=self.reminder_scheduler,
+                                                  workers=int(os.getenv("PENDING_MESSAGES_JOB_WORKERS", 4)), shard_lease_manager=ShardLeaseManager.build_from_env("pending-messages-job"),
+                                                  pending_queue_store=self.pending_queue_store, outbound_scheduler=self.outbound_scheduler, user_lock=self.messages_lock)
+        JobManager.instance().add_job(pending_messages_job)
+        self.reminder_scheduler.start(pending_messages_job.handle_due_reminders)
         self.intent_manager.with_fulfiller(
             IntentFulfillerV3(self.INTENT_ASK, self.action_question_0).with_rule(
                 intent=self.INTENT_ASK
@@ -327,27 +359,56 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         # keep this as the last one!
         self.intent_manager.with_fulfiller(
             IntentFulfillerV3("", self.handle_button_with_payload).with_rule(
-                regex=self.INTENT_BUTTON_WITH_PAYLOAD.format("[A-Za-z0-9-]+"))
+                regex=self.INTENT_BUTTON_WITH_PAYLOAD.format("([A-Za-z0-9-]+|\\..+)"))
         )
 
     def _get_user_locale_from_wenet_id(self, wenet_user_id: str, context: Optional[ConversationContext] = None) -> str:
+        cached_locale = self.cache.get(self.CACHE_LOCALE.format(wenet_user_id))
+        if cached_locale and not self._should_refresh_locale(cached_locale):
+            return cached_locale.get("locale", "en")
+        try:
+            # the concurrent misses for the same user wait for a single fetch of the locale
+            return self.locale_flight.do(wenet_user_id, lambda: self._fetch_user_locale(wenet_user_id, context))
+        except Exception:
+            if cached_locale:
+                logger.warning(f"Unable to refresh the locale of user [{wenet_user_id}], using the cached one")
+                return cached_locale.get("locale", "en")
+            raise
+
+    @staticmethod
+    def _should_refresh_locale(cached_locale: dict) -> bool:
+        """
+        Probabilistic early expiration: the closer the cached locale is to its expiration, and the longer it took to
+        fetch it, the more likely it is refreshed in advance, so that the locales of the users do not expire all at once
+
+        :return: if the cached locale should be refreshed before its expiration
+        """
+        expires_at = cached_locale.get("expires_at")
+        if expires_at is None:
+            return False
+        beta = float(os.getenv("LOCALE_EARLY_REFRESH_BETA", 1))
+        return time.time() - cached_locale.get("delta", 0) * beta * math.log(1 - random.random()) >= expires_at
+
+    def _fetch_user_locale(self, wenet_user_id: str, context: Optional[ConversationContext]) -> str:
+        start = time.time()
         if not context:
             user_accounts = self.get_user_accounts(wenet_user_id)
             if len(user_accounts) != 1:
                 logger.error(f"No context associated with WeNet user {wenet_user_id}")
                 raise Exception(f"No context associated with WeNet user {wenet_user_id}")
             context = user_accounts[0].context
-        cached_locale = self.cache.get(self.CACHE_LOCALE.format(wenet_user_id))
-        if not cached_locale:
-            service_api = self._get_service_api_interface_connector_from_context(context)
-            user_object = service_api.get_user_profile(wenet_user_id)
-            if not user_object:
-                logger.info(f"Unable to retrieve user profile [{wenet_user_id}]")
-                return "en"
+        service_api = self._get_service_api_interface_connector_from_context(context)
+        user_object = service_api.get_user_profile(wenet_user_id)
+        if not user_object:
+            logger.info(f"Unable to retrieve user profile [{wenet_user_id}]")
+            locale = "en"
+            ttl = int(os.getenv("LOCALE_NEGATIVE_TTL", 60))
+        else:
             locale = user_object.locale if user_object.locale else "en"
-            self.cache.cache({"locale": locale}, ttl=int(os.getenv("LOCALE_TTL", 86400)), key=self.CACHE_LOCALE.format(wenet_user_id))
-            return locale
-        return cached_locale.get("locale", "en")
+            ttl = int(os.getenv("LOCALE_TTL", 86400))
+        end = time.time()
+        self.cache.cache({"locale": locale, "delta": end - start, "expires_at": end + ttl}, ttl=ttl, key=self.CACHE_LOCALE.format(wenet_user_id))
+        return locale
 
     def _get_user_locale_from_incoming_event(self, incoming_event: IncomingSocialEvent) -> str:
         wenet_user_id = incoming_event.context.get_static_state(self.CONTEXT_WENET_USER_ID, None)
@@ -460,13 +521,56 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
 
         return emojize(decoded_text, use_aliases=True)
 
+    def _create_response(self, incoming_event: IncomingSocialEvent) -> OutgoingEvent:
+        was_doing_another_action = self._is_doing_another_action(incoming_event.context)
+        outgoing_event = super()._create_response(incoming_event)
+        # the messages deferred while the user was doing another action are sent as soon as it is over
+        if was_doing_another_action and outgoing_event.context is not None and not self._is_doing_another_action(outgoing_event.context):
+            self._flush_pending_wenet_messages(outgoing_event)
+        return outgoing_event
+
+    def _flush_pending_wenet_messages(self, outgoing_event: OutgoingEvent) -> None:
+        """
+        Add the pending wenet messages of the user to the outgoing event, removing them from the pending queue store
+        """
+        context = outgoing_event.context
+        self.pending_queue_store.migrate(outgoing_event.social_details, context)
+        raw_pending_wenet_messages = self.pending_queue_store.pop_wenet_messages(outgoing_event.social_details)
+        if not raw_pending_wenet_messages:
+            return
+
+        now = datetime.now()
+        max_waiting_sec = 0.0
+        for raw_pending_wenet_message in raw_pending_wenet_messages:
+            try:
+                pending_wenet_message = PendingWenetMessage.from_repr(raw_pending_wenet_message)
+            except Exception as e:
+                logger.exception(f"An exception [{type(e)}] occurs parsing the pending wenet message [{raw_pending_wenet_message}]", exc_info=e)
+                continue
+
+            service_api = self._get_service_connector_from_social_details(pending_wenet_message.social_details)
+            for response in pending_wenet_message.responses:
+                outgoing_event.with_message(response)
+                if pending_wenet_message.response_to:
+                    try:
+                        self.log_shipper.ship(service_api, self.message_parser_for_logs.create_response(response, context.get_static_state(self.CONTEXT_WENET_USER_ID), pending_wenet_message.response_to))
+                    except TypeError as e:
+                        logger.warning("Unsupported message to log", exc_info=e)
+            if pending_wenet_message.deferred is not None:
+                max_waiting_sec = max(max_waiting_sec, (now - pending_wenet_message.deferred).total_seconds())
+
+            self.flushed_pending_wenet_messages += 1
+
+        self.pending_queue_store.update_counts(outgoing_event.social_details, context)
+        logger.info(f"Sent the pending wenet messages of the user [{outgoing_event.social_details.get_user_id()}] on leaving the state, "
+                    f"the oldest one waited [{max_waiting_sec:.1f}] seconds")
+
     def _get_notification_event_based_on_what_user_is_doing(self, context: ConversationContext, social_details: SocialDetails, responses: List[ResponseMessage], response_to: str) -> NotificationEvent:
         if self._is_doing_another_action(context):
-            pending_wenet_messages = context.get_static_state(self.CONTEXT_PENDING_WENET_MESSAGES, dict())
-            pending_wenet_message_id = str(uuid.uuid4())
-            pending_wenet_message = PendingWenetMessage(pending_wenet_message_id, responses, social_details, response_to=response_to)
-            pending_wenet_messages[pending_wenet_message_id] = pending_wenet_message.to_repr()
-            context.with_static_state(self.CONTEXT_PENDING_WENET_MESSAGES, pending_wenet_messages)
+            pending_wenet_message = PendingWenetMessage(str(uuid.uuid4()), responses, social_details, response_to=response_to, deferred=datetime.now())
+            self.pending_queue_store.push_wenet_message(social_details, pending_wenet_message.to_repr())
+            self.pending_queue_store.update_counts(social_details, context)
+            self.pending_users_index.mark(social_details)
             return NotificationEvent(social_details, [], context)
         else:
             return NotificationEvent(social_details, responses, context)
@@ -508,23 +612,23 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
             .with_substitution("user", questioning_user.name.first if questioning_user.name.first and not anonymous else self._translator.get_translation_instance(user_object.locale).with_text("anonymous_user").translate()) \
             .translate()
 
-        # we create ids of all buttons, to know which buttons invalidate when one of them is clicked
-        button_ids = [str(uuid.uuid4()) for _ in range(4)]
         button_data = {
             "task_id": message.task_id,
             "question": self._prepare_string_to_telegram(message.question),
             "sensitive": sensitive,
             "username": questioning_user.name.first if questioning_user.name.first and not anonymous else self._translator.get_translation_instance(user_object.locale).with_text("anonymous_user").translate(),
-            "related_buttons": button_ids,
         }
         response = TelegramRapidAnswerResponse(TextualResponse(message_string), row_displacement=[2, 2])
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ANSWER_QUESTION).to_repr(), key=button_ids[0])
+        # the buttons are in the same group, so that all of them are invalidated when one of them is clicked
+        button_ids = self._store_button_group(button_data, [
+            ButtonPayload({}, self.INTENT_ANSWER_QUESTION),
+            ButtonPayload({}, self.INTENT_ANSWER_REMIND_LATER),
+            ButtonPayload({}, self.INTENT_ANSWER_NOT),
+            ButtonPayload({}, self.INTENT_QUESTION_REPORT),
+        ])
         response.with_textual_option(self._translator.get_translation_instance(user_object.locale).with_text("answer_question_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[0]))
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ANSWER_REMIND_LATER).to_repr(), key=button_ids[1])
         response.with_textual_option(self._translator.get_translation_instance(user_object.locale).with_text("answer_remind_later_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[1]))
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ANSWER_NOT).to_repr(), key=button_ids[2])
         response.with_textual_option(self._translator.get_translation_instance(user_object.locale).with_text("answer_not_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[2]))
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_QUESTION_REPORT).to_repr(), key=button_ids[3])
         response.with_textual_option(self._translator.get_translation_instance(user_object.locale).with_text("answer_report_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[3]))
         return response
 
@@ -544,7 +648,6 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         button_report_text = self._translator.get_translation_instance(user_object.locale).with_text("answer_report_button").translate()
         button_follow_up_text = self._translator.get_translation_instance(user_object.locale).with_text("follow_up_button").with_substitution("answerer", answerer_name).translate()
         button_like_answer_text = self._translator.get_translation_instance(user_object.locale).with_text("like_answer_button").translate()
-        button_ids = [str(uuid.uuid4()) for _ in range(3)]
         button_data = {
             "answerer_user_id": answerer_user.profile_id,
             "answerer_name": answerer_name,
@@ -553,15 +656,13 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
             "task_id": message.attributes["taskId"],
             "question": question_text,
             "questioner_user_id": user_object.profile_id,
-            "related_buttons": [button_ids[0], button_ids[2]]  # We want to allow more clicks for this set of buttons: not all the buttons should expire when we press one of them, only like and report are mutually exclusive
         }
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_LIKE_ANSWER).to_repr(), key=button_ids[0])
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ANSWER_REPORT).to_repr(), key=button_ids[2])
-        button_data["related_buttons"] = [button_ids[1]]  # Follow up is independent of like and report
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_FOLLOW_UP).to_repr(), key=button_ids[1])
-        answer.with_textual_option(button_like_answer_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[0]))
-        answer.with_textual_option(button_follow_up_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[1]))
-        answer.with_textual_option(button_report_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[2]))
+        # We want to allow more clicks for this set of buttons: not all the buttons should expire when we press one of them, only like and report are mutually exclusive
+        like_button_id, report_button_id = self._store_button_group(button_data, [ButtonPayload({}, self.INTENT_LIKE_ANSWER), ButtonPayload({}, self.INTENT_ANSWER_REPORT)])
+        follow_up_button_id, = self._store_button_group(button_data, [ButtonPayload({}, self.INTENT_FOLLOW_UP)])  # Follow up is independent of like and report
+        answer.with_textual_option(button_like_answer_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(like_button_id))
+        answer.with_textual_option(button_follow_up_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(follow_up_button_id))
+        answer.with_textual_option(button_report_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(report_button_id))
         return answer
 
     def _handle_answered_picked(self, message: AnsweredPickedMessage, user_object: WeNetUserProfile) -> TextualResponse:
@@ -596,6 +697,8 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
 
         message_upper_part = f"{message_attributes} \n\n"
         answer = []
+        buttons = []
+        button_texts = []
 
         if len(message_answers) != 0:
             message_upper_part += f"{self._translator.get_translation_instance(locale).with_text('collected_answers').translate()} \n\n"
@@ -633,10 +736,9 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
                     button_rows.append(1)
 
             answer_lower_part = TelegramRapidAnswerResponse(TextualResponse(message_string), row_displacement=button_rows)
-            button_ids = [str(uuid.uuid4()) for _ in range(len(transaction_ids) + 1)]
             for i in range(len(transaction_ids)):
-                self.cache.cache(ButtonPayload({"task_id": message.task_id, "transaction_id": transaction_ids[i], "order": f"#{1 + i}", "related_buttons": button_ids}, self.INTENT_BEST_ANSWER).to_repr(), key=button_ids[i])
-                answer_lower_part.with_textual_option(f"#{1 + i}", self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[i]))
+                buttons.append(ButtonPayload({"task_id": message.task_id, "transaction_id": transaction_ids[i], "order": f"#{1 + i}"}, self.INTENT_BEST_ANSWER))
+                button_texts.append(f"#{1 + i}")
 
         else:
             no_reply_string = self._translator.get_translation_instance(locale) \
@@ -645,20 +747,16 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
                 .translate()
             message_upper_part += no_reply_string
             answer_lower_part = TelegramRapidAnswerResponse(TextualResponse(message_upper_part), row_displacement=[1, 1])
-            button_ids = [str(uuid.uuid4()) for _ in range(2)]
 
-        button_data = {
-            "task_id": message.attributes["taskId"],
-            "related_buttons": button_ids
-        }
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ASK_MORE_ANSWERS).to_repr(), key=button_ids[len(transaction_ids)])
-        button_ask_more_text = self._translator.get_translation_instance(locale).with_text("more_answers_button").translate()
-        answer_lower_part.with_textual_option(button_ask_more_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[len(transaction_ids)]))
+        buttons.append(ButtonPayload({}, self.INTENT_ASK_MORE_ANSWERS))
+        button_texts.append(self._translator.get_translation_instance(locale).with_text("more_answers_button").translate())
         if len(message_answers) == 0:
-            self.cache.cache(ButtonPayload(button_data, self.INTENT_CLOSE_QUESTION).to_repr(), key=button_ids[len(transaction_ids) + 1])
-            button_close_question_text = self._translator.get_translation_instance(locale).with_text("close_question_button").translate()
-            answer_lower_part.with_textual_option(button_close_question_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[len(transaction_ids) + 1]))
+            buttons.append(ButtonPayload({}, self.INTENT_CLOSE_QUESTION))
+            button_texts.append(self._translator.get_translation_instance(locale).with_text("close_question_button").translate())
 
+        button_ids = self._store_button_group({"task_id": message.attributes["taskId"]}, buttons)
+        for button_text, button_id in zip(button_texts, button_ids):
+            answer_lower_part.with_textual_option(button_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_id))
         answer.append(answer_lower_part)
         return answer
 
@@ -734,6 +832,7 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
                 raise Exception(f"Received unrecognized message of type {type(message)}: {message.to_repr()}")
         except RefreshTokenExpiredError as e:
             logger.exception("Refresh token is not longer valid", exc_info=e)
+            self.service_api_pool.invalidate(user_account.social_details.unique_id())
             notification_event = NotificationEvent(social_details=user_account.social_details)
             notification_event.with_message(
                 TelegramTextualResponse(
@@ -747,26 +846,65 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         # in case the user was doing something else the received message is stored
         return self._get_notification_event_based_on_what_user_is_doing(context, user_account.social_details, responses, response_to)
 
+    def _store_button_group(self, payload: dict, buttons: List[ButtonPayload]) -> List[str]:
+        """
+        Store a group of buttons, clicking one of them invalidates all the others.
+        Small payloads are signed in the callback data of the buttons, the others are stored in the cache
+
+        :return: the IDs of the buttons
+        """
+        button_ids = self.callback_codec.encode([ButtonPayload(dict(payload, **button.payload), button.intent) for button in buttons])
+        if button_ids is None:
+            button_ids = self.cache.cache_button_group(payload, buttons)
+        return button_ids
+
+    def _consume_signed_button(self, button_id: str) -> Optional[ButtonPayload]:
+        """
+        :return: the payload signed in the button, None if it is expired
+        :raise ButtonAlreadyConsumedError: if a button of the same group was already clicked
+        :raise InvalidCallbackDataError: if the button is not valid
+        """
+        signed_button = self.callback_codec.decode(button_id)
+        if signed_button is None:
+            return None
+        if not self.cache.mark_consumed(signed_button.nonce, ttl=max(1, int(signed_button.expires_at - datetime.now().timestamp()))):
+            raise ButtonAlreadyConsumedError(button_id)
+        return signed_button.button_payload
+
     def handle_button_with_payload(self, incoming_event: IncomingSocialEvent, _: str) -> OutgoingEvent:
         """
-        Handle a button with a payload saved into redis
+        Handle a button with a payload saved into redis, or signed in its callback data
         """
-        button_id = incoming_event.incoming_message.intent.value.split("--")[-1]
-        raw_button_payload = self.cache.get(button_id)
-        if raw_button_payload is None:
+        # the signed payloads can contain the separator of the intent
+        button_id = incoming_event.incoming_message.intent.value[len(self.INTENT_BUTTON_WITH_PAYLOAD.format("")):]
+        try:
+            # the button is removed from the cache together with all the buttons of its group in the same atomic operation
+            if is_signed_button(button_id):
+                button_payload = self._consume_signed_button(button_id)
+            elif is_group_button(button_id):
+                button_payload = self.cache.consume_group_button(button_id)
+            else:
+                raw_button_payload = self.cache.consume(button_id)
+                button_payload = ButtonPayload.from_repr(raw_button_payload) if raw_button_payload is not None else None
+        except ButtonAlreadyConsumedError:
+            # e.g. a double tap on the button, the action is done only once by the first click
+            logger.debug(f"The button [{button_id}] was already consumed by a previous click")
+            return OutgoingEvent(social_details=incoming_event.social_details)
+        except InvalidCallbackDataError as e:
+            logger.warning(f"Ignoring an invalid signed button: {e}")
+            return OutgoingEvent(social_details=incoming_event.social_details)
+
+        if button_payload is None:
             response = OutgoingEvent(social_details=incoming_event.social_details)
             user_locale = self._get_user_locale_from_incoming_event(incoming_event)
             response.with_message(TextualResponse(self._translator.get_translation_instance(user_locale).with_text("expired_button_message").translate()))
             return response
 
-        button_payload = ButtonPayload.from_repr(raw_button_payload)
         if "related_buttons" in button_payload.payload:
-            # removing the button and all the related buttons from the cache
+            # removing the related buttons stored on their own by the previous versions
             for button_to_remove in button_payload.payload["related_buttons"]:
-                self.cache.remove(button_to_remove)
-        else:
-            # in case the button is not related with any other buttons, just remove it from the cache
-            self.cache.remove(button_id)
+                if button_to_remove != button_id:
+                    self.cache.remove(button_to_remove)
 
         if button_payload.intent == self.INTENT_ASK_MORE_ANSWERS:
             return self.action_more_answers(incoming_event, button_payload)
@@ -1358,7 +1496,6 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         context = incoming_event.context
         message = self._translator.get_translation_instance(user_locale).with_text("answer_remind_later_message").translate()
         response.with_message(TextualResponse(message))
-        pending_answers = context.get_static_state(self.CONTEXT_PENDING_ANSWERS, dict())
         question_id = button_payload.payload["task_id"]
 
         # Recreating the message that someone in the community has a question and insert the details of the question, treat differently sensitive questions
@@ -1372,27 +1509,28 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
             .with_substitution("user", button_payload.payload["username"]) \
             .translate()
 
-        button_ids = [str(uuid.uuid4()) for _ in range(4)]
         button_data = {
             "task_id": question_id,
             "question": button_payload.payload["question"],
             "sensitive": button_payload.payload.get("sensitive", False),
             "username": button_payload.payload["username"],
-            "related_buttons": button_ids,
         }
         response_to_store = TelegramRapidAnswerResponse(TextualResponse(message_string), row_displacement=[2, 2])
 
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ANSWER_QUESTION).to_repr(), key=button_ids[0])
+        button_ids = self._store_button_group(button_data, [
+            ButtonPayload({}, self.INTENT_ANSWER_QUESTION),
+            ButtonPayload({}, self.INTENT_ANSWER_REMIND_LATER),
+            ButtonPayload({}, self.INTENT_ANSWER_NOT),
+            ButtonPayload({}, self.INTENT_QUESTION_REPORT),
+        ])
         response_to_store.with_textual_option(self._translator.get_translation_instance(user_locale).with_text("answer_question_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[0]))
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ANSWER_REMIND_LATER).to_repr(), key=button_ids[1])
         response_to_store.with_textual_option(self._translator.get_translation_instance(user_locale).with_text("answer_remind_later_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[1]))
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_ANSWER_NOT).to_repr(), key=button_ids[2])
         response_to_store.with_textual_option(self._translator.get_translation_instance(user_locale).with_text("answer_not_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[2]))
-        self.cache.cache(ButtonPayload(button_data, self.INTENT_QUESTION_REPORT).to_repr(), key=button_ids[3])
         response_to_store.with_textual_option(self._translator.get_translation_instance(user_locale).with_text("answer_report_button").translate(), self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[3]))
         pending_answer = PendingQuestionToAnswer(question_id, response_to_store, incoming_event.social_details, sent=datetime.now(), response_to=incoming_event.incoming_message.message_id)
-        pending_answers[question_id] = pending_answer.to_repr()
-        context.with_static_state(self.CONTEXT_PENDING_ANSWERS, pending_answers)
+        self.pending_queue_store.put_answer(incoming_event.social_details, question_id, pending_answer.to_repr())
+        self.pending_queue_store.update_counts(incoming_event.social_details, context)
+        self.reminder_scheduler.schedule(Reminder(incoming_event.social_details, question_id, pending_answer.sent.timestamp() + PendingMessagesJob.REMINDER_MINUTES * 60))
         response.with_context(context)
         return response
 
@@ -1408,11 +1546,9 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         button_why_reporting_2_text = self._translator.get_translation_instance(user_locale).with_text("button_why_reporting_2_text").translate()
         button_why_reporting_3_text = self._translator.get_translation_instance(user_locale).with_text("button_why_reporting_3_text").translate()
         message = TelegramRapidAnswerResponse(TextualResponse(message_text), row_displacement=[1, 1, 1])
-        button_ids = [str(uuid.uuid4()) for _ in range(2)]
-        payload = button_payload.payload
-        payload.update({"related_buttons": button_ids})
-        self.cache.cache(ButtonPayload(button_payload.payload, self.INTENT_REPORT_ABUSIVE).to_repr(), key=button_ids[0])
-        self.cache.cache(ButtonPayload(button_payload.payload, self.INTENT_REPORT_SPAM).to_repr(), key=button_ids[1])
+        # only the task and the transaction are needed to report the message
+        payload = {"task_id": button_payload.payload["task_id"], "transaction_id": button_payload.payload.get("transaction_id", None)}
+        button_ids = self._store_button_group(payload, [ButtonPayload({}, self.INTENT_REPORT_ABUSIVE), ButtonPayload({}, self.INTENT_REPORT_SPAM)])
         message.with_textual_option(button_why_reporting_1_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[0]))
         message.with_textual_option(button_why_reporting_2_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[1]))
         message.with_textual_option(button_why_reporting_3_text, self.INTENT_CANCEL)
@@ -1517,13 +1653,23 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         response.with_context(context)
         return response
 
-    def _get_telegram_user(self, context: ConversationContext) -> Optional[str]:
+    def _get_telegram_user(self, context: ConversationContext, refresh: bool = False) -> Optional[str]:
+        """
+        Get the Telegram username of the user, cached for a short time. The users without a username are cached for
+        an even shorter time, and the cache is skipped with `refresh` (e.g. when the user says to have set it).
+        """
         if not isinstance(self._connector, TelegramSocialConnector):
             logger.error(f"Expected telegram social connector, got [{type(self._connector)}]")
             raise Exception(f"Expected telegram social connector, got [{type(self._connector)}]")
 
-        response = requests.get(f"{getattr(self._connector, '_telegram_url')}/getChat?chat_id={context.get_static_state(self.CONTEXT_TELEGRAM_USER_ID)}")
-        username = response.json()['result'].get('username', None)
+        telegram_user_id = context.get_static_state(self.CONTEXT_TELEGRAM_USER_ID)
+        cached_username = self.cache.get(self.CACHE_TELEGRAM_USERNAME.format(telegram_user_id)) if not refresh else None
+        if cached_username is not None:
+            username = cached_username.get("username")
+        else:
+            username = self.telegram_api_client.get_chat(telegram_user_id).get('username', None)
+            ttl = int(os.getenv("TELEGRAM_USERNAME_TTL", 300)) if username is not None else int(os.getenv("TELEGRAM_USERNAME_NEGATIVE_TTL", 60))
+            self.cache.cache({"username": username}, ttl=ttl, key=self.CACHE_TELEGRAM_USERNAME.format(telegram_user_id))
         if username is not None:  # The username could not available since is not mandatory to have it
             username = f"@{username}"
             return username.replace("_", "\\_").replace("*", "\\*").replace("`", "\\`")
@@ -1534,7 +1680,7 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         response = OutgoingEvent(social_details=incoming_event.social_details)
         user_locale = self._get_user_locale_from_incoming_event(incoming_event)
         context = incoming_event.context
-        if self._get_telegram_user(context):
+        if self._get_telegram_user(context, refresh=button_payload.payload.get("username_retry", False)):
             context.with_static_state(self.CONTEXT_CURRENT_STATE, self.STATE_FOLLOW_UP_0)
             context.with_static_state(self.CONTEXT_ANSWERER_USER_ID, button_payload.payload["answerer_user_id"])
             context.with_static_state(self.CONTEXT_ANSWERER_NAME, button_payload.payload["answerer_name"])
@@ -1556,7 +1702,7 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
             message = TelegramRapidAnswerResponse(TextualResponse(message), row_displacement=[1])
             button_follow_up_text = self._translator.get_translation_instance(user_locale).with_text("follow_up_button").with_substitution("answerer", button_payload.payload["answerer_name"]).translate()
             button_id = str(uuid.uuid4())
-            self.cache.cache(ButtonPayload(button_payload.payload, self.INTENT_FOLLOW_UP).to_repr(), key=button_id)
+            self.cache.cache(ButtonPayload(dict(button_payload.payload, username_retry=True), self.INTENT_FOLLOW_UP).to_repr(), key=button_id)
             message.with_textual_option(button_follow_up_text, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_id))
 
         response.with_message(message)
@@ -1610,7 +1756,6 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
                 button_share_details = self._translator.get_translation_instance(answerer_locale).with_text("share_details").translate()
                 button_not_share_details = self._translator.get_translation_instance(answerer_locale).with_text("not_now_share_details").translate()
                 button_block_share_details = self._translator.get_translation_instance(answerer_locale).with_text("block_share_details").translate()
-                button_ids = [str(uuid.uuid4()) for _ in range(3)]
                 button_data = {
                     "answerer_user_id": answerer_user_id,
                     "answerer_name": answerer_name,
@@ -1618,29 +1763,28 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
                     "task_id": task_id,
                     "questioner_user_id": questioner_user_id,
                     "questioner_name": questioner_name,
-                    "related_buttons": button_ids
                 }
-                self.cache.cache(ButtonPayload(button_data, self.INTENT_SHARE_DETAILS_TO_QUESTIONER).to_repr(), key=button_ids[0])
+                button_ids = self._store_button_group(button_data, [
+                    ButtonPayload({}, self.INTENT_SHARE_DETAILS_TO_QUESTIONER),
+                    ButtonPayload({}, self.INTENT_NOT_NOW_SHARE_DETAILS),
+                    ButtonPayload({}, self.INTENT_BLOCK_SHARE_DETAILS),
+                ])
                 notification_message.with_textual_option(button_share_details, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[0]))
-                self.cache.cache(ButtonPayload(button_data, self.INTENT_NOT_NOW_SHARE_DETAILS).to_repr(), key=button_ids[1])
                 notification_message.with_textual_option(button_not_share_details, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[1]))
-                self.cache.cache(ButtonPayload(button_data, self.INTENT_BLOCK_SHARE_DETAILS).to_repr(), key=button_ids[2])
                 notification_message.with_textual_option(button_block_share_details, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[2]))
 
                 answerer_service_api = self._get_service_api_interface_connector_from_context(answerer_account.context)
                 notification = self._get_notification_event_based_on_what_user_is_doing(answerer_account.context, answerer_account.social_details, [notification_message], incoming_event.incoming_message.message_id)
                 try:
-                    self.send_notification(notification)
+                    self.send_notification(notification, priority=OutboundScheduler.PRIORITY_INTERACTIVE)
                     for outgoing_message in notification.messages:
                         try:
-                            answerer_service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, answerer_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
+                            self.log_shipper.ship(answerer_service_api, self.message_parser_for_logs.create_response(outgoing_message, answerer_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
                         except TypeError as e:
                             logger.warning("Unsupported message to log", exc_info=e)
-                        except CreationError:
-                            logger.warning("Unable to send logs to the service API")
 
                     if notification.context is not None:
-                        self._interface_connector.update_user_context(UserConversationContext(
+                        self._update_user_context(UserConversationContext(
                             social_details=notification.social_details,
                             context=notification.context,
                             version=UserConversationContext.VERSION_V3)
@@ -1661,7 +1805,7 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         user_locale = self._get_user_locale_from_incoming_event(incoming_event)
 
         context = incoming_event.context
-        answerer_contact = self._get_telegram_user(context)
+        answerer_contact = self._get_telegram_user(context, refresh=button_payload.payload.get("username_retry", False))
         if answerer_contact:
             answerer_user_id = button_payload.payload["answerer_user_id"]
             answerer_name = button_payload.payload["answerer_name"]
@@ -1727,17 +1871,15 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
             questioner_service_api = self._get_service_api_interface_connector_from_context(questioner_account.context)
             notification = self._get_notification_event_based_on_what_user_is_doing(questioner_account.context, questioner_account.social_details, [notification_message], incoming_event.incoming_message.message_id)
             try:
-                self.send_notification(notification)
+                self.send_notification(notification, priority=OutboundScheduler.PRIORITY_INTERACTIVE)
                 for outgoing_message in notification.messages:
                     try:
-                        questioner_service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, questioner_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
+                        self.log_shipper.ship(questioner_service_api, self.message_parser_for_logs.create_response(outgoing_message, questioner_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
                     except TypeError as e:
                         logger.warning("Unsupported message to log", exc_info=e)
-                    except CreationError:
-                        logger.warning("Unable to send logs to the service API")
 
                 if notification.context is not None:
-                    self._interface_connector.update_user_context(UserConversationContext(
+                    self._update_user_context(UserConversationContext(
                         social_details=notification.social_details,
                         context=notification.context,
                         version=UserConversationContext.VERSION_V3)
@@ -1750,7 +1892,7 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
             message = TelegramRapidAnswerResponse(TextualResponse(message), row_displacement=[1])
             button_share_details = self._translator.get_translation_instance(user_locale).with_text("share_details").translate()
             button_id = str(uuid.uuid4())
-            self.cache.cache(ButtonPayload(button_payload.payload, self.INTENT_SHARE_DETAILS_TO_QUESTIONER).to_repr(), key=button_id)
+            self.cache.cache(ButtonPayload(dict(button_payload.payload, username_retry=True), self.INTENT_SHARE_DETAILS_TO_QUESTIONER).to_repr(), key=button_id)
             message.with_textual_option(button_share_details, self.INTENT_BUTTON_WITH_PAYLOAD.format(button_id))
 
         response.with_message(message)
@@ -1786,17 +1928,15 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         questioner_service_api = self._get_service_api_interface_connector_from_context(questioner_account.context)
         notification = self._get_notification_event_based_on_what_user_is_doing(questioner_account.context, questioner_account.social_details, [notification_message], incoming_event.incoming_message.message_id)
         try:
-            self.send_notification(notification)
+            self.send_notification(notification, priority=OutboundScheduler.PRIORITY_INTERACTIVE)
             for outgoing_message in notification.messages:
                 try:
-                    questioner_service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, questioner_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
+                    self.log_shipper.ship(questioner_service_api, self.message_parser_for_logs.create_response(outgoing_message, questioner_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
                 except TypeError as e:
                     logger.warning("Unsupported message to log", exc_info=e)
-                except CreationError:
-                    logger.warning("Unable to send logs to the service API")
 
             if notification.context is not None:
-                self._interface_connector.update_user_context(UserConversationContext(
+                self._update_user_context(UserConversationContext(
                     social_details=notification.social_details,
                     context=notification.context,
                     version=UserConversationContext.VERSION_V3)
@@ -1871,17 +2011,15 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         answerer_service_api = self._get_service_api_interface_connector_from_context(answerer_account.context)
         notification = self._get_notification_event_based_on_what_user_is_doing(answerer_account.context, answerer_account.social_details, [notification_message], incoming_event.incoming_message.message_id)
         try:
-            self.send_notification(notification)
+            self.send_notification(notification, priority=OutboundScheduler.PRIORITY_INTERACTIVE)
             for outgoing_message in notification.messages:
                 try:
-                    answerer_service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, answerer_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
+                    self.log_shipper.ship(answerer_service_api, self.message_parser_for_logs.create_response(outgoing_message, answerer_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), incoming_event.incoming_message.message_id))
                 except TypeError as e:
                     logger.warning("Unsupported message to log", exc_info=e)
-                except CreationError:
-                    logger.warning("Unable to send logs to the service API")
 
             if notification.context is not None:
-                self._interface_connector.update_user_context(UserConversationContext(
+                self._update_user_context(UserConversationContext(
                     social_details=notification.social_details,
                     context=notification.context,
                     version=UserConversationContext.VERSION_V3)
@@ -2001,7 +2139,7 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
         if intent == self.INTENT_PUBLISH and isinstance(incoming_event.social_details, TelegramDetails):
             notification = NotificationEvent(social_details=TelegramDetails(None, self.channel_id, incoming_event.social_details.telegram_bot_id), messages=message_notification)
             try:
-                self.send_notification(notification)
+                self.send_notification(notification, priority=OutboundScheduler.PRIORITY_INTERACTIVE)
                 logger.info(f"Notification sent to the telegram channel {self.channel_id}")
             except Exception as e:
                 logger.exception(f"An exception [{type(e)}] occurs sending the notification [{notification.to_repr()}]", exc_info=e)
@@ -2132,9 +2270,19 @@ class AskForHelpHandler(WenetEventHandler, StateMixin):
                     proposed_tasks.append(task)
             message_text = "\n".join([text] + tasks_texts + [self._translator.get_translation_instance(user_locale).with_text("answers_tasks_choose").translate()])
             rapid_answer = TelegramRapidAnswerResponse(TextualResponse(message_text))
+            button_ids = []
+            buttons_to_cache = {}
+            for i in range(len(proposed_tasks)):
+                button = ButtonPayload({"task_id": proposed_tasks[i].task_id, "sensitive": proposed_tasks[i].attributes["domain"] == self.INTENT_SENSITIVE_QUESTION, "questioner_name": questioner_names[i]}, self.INTENT_ANSWER_PICKED_QUESTION)
+                signed_button_ids = self.callback_codec.encode([button])
+                if signed_button_ids is not None:
+                    button_ids.append(signed_button_ids[0])
+                else:
+                    button_ids.append(str(uuid.uuid4()))
+                    buttons_to_cache[button_ids[-1]] = button.to_repr()
+            self.cache.cache_many(buttons_to_cache)
             for i in range(len(proposed_tasks)):
-                button_id = self.cache.cache(ButtonPayload({"task_id": proposed_tasks[i].task_id, "sensitive": proposed_tasks[i].attributes["domain"] == self.INTENT_SENSITIVE_QUESTION, "questioner_name": questioner_names[i]}, self.INTENT_ANSWER_PICKED_QUESTION).to_repr())
-                rapid_answer.with_textual_option(f"#{1 + i}", self.INTENT_BUTTON_WITH_PAYLOAD.format(button_id))
+                rapid_answer.with_textual_option(f"#{1 + i}", self.INTENT_BUTTON_WITH_PAYLOAD.format(button_ids[i]))
             response.with_message(rapid_answer)
         response.with_context(context)
         return response
@@ -2,6 +2,8 @@ from __future__ import absolute_import, annotations
 
 import logging.config
 import os
+import signal
+import sys
 import sentry_sdk
 
 from ask_for_help_bot.handler import AskForHelpHandler
@@ -94,6 +96,8 @@ if __name__ == "__main__":
     instance_manager = InstanceManager(instance_namespace, subscriber, MultiThreadEventDispatcher())
     instance_manager.with_event_handler(handler)
 
+    # exit normally on SIGTERM (e.g. when the container is stopped), so that the exit handlers are run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
         instance_manager.start()
     except KeyboardInterrupt:
@@ -14,20 +14,24 @@ class PendingWenetMessage:
     - the response messages to be sent to the user
     - the social details of the user
     - the message to which the bot is replying
+    - the timestamp of when the message was deferred
     """
 
-    def __init__(self, pending_wenet_message_id: str, responses: List[ResponseMessage], social_details: SocialDetails, response_to: Optional[str] = None) -> None:
+    def __init__(self, pending_wenet_message_id: str, responses: List[ResponseMessage], social_details: SocialDetails,
+                 response_to: Optional[str] = None, deferred: Optional[datetime] = None) -> None:
         self.pending_wenet_message_id = pending_wenet_message_id
         self.responses = responses
         self.social_details = social_details
         self.response_to = response_to
+        self.deferred = deferred
 
     def to_repr(self) -> dict:
         return {
             "pending_wenet_message_id": self.pending_wenet_message_id,
             "responses": [response.to_repr() for response in self.responses],
             "social_details": self.social_details.to_repr(),
-            "response_to": self.response_to
+            "response_to": self.response_to,
+            "deferred": self.deferred.isoformat() if self.deferred else None
         }
 
     @staticmethod
@@ -36,14 +40,15 @@ class PendingWenetMessage:
             raw["pending_wenet_message_id"],
             [ResponseMessage.from_repr(response) for response in raw["responses"]],
             SocialDetails.from_repr(raw["social_details"]),
-            raw.get("response_to")
+            raw.get("response_to"),
+            deferred=datetime.fromisoformat(raw["deferred"]) if raw.get("deferred") else None
         )
 
     def __eq__(self, o: object) -> bool:
         if not isinstance(o, PendingWenetMessage):
             return False
         return self.pending_wenet_message_id == o.pending_wenet_message_id and self.responses == o.responses and \
-            self.social_details == o.social_details and self.response_to == o.response_to
+            self.social_details == o.social_details and self.response_to == o.response_to and self.deferred == o.deferred
 
 
 class PendingQuestionToAnswer:
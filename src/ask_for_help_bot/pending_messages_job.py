@@ -2,13 +2,18 @@ from __future__ import absolute_import, annotations
 
 import datetime
 import logging
-from typing import Optional, List, Dict, Set
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, List, Dict, Set, TypeVar
 
-from wenet.interface.client import Oauth2Client
-from wenet.interface.service_api import ServiceApiInterface
 from wenet.storage.cache import BaseCache
 
 from ask_for_help_bot.pending_conversations import PendingQuestionToAnswer, PendingWenetMessage
+from ask_for_help_bot.pending_queue_store import PendingQueueStore
+from ask_for_help_bot.pending_users_index import PendingUsersIndex
+from ask_for_help_bot.reminder_scheduler import Reminder, ReminderScheduler
+from chatbot_core.model.details import SocialDetails
 from chatbot_core.model.user_context import UserConversationContext
 from chatbot_core.v3.connector.social_connector import SocialConnector
 from chatbot_core.v3.job.job import SocialJob
@@ -16,25 +21,54 @@ from chatbot_core.v3.logger.event_logger import LoggerConnector
 from chatbot_core.v3.model.outgoing_event import NotificationEvent
 
 from ask_for_help_bot.state_mixin import StateMixin
-from common.authentication_event import CreationError
+from common.locks import StripedLock
+from common.log_shipper import LogShipper
+from common.outbound_scheduler import OutboundScheduler
+from common.service_api_pool import ServiceApiPool
+from common.shard_lease import ShardLeaseManager
 from common.messages_to_log import LogMessageHandler
 
 logger = logging.getLogger("uhopper.chatbot.wenet.askforhelp.pending_messages_job")
 
+T = TypeVar("T")
+
 
 class PendingMessagesJob(SocialJob, StateMixin):
     """
-    This job passes all the contexts, checking whether they contain pending questions or wenet messages dictionaries.
-    In case they do and the user is not in any state, and for the question ones also the right amount of time since
-    the question was added is passed, the stored messages are sent to the user,
-    and the pending questions or wenet messages are removed from the dictionaries.
+    This job passes all the contexts, checking whether their users have pending questions or wenet messages in the
+    pending queue store. In case they do and the user is not in any state, and for the question ones also the right
+    amount of time since the question was added is passed, the stored messages are sent to the user,
+    and the pending questions or wenet messages are removed from the store.
+    The pending items still contained in the contexts are moved to the store before being handled.
+
+    With an index of the users having pending messages, only their contexts are fetched, and all the contexts are
+    passed only every `full_scan_interval_sec` as a safety net (e.g. for messages stored before the index existed).
+    With a reminder scheduler, the remind later questions are sent when the scheduler fires them, in its own thread,
+    and they are looked for in the contexts only by the full scans.
+    The context of a user is loaded and saved holding the lock of the user, shared with the handler, so that the runs
+    of the job and the reminders do not overwrite the changes of each other.
+
+    Users are handled by `workers` threads, each user always by the same one so that its messages keep their order.
+    With a shard lease manager, a replica of the bot handles only the users of the shards it owns, renewing the lease of
+    the shard of a user before handling it, so that a long run does not handle users whose shard has been taken by
+    another replica.
+    With an outbound scheduler, the messages are sent with the lowest priority, after the ones of the handler.
     """
     REMINDER_MINUTES = 60
     CONTEXT_WENET_USER_ID = "wenet_user_id"
+    # users marked more recently are kept in the index even if nothing is pending, since their context may not be saved yet
+    INDEX_GRACE_SEC = 60
+    # delay of the reminders of the users doing another action when they are due
+    REMINDER_RETRY_SEC = 60
 
     def __init__(self, job_id, instance_namespace: str, connector: SocialConnector,
                  logger_connectors: Optional[List[LoggerConnector]], app_id: str, client_secret: str,
-                 oauth_cache: BaseCache, wenet_authentication_management_url: str, wenet_instance_url: str) -> None:
+                 oauth_cache: BaseCache, wenet_authentication_management_url: str, wenet_instance_url: str,
+                 log_shipper: Optional[LogShipper] = None, service_api_pool: Optional[ServiceApiPool] = None,
+                 pending_users_index: Optional[PendingUsersIndex] = None, full_scan_interval_sec: float = 3600,
+                 reminder_scheduler: Optional[ReminderScheduler] = None, workers: int = 1,
+                 shard_lease_manager: Optional[ShardLeaseManager] = None, pending_queue_store: Optional[PendingQueueStore] = None,
+                 outbound_scheduler: Optional[OutboundScheduler] = None, user_lock: Optional[StripedLock] = None) -> None:
         super().__init__(job_id, instance_namespace, connector, logger_connectors)
         self.app_id = app_id
         self.client_secret = client_secret
@@ -42,12 +76,169 @@ class PendingMessagesJob(SocialJob, StateMixin):
         self.wenet_authentication_management_url = wenet_authentication_management_url
         self.wenet_instance_url = wenet_instance_url
         self.message_parser_for_logs = LogMessageHandler(self.app_id, "Telegram")
+        self.log_shipper = log_shipper if log_shipper is not None else LogShipper(workers=0)
+        self.service_api_pool = service_api_pool if service_api_pool is not None else ServiceApiPool(app_id, client_secret, oauth_cache, wenet_authentication_management_url, wenet_instance_url)
+        self.pending_users_index = pending_users_index
+        self.full_scan_interval_sec = full_scan_interval_sec
+        self._last_full_scan: Optional[float] = None
+        self.reminder_scheduler = reminder_scheduler
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pending-messages") if workers > 1 else None
+        self.shard_lease_manager = shard_lease_manager
+        self.last_run_stats: dict = {}
+        self.pending_queue_store = pending_queue_store if pending_queue_store is not None else PendingQueueStore()
+        self.outbound_scheduler = outbound_scheduler
+        self.user_lock = user_lock if user_lock is not None else StripedLock()
+
+    def send_notification(self, notification: NotificationEvent) -> None:
+        if self.outbound_scheduler is None:
+            super().send_notification(notification)
+        else:
+            self.outbound_scheduler.submit(notification, OutboundScheduler.PRIORITY_BATCH).result()
 
     def _should_run(self) -> bool:
         return True
 
     def execute(self, **kwargs) -> None:
-        contexts = self._interface_connector.get_user_contexts(self._instance_namespace, None)
+        start = time.monotonic()
+        owned_shards: Set[int] = set()
+        if self.shard_lease_manager is not None:
+            self.shard_lease_manager.refresh()
+            owned_shards = self.shard_lease_manager.owned_shards()
+
+        if self.pending_users_index is None or self._last_full_scan is None or start - self._last_full_scan >= self.full_scan_interval_sec:
+            self._last_full_scan = start
+            full_scan = True
+            contexts = [context for context in self._interface_connector.get_user_contexts(self._instance_namespace, None) if self._owns(context.social_details)]
+            handled = self._run_partitioned(contexts, lambda context: context.social_details, lambda context: self._handle_scanned_user(context.social_details))
+        else:
+            full_scan = False
+            users = [(social_details, version) for social_details, version in self.pending_users_index.get_all() if self._owns(social_details)]
+            handled = self._run_partitioned(users, lambda user: user[0], lambda user: self._handle_pending_user(*user))
+
+        duration = time.monotonic() - start
+        self.last_run_stats = {
+            "full_scan": full_scan,
+            "users": handled,
+            "duration_sec": duration,
+            "users_per_sec": handled / duration if duration > 0 else 0.0,
+            "owned_shards": len(self.shard_lease_manager.owned_shards()) if self.shard_lease_manager is not None else None,
+            "lost_shards": len(owned_shards - self.shard_lease_manager.owned_shards()) if self.shard_lease_manager is not None else None,
+            "outbound_queued": self.outbound_scheduler.queue_depth() if self.outbound_scheduler is not None else None,
+        }
+        logger.info(f"Pending messages job run stats {self.last_run_stats}")
+        if self.shard_lease_manager is not None and duration > self.shard_lease_manager.lease_ttl_sec / 2:
+            logger.warning(f"The run took [{duration:.1f}] seconds, more than half of the lease time to live: other replicas may take the shards in the meantime")
+
+    def _owns(self, social_details: Optional[SocialDetails]) -> bool:
+        if self.shard_lease_manager is None:
+            return True
+        return social_details is not None and self.shard_lease_manager.owns(social_details.unique_id())
+
+    def _renew_lease(self, social_details: Optional[SocialDetails]) -> bool:
+        """
+        :return: True if the shard of the user is still owned by the replica, renewing its lease if needed
+        """
+        if self.shard_lease_manager is None or social_details is None:
+            return True
+        if self.shard_lease_manager.renew(social_details.unique_id()):
+            return True
+        logger.info(f"The shard of the user [{social_details}] has been taken by another replica, the user is not handled")
+        return False
+
+    def _lock_user(self, social_details: Optional[SocialDetails]):
+        """
+        :return: the lock of the user, the same taken by the handler for the messages addressed to the user
+        """
+        return self.user_lock.acquire(str(social_details.get_user_id()) if social_details is not None else "")
+
+    def _run_partitioned(self, items: List[T], get_social_details: Callable[[T], Optional[SocialDetails]], handle: Callable[[T], None]) -> int:
+        """
+        Handle the items in the worker threads, the items of a user are always handled in order by the same thread
+        :return: the number of handled items
+        """
+        if self._executor is None:
+            for item in items:
+                handle(item)
+            return len(items)
+
+        partitions: List[List[T]] = [[] for _ in range(self.workers)]
+        for item in items:
+            social_details = get_social_details(item)
+            key = social_details.unique_id() if social_details is not None else ""
+            partitions[zlib.crc32(key.encode("utf-8")) % self.workers].append(item)
+
+        def handle_partition(partition: List[T]) -> None:
+            for partition_item in partition:
+                handle(partition_item)
+
+        futures = [self._executor.submit(handle_partition, partition) for partition in partitions if partition]
+        for future in futures:
+            future.result()
+        return len(items)
+
+    def handle_due_reminders(self, reminders: List[Reminder]) -> None:
+        """
+        Send the questions of the due reminders, the reminders of users doing another action are scheduled again
+        """
+        question_ids: Dict[str, Set[str]] = {}
+        social_details = {}
+        for reminder in reminders:
+            question_ids.setdefault(reminder.social_details.unique_id(), set()).add(reminder.question_id)
+            social_details[reminder.social_details.unique_id()] = reminder.social_details
+
+        for unique_id, user_question_ids in question_ids.items():
+            try:
+                with self._lock_user(social_details[unique_id]):
+                    context = self._interface_connector.get_user_context(social_details[unique_id])
+                    if self._is_doing_another_action(context.context):
+                        for question_id in user_question_ids:
+                            self.reminder_scheduler.schedule(Reminder(social_details[unique_id], question_id, time.time() + self.REMINDER_RETRY_SEC))
+                    else:
+                        self._handle_remind_me_later_messages(context, user_question_ids)
+            except Exception as e:
+                logger.exception(f"An exception [{type(e)}] occurs handling the reminders of the user [{unique_id}]", exc_info=e)
+        if reminders:
+            logger.info(f"Handled [{len(reminders)}] due reminders, scheduler stats {self.reminder_scheduler.stats()}")
+
+    def _handle_pending_user(self, social_details: SocialDetails, version: str) -> None:
+        """
+        Handle the context of a user in the index, removing the user if its pending messages have all been sent
+        """
+        try:
+            if not self._renew_lease(social_details):
+                return
+            with self._lock_user(social_details):
+                context = self._interface_connector.get_user_context(social_details)
+                self._handle_contexts([context], remind_me_later=self.reminder_scheduler is None)
+            if not self._has_pending_messages(context) and time.time() - self.pending_users_index.marked_at(version) >= self.INDEX_GRACE_SEC:
+                self.pending_users_index.remove(social_details, version)
+        except Exception as e:
+            logger.exception(f"An exception [{type(e)}] occurs handling the pending messages of the user [{social_details}]", exc_info=e)
+
+    def _handle_scanned_user(self, social_details: SocialDetails) -> None:
+        """
+        Handle a user found by a full scan, its context is loaded again since it may have changed during the scan
+        """
+        try:
+            if not self._renew_lease(social_details):
+                return
+            with self._lock_user(social_details):
+                self._handle_contexts([self._interface_connector.get_user_context(social_details)])
+        except Exception as e:
+            logger.exception(f"An exception [{type(e)}] occurs handling the pending messages of the user [{social_details}]", exc_info=e)
+
+    def _has_pending_messages(self, context: UserConversationContext) -> bool:
+        if context.social_details is None:
+            return False
+        if self.pending_queue_store.has_legacy_items(context.context):
+            return True
+        if self.pending_queue_store.count_wenet_messages(context.social_details) > 0:
+            return True
+        # the remind later questions are tracked by the scheduler, when there is one
+        return self.reminder_scheduler is None and self.pending_queue_store.count_answers(context.social_details) > 0
+
+    def _handle_contexts(self, contexts: List[UserConversationContext], remind_me_later: bool = True) -> None:
         for context in contexts:
             if not self._is_doing_another_action(context.context):
                 try:
@@ -55,7 +246,7 @@ class PendingMessagesJob(SocialJob, StateMixin):
                 except Exception as e:
                     logger.exception(f"An exception [{type(e)}] occurs handling the context [{context}] for sending delayed wenet messages", exc_info=e)
 
-            if not self._is_doing_another_action(context.context):
+            if remind_me_later and not self._is_doing_another_action(context.context):
                 try:
                     self._handle_remind_me_later_messages(context)
                 except Exception as e:
@@ -63,105 +254,86 @@ class PendingMessagesJob(SocialJob, StateMixin):
 
     def _handle_delayed_wenet_messages(self, context: UserConversationContext) -> None:
         """
-        Check whether a context contains some pending wenet messages. In case they do, they are handled sending the
-        pending wenet messages and removing the wenet messages from the dict.
+        Check whether the user of a context has some pending wenet messages. In case they do, they are handled sending
+        the pending wenet messages and removing them from the store.
         """
-        notifications: List[NotificationEvent] = []
-        responses_to: List[Optional[str]] = []
-        pending_wenet_messages: Dict[str, dict] = context.context.get_static_state(self.CONTEXT_PENDING_WENET_MESSAGES, dict())
-        pending_wenet_messages_to_remove: Set[str] = set()
-        is_context_modified: bool = False
-        for pending_wenet_message_id in pending_wenet_messages:
+        if context.social_details is None or self._is_doing_another_action(context.context):
+            return
+
+        is_context_modified = self.pending_queue_store.migrate(context.social_details, context.context)
+        raw_pending_wenet_messages = self.pending_queue_store.pop_wenet_messages(context.social_details)
+        for raw_pending_wenet_message in raw_pending_wenet_messages:
+            is_context_modified = True
             try:
-                pending_wenet_message = PendingWenetMessage.from_repr(pending_wenet_messages[pending_wenet_message_id])
+                pending_wenet_message = PendingWenetMessage.from_repr(raw_pending_wenet_message)
             except Exception as e:
-                logger.exception(f"An exception [{type(e)}] occurs handling in parsing the pending wenet message [{pending_wenet_messages[pending_wenet_message_id]}]", exc_info=e)
-                pending_wenet_messages_to_remove.add(pending_wenet_message_id)
-                is_context_modified = True
+                logger.exception(f"An exception [{type(e)}] occurs handling in parsing the pending wenet message [{raw_pending_wenet_message}]", exc_info=e)
                 continue
 
-            notifications.append(NotificationEvent(social_details=pending_wenet_message.social_details, messages=pending_wenet_message.responses))
-            responses_to.append(pending_wenet_message.response_to)
-            pending_wenet_messages_to_remove.add(pending_wenet_message.pending_wenet_message_id)
-            is_context_modified = True
+            notification = NotificationEvent(social_details=pending_wenet_message.social_details, messages=pending_wenet_message.responses)
+            if self._send_pending_notification(context, notification, pending_wenet_message.response_to):
+                logger.debug(f"Sent delayed messages with the notification: [{notification.to_repr()}]")
 
-        if not self._is_doing_another_action(context.context):
-            for i, notification in enumerate(notifications):
-                notification.with_context(context.context)
-                oauth_client = Oauth2Client(self.app_id, self.client_secret, notification.social_details.unique_id(), self.oauth_cache, token_endpoint_url=self.wenet_authentication_management_url)
-                service_api = ServiceApiInterface(oauth_client, self.wenet_instance_url)
-                try:
-                    self.send_notification(notification)
-                    logger.debug(f"Sent delayed messages with the notification: [{notification.to_repr()}]")
-
-                    if responses_to[i]:
-                        for outgoing_message in notification.messages:
-                            try:
-                                service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, context.context.get_static_state(self.CONTEXT_WENET_USER_ID), responses_to[i]))
-                            except TypeError as e:
-                                logger.warning("Unsupported message to log", exc_info=e)
-                            except CreationError:
-                                logger.warning("Unable to send logs to the service API")
-                except Exception as e:
-                    logger.exception(f"An exception [{type(e)}] occurs sending the notification [{notification.to_repr()}]", exc_info=e)
+        if is_context_modified:
+            self.pending_queue_store.update_counts(context.social_details, context.context)
+            self._interface_connector.update_user_context(context)
 
-            for pending_wenet_message_id in pending_wenet_messages_to_remove:
-                pending_wenet_messages.pop(pending_wenet_message_id)
-
-            if is_context_modified:
-                context.context.with_static_state(self.CONTEXT_PENDING_WENET_MESSAGES, pending_wenet_messages)
-                self._interface_connector.update_user_context(context)
-
-    def _handle_remind_me_later_messages(self, context: UserConversationContext) -> None:
+    def _handle_remind_me_later_messages(self, context: UserConversationContext, question_ids: Optional[Set[str]] = None) -> None:
         """
-        Check whether a context contains some pending questions to be answered. In case they do, they are handled
+        Check whether the user of a context has some pending questions to be answered. In case they do, they are handled
         sending the pending questions if the right amount of time since the question was added is passed
-        and removing the questions from the dict.
-        """
-        notifications: List[NotificationEvent] = []
-        responses_to: List[Optional[str]] = []
-        pending_answers: Dict[str, dict] = context.context.get_static_state(self.CONTEXT_PENDING_ANSWERS, dict())
-        questions_to_remove: Set[str] = set()
-        is_context_modified: bool = False
-        for question_id in pending_answers:
+        and removing the questions from the store.
+        When the IDs of the due questions are given, only those questions are sent, without checking the time.
+        """
+        if context.social_details is None or self._is_doing_another_action(context.context):
+            return
+
+        is_context_modified = self.pending_queue_store.migrate(context.social_details, context.context)
+        if question_ids is None:
+            question_ids = set()
+            for question_id, raw_pending_answer in self.pending_queue_store.get_answers(context.social_details).items():
+                try:
+                    sent = PendingQuestionToAnswer.from_repr(raw_pending_answer).sent
+                except Exception:
+                    # taken and discarded below
+                    question_ids.add(question_id)
+                    continue
+                if sent is not None and sent + datetime.timedelta(minutes=self.REMINDER_MINUTES) <= datetime.datetime.now():
+                    question_ids.add(question_id)
+
+        raw_pending_answers = self.pending_queue_store.pop_answers(context.social_details, question_ids)
+        for raw_pending_answer in raw_pending_answers.values():
+            is_context_modified = True
             try:
-                pending_answer = PendingQuestionToAnswer.from_repr(pending_answers[question_id])
+                pending_answer = PendingQuestionToAnswer.from_repr(raw_pending_answer)
             except Exception as e:
-                logger.exception(f"An exception [{type(e)}] occurs handling in parsing the pending answer [{pending_answers[question_id]}]", exc_info=e)
-                questions_to_remove.add(question_id)
-                is_context_modified = True
+                logger.exception(f"An exception [{type(e)}] occurs handling in parsing the pending answer [{raw_pending_answer}]", exc_info=e)
                 continue
 
-            if pending_answer.sent is not None and pending_answer.sent + datetime.timedelta(minutes=self.REMINDER_MINUTES) <= datetime.datetime.now():
-                notifications.append(NotificationEvent(social_details=pending_answer.social_details, messages=[pending_answer.response]))
-                responses_to.append(pending_answer.response_to)
-                questions_to_remove.add(pending_answer.question_id)
-                is_context_modified = True
-
-        if not self._is_doing_another_action(context.context):
-            for i, notification in enumerate(notifications):
-                notification.with_context(context.context)
-                oauth_client = Oauth2Client(self.app_id, self.client_secret, notification.social_details.unique_id(), self.oauth_cache, token_endpoint_url=self.wenet_authentication_management_url)
-                service_api = ServiceApiInterface(oauth_client, self.wenet_instance_url)
-                try:
-                    self.send_notification(notification)
-                    logger.debug(f"Sent remind me later messages with the notification: [{notification.to_repr()}]")
-
-                    if responses_to[i]:
-                        for outgoing_message in notification.messages:
-                            try:
-                                service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, context.context.get_static_state(self.CONTEXT_WENET_USER_ID), responses_to[i]))
-                            except TypeError as e:
-                                logger.warning("Unsupported message to log", exc_info=e)
-                            except CreationError:
-                                logger.warning("Unable to send logs to the service API")
-
-                except Exception as e:
-                    logger.exception(f"An exception [{type(e)}] occurs sending the notification [{notification.to_repr()}]", exc_info=e)
+            notification = NotificationEvent(social_details=pending_answer.social_details, messages=[pending_answer.response])
+            if self._send_pending_notification(context, notification, pending_answer.response_to):
+                logger.debug(f"Sent remind me later messages with the notification: [{notification.to_repr()}]")
 
-            for question_id in questions_to_remove:
-                pending_answers.pop(question_id)
+        if is_context_modified:
+            self.pending_queue_store.update_counts(context.social_details, context.context)
+            self._interface_connector.update_user_context(context)
 
-            if is_context_modified:
-                context.context.with_static_state(self.CONTEXT_PENDING_ANSWERS, pending_answers)
-                self._interface_connector.update_user_context(context)
+    def _send_pending_notification(self, context: UserConversationContext, notification: NotificationEvent, response_to: Optional[str]) -> bool:
+        """
+        Send a pending notification to the user, shipping the logs of its messages
+        :return: True if the notification has been sent
+        """
+        notification.with_context(context.context)
+        service_api = self.service_api_pool.get(notification.social_details.unique_id())
+        try:
+            self.send_notification(notification)
+            if response_to:
+                for outgoing_message in notification.messages:
+                    try:
+                        self.log_shipper.ship(service_api, self.message_parser_for_logs.create_response(outgoing_message, context.context.get_static_state(self.CONTEXT_WENET_USER_ID), response_to))
+                    except TypeError as e:
+                        logger.warning("Unsupported message to log", exc_info=e)
+            return True
+        except Exception as e:
+            logger.exception(f"An exception [{type(e)}] occurs sending the notification [{notification.to_repr()}]", exc_info=e)
+            return False
@@ -0,0 +1,221 @@
+from __future__ import absolute_import, annotations
+
+import argparse
+import json
+import logging
+import os
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+
+from chatbot_core.model.context import ConversationContext
+from chatbot_core.model.details import SocialDetails
+from wenet.storage.cache import RedisCache
+
+from ask_for_help_bot.state_mixin import StateMixin
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.askforhelp.pending_queue_store")
+
+
+class PendingQueueStore:
+    """
+    Store of the pending wenet messages and of the pending answers of the users, outside of their contexts.
+
+    The pending wenet messages of a user are a Redis list, to which messages are pushed when they are deferred and that
+    is emptied at once when they are sent. The pending answers of a user are a Redis hash from the question ID, since
+    they are sent one by one when they are due. Both expire `ttl_sec` after the last item was added.
+    Without a Redis client the queues are kept in memory, which is only suitable for a single process.
+
+    The contexts only keep the number of pending items. The contexts still containing the pending items, stored by the
+    previous versions of the bot, are migrated with `migrate`.
+
+    Attributes:
+        - ttl_sec: the time to live of the queues of a user
+    """
+    WENET_MESSAGES_KEY = "pending-wenet-messages-{}"
+    ANSWERS_KEY = "pending-answers-{}"
+
+    def __init__(self, r=None, ttl_sec: int = 604800) -> None:
+        self._r = r
+        self.ttl_sec = ttl_sec
+        self._lists: Dict[str, List[str]] = {}
+        self._hashes: Dict[str, Dict[str, str]] = {}
+        self._local_lock = Lock()
+
+    def push_wenet_message(self, social_details: SocialDetails, pending_wenet_message: dict) -> int:
+        """
+        Add a message at the end of the pending wenet messages of the user
+        :return: the number of pending wenet messages of the user
+        """
+        key = self.WENET_MESSAGES_KEY.format(social_details.unique_id())
+        value = json.dumps(pending_wenet_message)
+        if self._r is not None:
+            pipeline = self._r.pipeline(transaction=True)
+            pipeline.rpush(key, value)
+            pipeline.expire(key, self.ttl_sec)
+            return pipeline.execute()[0]
+        with self._local_lock:
+            self._lists.setdefault(key, []).append(value)
+            return len(self._lists[key])
+
+    def pop_wenet_messages(self, social_details: SocialDetails) -> List[dict]:
+        """
+        Take all the pending wenet messages of the user, in the order they were added
+        """
+        key = self.WENET_MESSAGES_KEY.format(social_details.unique_id())
+        if self._r is not None:
+            pipeline = self._r.pipeline(transaction=True)
+            pipeline.lrange(key, 0, -1)
+            pipeline.delete(key)
+            values = pipeline.execute()[0]
+        else:
+            with self._local_lock:
+                values = self._lists.pop(key, [])
+        return [json.loads(value) for value in values]
+
+    def count_wenet_messages(self, social_details: SocialDetails) -> int:
+        key = self.WENET_MESSAGES_KEY.format(social_details.unique_id())
+        if self._r is not None:
+            return self._r.llen(key)
+        with self._local_lock:
+            return len(self._lists.get(key, []))
+
+    def put_answer(self, social_details: SocialDetails, question_id: str, pending_answer: dict) -> int:
+        """
+        Add or replace the pending answer to a question of the user
+        :return: the number of pending answers of the user
+        """
+        key = self.ANSWERS_KEY.format(social_details.unique_id())
+        value = json.dumps(pending_answer)
+        if self._r is not None:
+            pipeline = self._r.pipeline(transaction=True)
+            pipeline.hset(key, question_id, value)
+            pipeline.expire(key, self.ttl_sec)
+            pipeline.hlen(key)
+            return pipeline.execute()[2]
+        with self._local_lock:
+            self._hashes.setdefault(key, {})[question_id] = value
+            return len(self._hashes[key])
+
+    def get_answers(self, social_details: SocialDetails) -> Dict[str, dict]:
+        """
+        :return: the pending answers of the user, by question ID, without removing them
+        """
+        key = self.ANSWERS_KEY.format(social_details.unique_id())
+        if self._r is not None:
+            values = self._r.hgetall(key)
+        else:
+            with self._local_lock:
+                values = dict(self._hashes.get(key, {}))
+        return {self._decode(question_id): json.loads(value) for question_id, value in values.items()}
+
+    def pop_answers(self, social_details: SocialDetails, question_ids: Iterable[str]) -> Dict[str, dict]:
+        """
+        Take the pending answers of the user to the given questions, the ones that are not pending are ignored
+        """
+        key = self.ANSWERS_KEY.format(social_details.unique_id())
+        question_ids = list(question_ids)
+        if not question_ids:
+            return {}
+        if self._r is not None:
+            pipeline = self._r.pipeline(transaction=True)
+            pipeline.hmget(key, question_ids)
+            pipeline.hdel(key, *question_ids)
+            values = pipeline.execute()[0]
+        else:
+            with self._local_lock:
+                answers = self._hashes.get(key, {})
+                values = [answers.pop(question_id, None) for question_id in question_ids]
+                if not answers:
+                    self._hashes.pop(key, None)
+        return {question_id: json.loads(value) for question_id, value in zip(question_ids, values) if value is not None}
+
+    def count_answers(self, social_details: SocialDetails) -> int:
+        key = self.ANSWERS_KEY.format(social_details.unique_id())
+        if self._r is not None:
+            return self._r.hlen(key)
+        with self._local_lock:
+            return len(self._hashes.get(key, {}))
+
+    def has_legacy_items(self, context: Optional[ConversationContext]) -> bool:
+        """
+        :return: True if the context still contains pending items, as stored by the previous versions of the bot
+        """
+        return context is not None and (
+            context.has_static_state(StateMixin.CONTEXT_PENDING_WENET_MESSAGES) or
+            context.has_static_state(StateMixin.CONTEXT_PENDING_ANSWERS)
+        )
+
+    def migrate(self, social_details: Optional[SocialDetails], context: Optional[ConversationContext]) -> bool:
+        """
+        Move the pending items still contained in the context of the user to the store, replacing them with their number
+        :return: True if the context has been modified, and it should be saved
+        """
+        if social_details is None or not self.has_legacy_items(context):
+            return False
+
+        pending_wenet_messages = context.get_static_state(StateMixin.CONTEXT_PENDING_WENET_MESSAGES, dict())
+        for pending_wenet_message in pending_wenet_messages.values():
+            self.push_wenet_message(social_details, pending_wenet_message)
+        pending_answers = context.get_static_state(StateMixin.CONTEXT_PENDING_ANSWERS, dict())
+        for question_id, pending_answer in pending_answers.items():
+            self.put_answer(social_details, question_id, pending_answer)
+
+        context.delete_static_state(StateMixin.CONTEXT_PENDING_WENET_MESSAGES)
+        context.delete_static_state(StateMixin.CONTEXT_PENDING_ANSWERS)
+        self.update_counts(social_details, context)
+        logger.info(f"Migrated [{len(pending_wenet_messages)}] pending wenet messages and [{len(pending_answers)}] pending answers of the user [{social_details.get_user_id()}]")
+        return True
+
+    def update_counts(self, social_details: SocialDetails, context: ConversationContext) -> None:
+        """
+        Store in the context the number of pending items of the user
+        """
+        context.with_static_state(StateMixin.CONTEXT_PENDING_WENET_MESSAGES_COUNT, self.count_wenet_messages(social_details))
+        context.with_static_state(StateMixin.CONTEXT_PENDING_ANSWERS_COUNT, self.count_answers(social_details))
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    @staticmethod
+    def build_from_env() -> PendingQueueStore:
+        """
+        Build the store using environment variables.
+
+        Required environment variables are:
+          - REDIS_HOST - default to 'localhost'
+          - REDIS_PORT - default to '6379'
+          - REDIS_DB - default to '0'
+
+        Optional environment variables are:
+          - PENDING_QUEUE_TTL - default to '604800' (7 days)
+
+        :return: the store
+        """
+        return PendingQueueStore(RedisCache._build_redis_from_env(), ttl_sec=int(os.getenv("PENDING_QUEUE_TTL", 604800)))
+
+
+def migrate_all(store: PendingQueueStore, interface_connector, instance_namespace: str, bot_id: Optional[str]) -> int:
+    """
+    Migrate the pending items of all the contexts of the bot to the store
+    :return: the number of migrated contexts
+    """
+    migrated = 0
+    for user_context in interface_connector.get_user_contexts(instance_namespace, bot_id):
+        if store.migrate(user_context.social_details, user_context.context):
+            interface_connector.update_user_context(user_context)
+            migrated += 1
+    logger.info(f"Migrated the pending items of [{migrated}] user contexts")
+    return migrated
+
+
+if __name__ == "__main__":
+    from chatbot_core.v3.connector.chatbot_interface import ChatbotInterfaceConnectorV3
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Move the pending wenet messages and answers from the user contexts to Redis")
+    parser.add_argument("bot_id", help="the ID of the bot, e.g. wenet-ask-for-help")
+    args = parser.parse_args()
+
+    migrate_all(PendingQueueStore.build_from_env(), ChatbotInterfaceConnectorV3.build_from_env(), os.getenv("INSTANCE_NAMESPACE"), args.bot_id)
@@ -0,0 +1,122 @@
+from __future__ import absolute_import, annotations
+
+import json
+import logging
+import time
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from chatbot_core.model.details import SocialDetails
+from wenet.storage.cache import RedisCache
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.askforhelp.pending_users_index")
+
+
+class PendingUsersIndex:
+    """
+    Index of the users having pending wenet messages or pending answers in their context, so that the pending
+    messages job fetches only their contexts instead of all of them.
+
+    Users are stored in a Redis hash, from their social details to the time they were last marked. An entry is removed
+    only if the user has not been marked again in the meantime, so that a message deferred while the job is handling
+    the user is not missed. Without a Redis client the index is kept in memory, which is only suitable for a single
+    process.
+
+    Attributes:
+        - key: the key of the Redis hash
+    """
+    KEY = "pending-users"
+
+    # remove the field only if it has not been updated since it was read
+    _REMOVE_IF_UNCHANGED = """
+    if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+        return redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+
+    def __init__(self, r=None, key: str = KEY) -> None:
+        self._r = r
+        self.key = key
+        self._remove_if_unchanged = r.register_script(self._REMOVE_IF_UNCHANGED) if r is not None else None
+        self._local: Dict[str, str] = {}
+        self._local_lock = Lock()
+
+    def mark(self, social_details: SocialDetails) -> None:
+        """
+        Mark the user as having pending messages
+        """
+        member = json.dumps(social_details.to_repr(), sort_keys=True)
+        marked_at = repr(time.time())
+        if self._r is not None:
+            self._r.hset(self.key, member, marked_at)
+        else:
+            with self._local_lock:
+                self._local[member] = marked_at
+
+    def get_all(self) -> List[Tuple[SocialDetails, str]]:
+        """
+        :return: the marked users, together with the version of their entry to be given back to `remove`
+        """
+        if self._r is not None:
+            entries = {self._decode(member): self._decode(marked_at) for member, marked_at in self._r.hgetall(self.key).items()}
+        else:
+            with self._local_lock:
+                entries = dict(self._local)
+
+        users = []
+        for member, marked_at in entries.items():
+            try:
+                users.append((SocialDetails.from_repr(json.loads(member)), marked_at))
+            except Exception as e:
+                logger.warning(f"Removing the malformed entry [{member}] from the pending users", exc_info=e)
+                self._remove_member(member, marked_at)
+        return users
+
+    def remove(self, social_details: SocialDetails, version: str) -> bool:
+        """
+        Remove a user from the index, unless it has been marked again after reading the given version of its entry
+        :return: True if the user has been removed
+        """
+        return self._remove_member(json.dumps(social_details.to_repr(), sort_keys=True), version)
+
+    @staticmethod
+    def marked_at(version: str) -> float:
+        """
+        :return: the time the user was marked, from the version of its entry
+        """
+        return float(version)
+
+    def size(self) -> int:
+        if self._r is not None:
+            return self._r.hlen(self.key)
+        with self._local_lock:
+            return len(self._local)
+
+    def _remove_member(self, member: str, version: str) -> bool:
+        if self._r is not None:
+            return bool(self._remove_if_unchanged(keys=[self.key], args=[member, version]))
+        with self._local_lock:
+            if self._local.get(member) == version:
+                del self._local[member]
+                return True
+            return False
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    @staticmethod
+    def build_from_env() -> PendingUsersIndex:
+        """
+        Build the index using environment variables.
+
+        Required environment variables are:
+          - REDIS_HOST - default to 'localhost'
+          - REDIS_PORT - default to '6379'
+          - REDIS_DB - default to '0'
+
+        :return: the index
+        """
+        return PendingUsersIndex(RedisCache._build_redis_from_env())
@@ -0,0 +1,205 @@
+from __future__ import absolute_import, annotations
+
+import json
+import logging
+import os
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+from chatbot_core.model.details import SocialDetails
+from wenet.storage.cache import RedisCache
+
+from common.timing_wheel import TimingWheel
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.askforhelp.reminder_scheduler")
+
+
+class Reminder:
+    """
+    A question to be sent again to a user, when it is due
+
+    Attributes:
+        - social_details: the social details of the user
+        - question_id: the ID of the question among the pending answers of the user
+        - due_at: the timestamp at which the question is sent again
+    """
+
+    def __init__(self, social_details: SocialDetails, question_id: str, due_at: float) -> None:
+        self.social_details = social_details
+        self.question_id = question_id
+        self.due_at = due_at
+
+    def member(self) -> str:
+        """
+        :return: the identifier of the reminder in the scheduler, the same for all the reminders of the question
+        """
+        return json.dumps({"socialDetails": self.social_details.to_repr(), "questionId": self.question_id}, sort_keys=True)
+
+    @staticmethod
+    def from_member(member: str, due_at: float) -> Reminder:
+        raw = json.loads(member)
+        return Reminder(SocialDetails.from_repr(raw["socialDetails"]), raw["questionId"], due_at)
+
+    def __repr__(self) -> str:
+        return f"Reminder({self.member()}, {self.due_at})"
+
+
+class ReminderScheduler:
+    """
+    Scheduler of the remind later questions, firing each of them when it is due.
+
+    Reminders are kept in a timing wheel in memory and in a Redis sorted set by due time, so that they survive restarts
+    and are shared by the replicas of the bot: the sorted set is loaded at start and periodically merged into the wheel,
+    and a due reminder is fired only by the replica that removes it from the sorted set. Without a Redis client the
+    reminders are only kept in memory.
+
+    The lag between the due time and the firing of the reminders is measured.
+
+    Attributes:
+        - key: the key of the Redis sorted set
+        - tick_sec: the precision of the timing wheel
+        - sync_interval_sec: how often the reminders added by other replicas are loaded from Redis
+    """
+    KEY = "remind-later"
+
+    # remove the reminder only if it has not been scheduled again for another time
+    _CLAIM = """
+    local due_at = redis.call('ZSCORE', KEYS[1], ARGV[1])
+    if due_at and tonumber(due_at) == tonumber(ARGV[2]) then
+        return redis.call('ZREM', KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+
+    def __init__(self, r=None, key: str = KEY, tick_sec: float = 1, sync_interval_sec: float = 60) -> None:
+        self._r = r
+        self.key = key
+        self.tick_sec = tick_sec
+        self.sync_interval_sec = sync_interval_sec
+        self._claim = r.register_script(self._CLAIM) if r is not None else None
+        self._lock = Lock()
+        self._wheel = TimingWheel(time.time(), tick_sec=tick_sec)
+        # due time of the reminders in the wheel, to ignore the ones superseded by a later schedule
+        self._scheduled: Dict[str, float] = {}
+        self._last_sync: Optional[float] = None
+        self._thread: Optional[Thread] = None
+        self._stopped = Event()
+        # lag statistics
+        self.fired = 0
+        self.total_lag_sec = 0.0
+        self.max_lag_sec = 0.0
+
+    def schedule(self, reminder: Reminder) -> None:
+        member = reminder.member()
+        if self._r is not None:
+            self._r.zadd(self.key, {member: reminder.due_at})
+        with self._lock:
+            self._add(member, reminder.due_at)
+
+    def _add(self, member: str, due_at: float) -> None:
+        if self._scheduled.get(member) != due_at:
+            self._scheduled[member] = due_at
+            self._wheel.add(due_at, member)
+
+    def sync(self) -> None:
+        """
+        Add to the wheel the reminders stored in Redis, e.g. by another replica or before a restart
+        """
+        if self._r is None:
+            return
+        entries = self._r.zrange(self.key, 0, -1, withscores=True)
+        with self._lock:
+            for member, due_at in entries:
+                self._add(member.decode("utf-8") if isinstance(member, bytes) else member, due_at)
+            self._last_sync = time.monotonic()
+
+    def pop_due(self) -> List[Reminder]:
+        """
+        Take the reminders that are due, they are removed from the scheduler
+        """
+        if self._r is not None and (self._last_sync is None or time.monotonic() - self._last_sync >= self.sync_interval_sec):
+            self.sync()
+
+        now = time.time()
+        with self._lock:
+            due: List[Reminder] = []
+            for due_at, member in self._wheel.advance(now):
+                if self._scheduled.get(member) != due_at:
+                    # scheduled again for another time
+                    continue
+                del self._scheduled[member]
+                due.append(Reminder.from_member(member, due_at))
+
+        fired = []
+        for reminder in due:
+            # only the replica removing the reminder from Redis fires it
+            if self._claim is not None and not self._claim(keys=[self.key], args=[reminder.member(), repr(reminder.due_at)]):
+                continue
+            self._record_lag(now - reminder.due_at)
+            fired.append(reminder)
+        return fired
+
+    def _record_lag(self, lag_sec: float) -> None:
+        with self._lock:
+            self.fired += 1
+            self.total_lag_sec += lag_sec
+            self.max_lag_sec = max(self.max_lag_sec, lag_sec)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "scheduled": len(self._scheduled),
+                "fired": self.fired,
+                "avg_lag_sec": self.total_lag_sec / self.fired if self.fired else 0.0,
+                "max_lag_sec": self.max_lag_sec,
+            }
+
+    def start(self, callback: Callable[[List[Reminder]], None]) -> ReminderScheduler:
+        """
+        Start a thread calling the callback with the due reminders at every tick
+        """
+        if self._thread is not None:
+            return self
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, args=(callback,), name="reminder-scheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, callback: Callable[[List[Reminder]], None]) -> None:
+        while not self._stopped.wait(self.tick_sec):
+            try:
+                reminders = self.pop_due()
+                if reminders:
+                    callback(reminders)
+            except Exception as e:
+                logger.exception("Unable to fire the due reminders", exc_info=e)
+
+    @staticmethod
+    def build_from_env() -> ReminderScheduler:
+        """
+        Build the scheduler using environment variables.
+
+        Required environment variables are:
+          - REDIS_HOST - default to 'localhost'
+          - REDIS_PORT - default to '6379'
+          - REDIS_DB - default to '0'
+
+        Optional environment variables are:
+          - REMINDER_SCHEDULER_TICK_SEC - default to '1'
+          - REMINDER_SCHEDULER_SYNC_INTERVAL - default to '60'
+
+        :return: the scheduler, not yet started
+        """
+        return ReminderScheduler(
+            RedisCache._build_redis_from_env(),
+            tick_sec=float(os.getenv("REMINDER_SCHEDULER_TICK_SEC", 1)),
+            sync_interval_sec=float(os.getenv("REMINDER_SCHEDULER_SYNC_INTERVAL", 60))
+        )
@@ -8,6 +8,9 @@ class StateMixin:
     # context for wenet messages and pending answers
     CONTEXT_PENDING_WENET_MESSAGES = "pending_wenet_messages"
     CONTEXT_PENDING_ANSWERS = "pending_answers"
+    # context for the number of wenet messages and pending answers, the items are in the pending queue store
+    CONTEXT_PENDING_WENET_MESSAGES_COUNT = "pending_wenet_messages_count"
+    CONTEXT_PENDING_ANSWERS_COUNT = "pending_answers_count"
     # available states
     STATE_QUESTION_0 = "question_0"
     STATE_QUESTION_1 = "question_1"
@@ -1,14 +1,200 @@
 from __future__ import absolute_import, annotations
 
-from typing import Optional
+import copy
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
-from wenet.storage.cache import RedisCache
+from wenet.storage.cache import InMemoryCache, RedisCache
+
+from common.button_payload import ButtonPayload
+from common.cache_codec import CacheCodec, MsgpackCodec, build_codec_from_env
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.cache")
+
+
+BUTTON_GROUP_KEY = "button-group-{}"
+BUTTON_GROUP_PAYLOAD_FIELD = "payload"
+BUTTON_CONSUMED_KEY = "button-consumed-{}"
+BUTTON_CONSUMED_TTL = 600
+
+
+class ButtonAlreadyConsumedError(Exception):
+    """
+    The button was clicked, and its payload consumed, by a previous click: e.g. a double tap of the user
+    """
+
+
+def is_group_button(button_id: str) -> bool:
+    """
+    :return: if the button is part of a group of buttons, or it is a button stored on its own
+    """
+    return button_id.count("-") == 1
+
+
+def _new_button_group(buttons: List[ButtonPayload]) -> Tuple[str, List[str]]:
+    group_id = uuid.uuid4().hex
+    return group_id, [f"{group_id}-{i}" for i in range(len(buttons))]
+
+
+def _split_button_id(button_id: str) -> Tuple[str, str, str]:
+    group_id, index = button_id.split("-")
+    return BUTTON_GROUP_KEY.format(group_id), BUTTON_CONSUMED_KEY.format(group_id), index
 
 
 class BotCache(RedisCache):
+    """
+    The Redis cache of the bots. The values are serialized by a pluggable codec, a compact binary one by default, still
+    reading the JSON values stored by the previous versions.
+
+    Besides the entries of the base cache, it stores groups of buttons sent in the same message: the payload shared by
+    the buttons of a group is stored once, in a Redis hash with a small record for each button holding its intent and
+    the data specific of the button. The ID of a button refers to its group, so that a button is read with a single
+    command and all the buttons of the group are invalidated at once by deleting the hash.
+
+    Clicked buttons are consumed atomically by a script, reading the payload and invalidating the buttons in the same
+    round trip and leaving a short lived marker, so that only the first of concurrent clicks gets the payload and the
+    others are told that the button was already consumed.
+    """
+
+    # read the button and delete its group, marking it as consumed. The payload is not returned when already known
+    _CONSUME_GROUP_BUTTON = """
+    local values = redis.call('HMGET', KEYS[1], ARGV[1], ARGV[2])
+    if values[1] and values[2] then
+        redis.call('DEL', KEYS[1])
+        redis.call('SET', KEYS[2], '1', 'EX', ARGV[3])
+        if ARGV[4] == '1' then
+            return values
+        end
+        return 2
+    end
+    return redis.call('EXISTS', KEYS[2])
+    """
+
+    # read a button stored on its own and delete it, marking it as consumed
+    _CONSUME = """
+    local value = redis.call('GET', KEYS[1])
+    if value then
+        redis.call('DEL', KEYS[1])
+        redis.call('SET', KEYS[2], '1', 'EX', ARGV[1])
+        return value
+    end
+    return redis.call('EXISTS', KEYS[2])
+    """
+
+    def __init__(self, r, codec: Optional[CacheCodec] = None) -> None:
+        super().__init__(r)
+        self._codec = codec if codec is not None else MsgpackCodec()
+        self._consume_group_button = r.register_script(self._CONSUME_GROUP_BUTTON)
+        self._consume = r.register_script(self._CONSUME)
 
     def cache(self, data: dict, ttl: int = 604800, key: Optional[str] = None) -> str:
-        return super().cache(data, key, ttl=ttl)
+        if key is None:
+            key = str(uuid.uuid4())
+        self._r.set(key, self._codec.encode(data), ex=ttl)
+        return key
+
+    def get(self, key: str) -> Optional[dict]:
+        raw = self._r.get(key)
+        return self._codec.decode(raw) if raw is not None else None
+
+    def cache_many(self, entries: Dict[str, dict], ttl: int = 604800) -> None:
+        """
+        Cache several entries in a single round trip to Redis.
+        The entries are written through a pipeline.
+
+        :param entries: the data to cache, by key
+        :param ttl: the time to live of every entry
+        """
+        if not entries:
+            return
+        pipeline = self._r.pipeline(transaction=False)
+        for key, data in entries.items():
+            pipeline.set(key, self._codec.encode(data), ex=ttl)
+        pipeline.execute()
+
+    def cache_button_group(self, payload: dict, buttons: List[ButtonPayload], ttl: int = 604800) -> List[str]:
+        """
+        Cache a group of buttons, clicking one of them invalidates all the others
+
+        :param payload: the payload shared by all the buttons
+        :param buttons: the intent of each button, with the data to add to the shared payload for that button
+        :param ttl: the time to live of the group
+        :return: the IDs of the buttons, in the same order
+        """
+        group_id, button_ids = _new_button_group(buttons)
+        key = BUTTON_GROUP_KEY.format(group_id)
+        mapping = {BUTTON_GROUP_PAYLOAD_FIELD: self._codec.encode(payload)}
+        for i, button in enumerate(buttons):
+            mapping[str(i)] = self._codec.encode({"intent": button.intent, "extra": button.payload})
+        pipeline = self._r.pipeline(transaction=False)
+        pipeline.hset(key, mapping=mapping)
+        pipeline.expire(key, ttl)
+        pipeline.execute()
+        return button_ids
+
+    def consume_group_button(self, button_id: str) -> Optional[ButtonPayload]:
+        """
+        Get the payload of a clicked button of a group and invalidate all the buttons of the group, atomically
+
+        :return: the payload of the button, None if the group is expired
+        :raise ButtonAlreadyConsumedError: if the group was invalidated by a previous click
+        """
+        result = self._run_consume_group_button(button_id, with_payload=True)
+        if result is None:
+            return None
+        raw_payload, raw_button = result
+        button = self._codec.decode(raw_button)
+        return ButtonPayload(dict(self._codec.decode(raw_payload), **button["extra"]), button["intent"])
+
+    def claim_group_button(self, button_id: str) -> bool:
+        """
+        Invalidate all the buttons of the group of a clicked button, atomically, without reading its payload.
+        It is used in place of `consume_group_button` when the payload is already known
+
+        :return: True if the button was claimed, False if the group is expired
+        :raise ButtonAlreadyConsumedError: if the group was invalidated by a previous click
+        """
+        return self._run_consume_group_button(button_id, with_payload=False) is not None
+
+    def _run_consume_group_button(self, button_id: str, with_payload: bool):
+        key, consumed_key, index = _split_button_id(button_id)
+        result = self._consume_group_button(keys=[key, consumed_key], args=[BUTTON_GROUP_PAYLOAD_FIELD, index, BUTTON_CONSUMED_TTL, "1" if with_payload else "0"])
+        if isinstance(result, list):
+            return result
+        if result == 2:
+            return True
+        if result:
+            raise ButtonAlreadyConsumedError(button_id)
+        return None
+
+    def consume(self, key: str) -> Optional[dict]:
+        """
+        Get the data of a key and remove it from the cache, atomically
+
+        :return: the cached data, None if it is expired
+        :raise ButtonAlreadyConsumedError: if the key was consumed by a previous call
+        """
+        result = self._consume(keys=[key, BUTTON_CONSUMED_KEY.format(key)], args=[BUTTON_CONSUMED_TTL])
+        if isinstance(result, int):
+            if result:
+                raise ButtonAlreadyConsumedError(key)
+            return None
+        return self._codec.decode(result)
+
+    def mark_consumed(self, consumed_id: str, ttl: int = BUTTON_CONSUMED_TTL) -> bool:
+        """
+        Mark as consumed a button whose payload is not stored in the cache, e.g. signed in its callback data
+
+        :return: True if the button was not consumed yet
+        """
+        return bool(self._r.set(BUTTON_CONSUMED_KEY.format(consumed_id), "1", nx=True, ex=ttl))
 
     @staticmethod
     def build_from_env() -> BotCache:
@@ -20,13 +206,315 @@ class BotCache(RedisCache):
           - REDIS_PORT - default to '6379'
           - REDIS_DB - default to '0'
 
+        Optional environment variables are:
+          - BOT_CACHE_CODEC - default to 'msgpack'
+          - BOT_CACHE_ZSTD_THRESHOLD - default to '512'
+
         :return: the bot cache
         """
         r = BotCache._build_redis_from_env()
-        return BotCache(r)
+        return BotCache(r, codec=build_codec_from_env())
 
     def remove(self, key: str):
         """
         Remove a key and its value from the cache
         """
         self._r.delete(key)
+
+
+class InMemoryBotCache(InMemoryCache):
+    """
+    In memory counterpart of the bot cache, used when Redis is not available (e.g. in tests)
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._consumed = set()
+        self._consume_lock = Lock()
+
+    def cache_many(self, entries: Dict[str, dict], ttl: int = 604800) -> None:
+        for key, data in entries.items():
+            self.cache(data, ttl=ttl, key=key)
+
+    def cache_button_group(self, payload: dict, buttons: List[ButtonPayload], ttl: int = 604800) -> List[str]:
+        group_id, button_ids = _new_button_group(buttons)
+        self._cache[BUTTON_GROUP_KEY.format(group_id)] = {
+            BUTTON_GROUP_PAYLOAD_FIELD: dict(payload),
+            "buttons": {str(i): {"intent": button.intent, "extra": dict(button.payload)} for i, button in enumerate(buttons)}
+        }
+        return button_ids
+
+    def consume_group_button(self, button_id: str) -> Optional[ButtonPayload]:
+        key, consumed_key, index = _split_button_id(button_id)
+        with self._consume_lock:
+            group = self._cache.get(key)
+            if group is None or index not in group["buttons"]:
+                if consumed_key in self._consumed:
+                    raise ButtonAlreadyConsumedError(button_id)
+                return None
+            del self._cache[key]
+            self._consumed.add(consumed_key)
+        button = group["buttons"][index]
+        return ButtonPayload(dict(group[BUTTON_GROUP_PAYLOAD_FIELD], **button["extra"]), button["intent"])
+
+    def claim_group_button(self, button_id: str) -> bool:
+        return self.consume_group_button(button_id) is not None
+
+    def consume(self, key: str) -> Optional[dict]:
+        with self._consume_lock:
+            data = self._cache.pop(key, None)
+            if data is None:
+                if BUTTON_CONSUMED_KEY.format(key) in self._consumed:
+                    raise ButtonAlreadyConsumedError(key)
+                return None
+            self._consumed.add(BUTTON_CONSUMED_KEY.format(key))
+        return data
+
+    def mark_consumed(self, consumed_id: str, ttl: int = BUTTON_CONSUMED_TTL) -> bool:
+        with self._consume_lock:
+            if BUTTON_CONSUMED_KEY.format(consumed_id) in self._consumed:
+                return False
+            self._consumed.add(BUTTON_CONSUMED_KEY.format(consumed_id))
+            return True
+
+
+class NearCache:
+    """
+    In process LRU cache placed in front of the bot cache.
+
+    The entries written by the bot are kept in memory, bounded in number and in time, and the reads are served from
+    memory before going to Redis. The entries are copied when stored and when read, so that changing a value does not
+    change the cached one. Button groups consumed while in memory are only claimed in Redis, without reading
+    their payload again, so that a button is still consumed once among all the replicas. The keys written, removed or
+    consumed are broadcast over Redis pub/sub, so that the other replicas drop their copies. Without a Redis client the
+    invalidations are not broadcast.
+
+    Attributes:
+        - backend: the cache the near cache is in front of
+        - max_size: the maximum number of entries kept in memory, the least recently used are evicted
+        - ttl_sec: the maximum time an entry is kept in memory
+        - channel: the Redis pub/sub channel of the invalidations
+        - stats_log_interval: the statistics are logged every this number of lookups, 0 to disable
+    """
+    CHANNEL = "bot-cache-invalidation"
+
+    def __init__(self, backend: Union[BotCache, InMemoryBotCache], r=None, max_size: int = 10000, ttl_sec: float = 60,
+                 channel: str = CHANNEL, now: Callable[[], float] = time.monotonic, stats_log_interval: int = 0) -> None:
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.channel = channel
+        self.stats_log_interval = stats_log_interval
+        self._r = r
+        self._now = now
+        self._origin = uuid.uuid4().hex
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+        self._stopped = Event()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _get_local(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._now():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                data = None
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                data = entry[1]
+            should_log = self._stats_due()
+        if should_log:
+            self.log_stats()
+        if data is None:
+            return None
+        # the entries are shared by the threads, the callers get their own copy as when reading from Redis
+        return copy.deepcopy(data)
+
+    def _pop_local(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self._now():
+                self.misses += 1
+                entry = None
+            else:
+                self.hits += 1
+            should_log = self._stats_due()
+        if should_log:
+            self.log_stats()
+        return entry[1] if entry is not None else None
+
+    def _stats_due(self) -> bool:
+        """
+        The caller must hold the lock
+        """
+        return self.stats_log_interval > 0 and (self.hits + self.misses) % self.stats_log_interval == 0
+
+    def _put_local(self, key: str, data: dict) -> None:
+        with self._lock:
+            self._entries[key] = (self._now() + self.ttl_sec, copy.deepcopy(data))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _invalidate(self, keys: List[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        self._broadcast(keys)
+
+    def _broadcast(self, keys: List[str]) -> None:
+        if self._r is not None:
+            try:
+                self._r.publish(self.channel, json.dumps({"origin": self._origin, "keys": keys}))
+            except Exception as e:
+                logger.warning(f"Unable to broadcast the invalidation of the keys {keys}", exc_info=e)
+
+    def get(self, key: str) -> Optional[dict]:
+        data = self._get_local(key)
+        if data is None:
+            data = self.backend.get(key)
+            if data is not None:
+                self._put_local(key, data)
+        return data
+
+    def cache(self, data: dict, ttl: int = 604800, key: Optional[str] = None) -> str:
+        broadcast = key is not None
+        key = self.backend.cache(data, ttl=ttl, key=key)
+        self._put_local(key, data)
+        if broadcast:
+            self._broadcast([key])
+        return key
+
+    def cache_many(self, entries: Dict[str, dict], ttl: int = 604800) -> None:
+        if not entries:
+            return
+        self.backend.cache_many(entries, ttl=ttl)
+        for key, data in entries.items():
+            self._put_local(key, data)
+        self._broadcast(list(entries.keys()))
+
+    def cache_button_group(self, payload: dict, buttons: List[ButtonPayload], ttl: int = 604800) -> List[str]:
+        button_ids = self.backend.cache_button_group(payload, buttons, ttl=ttl)
+        key, _, _ = _split_button_id(button_ids[0])
+        self._put_local(key, {
+            BUTTON_GROUP_PAYLOAD_FIELD: dict(payload),
+            "buttons": {str(i): {"intent": button.intent, "extra": dict(button.payload)} for i, button in enumerate(buttons)}
+        })
+        return button_ids
+
+    def consume_group_button(self, button_id: str) -> Optional[ButtonPayload]:
+        key, _, index = _split_button_id(button_id)
+        group = self._pop_local(key)
+        try:
+            if group is None or index not in group["buttons"]:
+                return self.backend.consume_group_button(button_id)
+            if not self.backend.claim_group_button(button_id):
+                return None
+            button = group["buttons"][index]
+            return ButtonPayload(dict(group[BUTTON_GROUP_PAYLOAD_FIELD], **button["extra"]), button["intent"])
+        finally:
+            self._invalidate([key])
+
+    def consume(self, key: str) -> Optional[dict]:
+        try:
+            return self.backend.consume(key)
+        finally:
+            self._invalidate([key])
+
+    def mark_consumed(self, consumed_id: str, ttl: int = BUTTON_CONSUMED_TTL) -> bool:
+        return self.backend.mark_consumed(consumed_id, ttl=ttl)
+
+    def remove(self, key: str) -> None:
+        self.backend.remove(key)
+        self._invalidate([key])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def log_stats(self) -> None:
+        logger.info(f"Near cache statistics: {self.stats()}")
+
+    def on_invalidation(self, message) -> None:
+        """
+        Drop the keys invalidated by another replica
+        """
+        raw = json.loads(message)
+        if raw["origin"] == self._origin:
+            return
+        with self._lock:
+            for key in raw["keys"]:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def start(self) -> NearCache:
+        """
+        Start a thread receiving the invalidations broadcast by the other replicas
+        """
+        if self._r is None or self._thread is not None:
+            return self
+        self._stopped.clear()
+        pubsub = self._r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        self._thread = Thread(target=self._run, args=(pubsub,), name="near-cache-invalidation", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, pubsub) -> None:
+        try:
+            while not self._stopped.is_set():
+                try:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message.get("type") == "message":
+                        self.on_invalidation(message["data"])
+                except Exception as e:
+                    logger.exception("Unable to handle an invalidation of the near cache", exc_info=e)
+                    self._stopped.wait(1.0)
+        finally:
+            pubsub.close()
+
+    @staticmethod
+    def build_from_env(backend: BotCache) -> NearCache:
+        """
+        Build the near cache using environment variables.
+
+        Required environment variables are:
+          - REDIS_HOST - default to 'localhost'
+          - REDIS_PORT - default to '6379'
+          - REDIS_DB - default to '0'
+
+        Optional environment variables are:
+          - NEAR_CACHE_SIZE - default to '0'
+          - NEAR_CACHE_TTL - default to '60'
+          - NEAR_CACHE_STATS_INTERVAL - default to '1000'
+
+        :return: the near cache, not yet started
+        """
+        return NearCache(
+            backend,
+            r=BotCache._build_redis_from_env(),
+            max_size=int(os.getenv("NEAR_CACHE_SIZE", 0)),
+            ttl_sec=float(os.getenv("NEAR_CACHE_TTL", 60)),
+            stats_log_interval=int(os.getenv("NEAR_CACHE_STATS_INTERVAL", 1000))
+        )
@@ -0,0 +1,97 @@
+from __future__ import absolute_import, annotations
+
+import abc
+import json
+import os
+import threading
+from typing import Optional, Union
+
+import msgpack
+import zstandard
+
+
+class CacheCodec(abc.ABC):
+    """
+    Serialization of the values stored by the bot cache
+    """
+
+    @abc.abstractmethod
+    def encode(self, data: dict) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, raw: Union[bytes, str]) -> dict:
+        pass
+
+
+class JsonCodec(CacheCodec):
+    """
+    The JSON serialization used by the previous versions, readable by all the replicas
+    """
+
+    def encode(self, data: dict) -> bytes:
+        return json.dumps(data).encode("utf-8")
+
+    def decode(self, raw: Union[bytes, str]) -> dict:
+        return json.loads(raw)
+
+
+class MsgpackCodec(CacheCodec):
+    """
+    Compact binary serialization of the values: msgpack, compressed with zstd when larger than a threshold.
+
+    The encoded values start with a version byte telling their format. Values without it are the JSON ones stored by
+    the previous versions, and they are read transparently: a JSON object always starts with a character that is not a
+    version byte.
+
+    Attributes:
+        - zstd_threshold: the size, in bytes, above which the values are compressed, None to never compress them
+        - zstd_level: the level of the zstd compression
+    """
+    VERSION_MSGPACK = 1
+    VERSION_MSGPACK_ZSTD = 2
+
+    def __init__(self, zstd_threshold: Optional[int] = 512, zstd_level: int = 3) -> None:
+        self.zstd_threshold = zstd_threshold
+        self.zstd_level = zstd_level
+        # the zstd contexts cannot be used by several threads at once
+        self._local = threading.local()
+
+    def _compressor(self) -> zstandard.ZstdCompressor:
+        if not hasattr(self._local, "compressor"):
+            self._local.compressor = zstandard.ZstdCompressor(level=self.zstd_level)
+            self._local.decompressor = zstandard.ZstdDecompressor()
+        return self._local.compressor
+
+    def _decompressor(self) -> zstandard.ZstdDecompressor:
+        self._compressor()
+        return self._local.decompressor
+
+    def encode(self, data: dict) -> bytes:
+        packed = msgpack.packb(data, use_bin_type=True)
+        if self.zstd_threshold is not None and len(packed) > self.zstd_threshold:
+            return bytes([self.VERSION_MSGPACK_ZSTD]) + self._compressor().compress(packed)
+        return bytes([self.VERSION_MSGPACK]) + packed
+
+    def decode(self, raw: Union[bytes, str]) -> dict:
+        if isinstance(raw, str) or not raw or raw[0] not in (self.VERSION_MSGPACK, self.VERSION_MSGPACK_ZSTD):
+            return json.loads(raw)
+        if raw[0] == self.VERSION_MSGPACK_ZSTD:
+            return msgpack.unpackb(self._decompressor().decompress(raw[1:]), raw=False)
+        return msgpack.unpackb(raw[1:], raw=False)
+
+
+def build_codec_from_env() -> CacheCodec:
+    """
+    Build the codec of the bot cache using environment variables.
+
+    Optional environment variables are:
+      - BOT_CACHE_CODEC - default to 'msgpack', 'json' to write the values readable by the previous versions
+      - BOT_CACHE_ZSTD_THRESHOLD - default to '512', '0' to disable the compression
+
+    :return: the codec
+    """
+    if os.getenv("BOT_CACHE_CODEC", "msgpack") == "json":
+        return JsonCodec()
+    zstd_threshold = int(os.getenv("BOT_CACHE_ZSTD_THRESHOLD", 512))
+    return MsgpackCodec(zstd_threshold=zstd_threshold if zstd_threshold > 0 else None)
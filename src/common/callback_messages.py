@@ -1,7 +1,72 @@
 from __future__ import absolute_import, annotations
+
+from typing import Callable, Dict, Optional, Tuple, Type
+
 from wenet.model.callback_message.message import Message
 
 
+class MessageBuilder:
+    """
+    Build the messages from WeNet using the parsers registered by the message classes.
+    A parser is registered for a label, or for a label together with the value of an attribute (the discriminator)
+    when the same label is used for different messages.
+    """
+    _parsers: Dict[str, Callable[[dict], Message]] = {}
+    _discriminated_parsers: Dict[str, Tuple[str, Dict[str, Callable[[dict], Message]]]] = {}
+    _classes: Dict[str, Type[Message]] = {Message.__name__: Message}
+
+    @staticmethod
+    def register(label: Optional[str] = None, discriminator: Optional[Tuple[str, str]] = None):
+        """
+        Class decorator registering the `from_repr` of the class as the parser of a label
+
+        :param label: the label of the messages, by default the `LABEL` of the class
+        :param discriminator: the name and the value of the attribute selecting the class among the ones sharing the label
+        """
+        def decorator(cls):
+            message_label = label if label is not None else cls.LABEL
+            if discriminator is None:
+                if message_label in MessageBuilder._parsers:
+                    raise ValueError(f"A parser is already registered for the label [{message_label}]")
+                MessageBuilder._parsers[message_label] = cls.from_repr
+            else:
+                attribute, value = discriminator
+                registered_attribute, parsers = MessageBuilder._discriminated_parsers.setdefault(message_label, (attribute, {}))
+                if registered_attribute != attribute or value in parsers:
+                    raise ValueError(f"Conflicting parser for the label [{message_label}] with [{attribute}] equal to [{value}]")
+                parsers[value] = cls.from_repr
+            MessageBuilder._classes[cls.__name__] = cls
+            return cls
+        return decorator
+
+    @staticmethod
+    def get_class(name: str) -> Optional[Type[Message]]:
+        """
+        Get a registered message class by its name
+        """
+        return MessageBuilder._classes.get(name)
+
+    @staticmethod
+    def build(raw_message: dict) -> Message:
+        """
+        It may raise ValueError or KeyError, to be caught where this method is used
+
+        :param raw_message: the raw message representation
+        :return Message: the message model
+        :raises ValueError KeyError:
+        """
+        message_label = raw_message["label"]
+        parser = MessageBuilder._parsers.get(message_label)
+        if parser is None and message_label in MessageBuilder._discriminated_parsers:
+            attribute, parsers = MessageBuilder._discriminated_parsers[message_label]
+            value = raw_message["attributes"].get(attribute)
+            parser = parsers.get(value) if isinstance(value, str) else None
+        if parser is None:
+            parser = Message.from_repr
+        return parser(raw_message)
+
+
+@MessageBuilder.register()
 class QuestionExpirationMessage(Message):
     """
     Message received when question is expired
@@ -50,6 +115,7 @@ class QuestionExpirationMessage(Message):
         return self.attributes["listOfTransactionIds"]
 
 
+@MessageBuilder.register()
 class TextualMessage(Message):
     """
     A simple textual message from WeNet to the user.
@@ -91,6 +157,7 @@ class TextualMessage(Message):
         )
 
 
+@MessageBuilder.register()
 class TaskProposalNotification(Message):
     """
     This notification is used in order to propose a user to volunteer to a newly created task
@@ -116,6 +183,7 @@ class TaskProposalNotification(Message):
         )
 
 
+@MessageBuilder.register()
 class TaskVolunteerNotification(Message):
     """
     This notification is used in order to notify the task creator that a new volunteer is proposing to participate
@@ -149,6 +217,7 @@ class TaskVolunteerNotification(Message):
         return self.attributes["volunteerId"]
 
 
+@MessageBuilder.register()
 class TaskSelectionNotification(Message):
     """
     This notification is used in order to notify the user who volunteered about the decision of the task creator.
@@ -186,6 +255,7 @@ class TaskSelectionNotification(Message):
         return self.attributes["outcome"]
 
 
+@MessageBuilder.register()
 class TaskConcludedNotification(Message):
     """
     This notification is used in order to notify task participants that a task has been completed, the outcome could be:
@@ -227,6 +297,8 @@ class TaskConcludedNotification(Message):
         return self.attributes["outcome"]
 
 
+@MessageBuilder.register("INCENTIVE", discriminator=("IncentiveType", "Message"))
+@MessageBuilder.register()
 class IncentiveMessage(Message):
     """
     This message is used to send an incentive to an user.
@@ -268,6 +340,8 @@ class IncentiveMessage(Message):
         return self.attributes["content"]
 
 
+@MessageBuilder.register("INCENTIVE", discriminator=("IncentiveType", "Badge"))
+@MessageBuilder.register()
 class IncentiveBadge(Message):
     """
     This message is used to send a badge to an user.
@@ -331,6 +405,7 @@ class IncentiveBadge(Message):
         return self.attributes["message"]
 
 
+@MessageBuilder.register()
 class QuestionToAnswerMessage(Message):
     """
     Message containing a new question to be answered.
@@ -373,6 +448,7 @@ class QuestionToAnswerMessage(Message):
         return self.attributes["userId"]
 
 
+@MessageBuilder.register()
 class AnsweredQuestionMessage(Message):
     """
     Message containing a new answer to a question.
@@ -423,6 +499,7 @@ class AnsweredQuestionMessage(Message):
         return self.attributes["userId"]
 
 
+@MessageBuilder.register()
 class AnsweredPickedMessage(Message):
     """
     Message received when an answer is picked as the best one.
@@ -462,49 +539,3 @@ class AnsweredPickedMessage(Message):
     @property
     def task_id(self) -> str:
         return self.attributes["taskId"]
-
-
-class MessageBuilder:
-
-    @staticmethod
-    def build(raw_message: dict) -> Message:
-        """
-        It may raise ValueError or KeyError, to be caught where this method is used
-
-        :param raw_message: the raw message representation
-        :return Message: the message model
-        :raises ValueError KeyError:
-        """
-        message_label = raw_message["label"]
-        if message_label == TextualMessage.LABEL:
-            message = TextualMessage.from_repr(raw_message)
-        elif message_label == TaskConcludedNotification.LABEL:
-            message = TaskConcludedNotification.from_repr(raw_message)
-        elif message_label == TaskVolunteerNotification.LABEL:
-            message = TaskVolunteerNotification.from_repr(raw_message)
-        elif message_label == TaskProposalNotification.LABEL:
-            message = TaskProposalNotification.from_repr(raw_message)
-        elif message_label == TaskSelectionNotification.LABEL:
-            message = TaskSelectionNotification.from_repr(raw_message)
-        elif message_label == IncentiveMessage.LABEL:
-            message = IncentiveMessage.from_repr(raw_message)
-        elif message_label == IncentiveBadge.LABEL:
-            message = IncentiveBadge.from_repr(raw_message)
-        elif message_label == QuestionExpirationMessage.LABEL:
-            message = QuestionExpirationMessage.from_repr(raw_message)
-        elif message_label == "INCENTIVE":
-            if "IncentiveType" in raw_message["attributes"] and raw_message["attributes"]["IncentiveType"] == "Message":
-                message = IncentiveMessage.from_repr(raw_message)
-            elif "IncentiveType" in raw_message["attributes"] and raw_message["attributes"]["IncentiveType"] == "Badge":
-                message = IncentiveBadge.from_repr(raw_message)
-            else:
-                message = Message.from_repr(raw_message)
-        elif message_label == QuestionToAnswerMessage.LABEL:
-            message = QuestionToAnswerMessage.from_repr(raw_message)
-        elif message_label == AnsweredQuestionMessage.LABEL:
-            message = AnsweredQuestionMessage.from_repr(raw_message)
-        elif message_label == AnsweredPickedMessage.LABEL:
-            return AnsweredPickedMessage.from_repr(raw_message)
-        else:
-            message = Message.from_repr(raw_message)
-        return message
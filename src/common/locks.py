@@ -0,0 +1,123 @@
+from __future__ import absolute_import, annotations
+
+import logging
+import os
+import time
+import zlib
+from contextlib import contextmanager
+from threading import Lock
+from typing import List, Iterator
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.locks")
+
+
+class StripeStats:
+    """
+    Statistics of a single stripe of a StripedLock
+    Attributes:
+        - acquisitions: the number of times the stripe has been acquired
+        - contentions: the number of acquisitions that had to wait because the stripe was already held
+        - wait_histogram: the number of acquisitions per wait time bucket, in milliseconds
+    """
+    # upper bounds (in milliseconds) of the wait time buckets, the last bucket collects everything above
+    WAIT_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+
+    def __init__(self) -> None:
+        self.acquisitions = 0
+        self.contentions = 0
+        self.wait_histogram = [0] * (len(self.WAIT_BUCKETS_MS) + 1)
+
+    def record(self, contended: bool, wait_ms: float) -> None:
+        self.acquisitions += 1
+        if contended:
+            self.contentions += 1
+        for i, bound in enumerate(self.WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                self.wait_histogram[i] += 1
+                return
+        self.wait_histogram[-1] += 1
+
+    def to_repr(self) -> dict:
+        buckets = [f"<={bound}ms" for bound in self.WAIT_BUCKETS_MS] + [f">{self.WAIT_BUCKETS_MS[-1]}ms"]
+        return {
+            "acquisitions": self.acquisitions,
+            "contentions": self.contentions,
+            "wait_histogram": dict(zip(buckets, self.wait_histogram)),
+        }
+
+
+class StripedLock:
+    """
+    A fixed set of locks (stripes), where each key is always mapped to the same stripe.
+    Operations on the same key are serialized, while operations on keys mapped to different stripes run in parallel.
+    Attributes:
+        - stripes: the number of locks
+        - stats_log_interval: the statistics of the stripes are logged every this number of acquisitions, 0 to disable
+    """
+
+    def __init__(self, stripes: int = 64, stats_log_interval: int = 0) -> None:
+        if stripes < 1:
+            raise ValueError(f"The number of stripes must be positive, got [{stripes}]")
+        self._locks: List[Lock] = [Lock() for _ in range(stripes)]
+        self._stats: List[StripeStats] = [StripeStats() for _ in range(stripes)]
+        self._stats_log_interval = stats_log_interval
+        self._acquisitions = 0
+        self._acquisitions_lock = Lock()
+
+    @property
+    def stripes(self) -> int:
+        return len(self._locks)
+
+    def stripe_for(self, key: str) -> int:
+        # crc32 is stable across processes, unlike the builtin hash of strings
+        return zlib.crc32(str(key).encode("utf-8")) % len(self._locks)
+
+    @contextmanager
+    def acquire(self, key: str) -> Iterator[None]:
+        """
+        Hold the stripe associated with the key for the duration of the with block
+        """
+        stripe = self.stripe_for(key)
+        lock = self._locks[stripe]
+        contended = not lock.acquire(blocking=False)
+        start = time.monotonic()
+        if contended:
+            lock.acquire()
+        wait_ms = (time.monotonic() - start) * 1000
+        # the stats of a stripe are only updated while holding it
+        self._stats[stripe].record(contended, wait_ms)
+        try:
+            yield
+        finally:
+            lock.release()
+        if self._stats_log_interval > 0:
+            with self._acquisitions_lock:
+                self._acquisitions += 1
+                should_log = self._acquisitions % self._stats_log_interval == 0
+            if should_log:
+                self.log_stats()
+
+    def stats(self) -> List[dict]:
+        return [stats.to_repr() for stats in self._stats]
+
+    def log_stats(self) -> None:
+        """
+        Log the statistics of the stripes that have been contended at least once
+        """
+        for stripe, stats in enumerate(self._stats):
+            if stats.contentions > 0:
+                logger.info(f"Stripe [{stripe}] statistics: {stats.to_repr()}")
+
+    @staticmethod
+    def build_from_env() -> StripedLock:
+        """
+        Build the striped lock using environment variables.
+
+        Optional environment variables are:
+          - MESSAGES_LOCK_STRIPES - default to '64'
+          - MESSAGES_LOCK_STATS_INTERVAL - default to '1000'
+
+        :return: the striped lock
+        """
+        return StripedLock(int(os.getenv("MESSAGES_LOCK_STRIPES", 64)), int(os.getenv("MESSAGES_LOCK_STATS_INTERVAL", 1000)))
@@ -0,0 +1,206 @@
+from __future__ import absolute_import, annotations
+
+import logging
+import os
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+from typing import Callable, Deque, List, Optional, Union
+
+from wenet.interface.exceptions import RefreshTokenExpiredError
+from wenet.interface.service_api import ServiceApiInterface
+from wenet.model.logging_message.message import RequestMessage, ResponseMessage, NotificationMessage
+
+from common.authentication_event import CreationError
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.log_shipper")
+
+LoggedMessage = Union[RequestMessage, ResponseMessage, NotificationMessage]
+
+
+class _LogItem:
+
+    def __init__(self, service_api: ServiceApiInterface, message: LoggedMessage) -> None:
+        self.service_api = service_api
+        self.message = message
+
+
+class LogShipper:
+    """
+    Ship the interaction logs to the service API in background, so that handlers only enqueue them.
+
+    Messages are kept in a bounded in-process queue (when it is full the oldest message is dropped) and drained in
+    batches by worker threads. Failed deliveries are retried with an exponential backoff.
+    With no workers, messages are sent synchronously by the thread calling `ship`.
+
+    Attributes:
+        - max_queue_size: the maximum number of messages waiting to be sent
+        - workers: the number of worker threads sending the messages
+        - batch_size: the maximum number of messages taken from the queue by a worker at once
+        - max_retries: the number of retries for a message before giving up
+        - backoff_sec: the waiting time before the first retry, doubled at every retry
+        - on_refresh_token_expired: called with the service API whose refresh token is no longer valid
+    """
+
+    def __init__(self, max_queue_size: int = 10000, workers: int = 2, batch_size: int = 50, max_retries: int = 3,
+                 backoff_sec: float = 0.5, on_refresh_token_expired: Optional[Callable[[ServiceApiInterface], None]] = None) -> None:
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.on_refresh_token_expired = on_refresh_token_expired
+        self._queue: Deque[_LogItem] = deque()
+        self._condition = Condition()
+        self._threads: List[Thread] = []
+        self._running = False
+        self._in_flight = 0
+        # counters
+        self._counters_lock = Lock()
+        self.enqueued = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self) -> LogShipper:
+        with self._condition:
+            if self._running or self.workers == 0:
+                return self
+            self._running = True
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name=f"log-shipper-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the workers after the queue has been drained
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def ship(self, service_api: ServiceApiInterface, message: LoggedMessage) -> None:
+        """
+        Enqueue a message to be logged using the given service API
+        """
+        item = _LogItem(service_api, message)
+        if not self._threads:
+            self._increment("enqueued")
+            self._send(item)
+            return
+
+        with self._condition:
+            if len(self._queue) >= self.max_queue_size:
+                self._queue.popleft()
+                self._increment("dropped")
+                logger.warning(f"The log queue is full, dropped the oldest message. Dropped so far [{self.dropped}]")
+            self._queue.append(item)
+            self._increment("enqueued")
+            self._condition.notify()
+
+    def flush(self, timeout: float = 10) -> bool:
+        """
+        Wait until all the enqueued messages have been handled
+        :return: True if the queue has been drained within the timeout, False otherwise
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._queue or self._in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+    def _increment(self, counter: str) -> None:
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue and self._running:
+                    self._condition.wait()
+                if not self._queue and not self._running:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._in_flight += len(batch)
+
+            for item in batch:
+                self._send(item)
+
+            with self._condition:
+                self._in_flight -= len(batch)
+                self._condition.notify_all()
+
+    def _send(self, item: _LogItem) -> None:
+        attempt = 0
+        while True:
+            try:
+                item.service_api.log_message(item.message)
+                self._increment("sent")
+                return
+            except RefreshTokenExpiredError:
+                logger.warning(f"Unable to log the message [{item.message.message_id}], the refresh token is no longer valid")
+                self._increment("failed")
+                if self.on_refresh_token_expired is not None:
+                    self.on_refresh_token_expired(item.service_api)
+                return
+            except TypeError as e:
+                logger.warning("Unsupported message to log", exc_info=e)
+                self._increment("failed")
+                return
+            except CreationError as e:
+                if e.http_status_code < 500 or attempt >= self.max_retries:
+                    logger.warning(f"Unable to send logs to the service API, it responded with code [{e.http_status_code}]")
+                    self._increment("failed")
+                    return
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    logger.warning(f"Unable to send logs to the service API after [{attempt + 1}] attempts", exc_info=e)
+                    self._increment("failed")
+                    return
+
+            time.sleep(self.backoff_sec * (2 ** attempt))
+            attempt += 1
+            self._increment("retried")
+
+    @staticmethod
+    def build_from_env(on_refresh_token_expired: Optional[Callable[[ServiceApiInterface], None]] = None) -> LogShipper:
+        """
+        Build the log shipper using environment variables.
+
+        Optional environment variables are:
+          - LOG_SHIPPER_QUEUE_SIZE - default to '10000'
+          - LOG_SHIPPER_WORKERS - default to '2', with '0' messages are sent synchronously
+          - LOG_SHIPPER_BATCH_SIZE - default to '50'
+          - LOG_SHIPPER_MAX_RETRIES - default to '3'
+          - LOG_SHIPPER_BACKOFF_SEC - default to '0.5'
+
+        :return: the log shipper, not yet started
+        """
+        return LogShipper(
+            max_queue_size=int(os.getenv("LOG_SHIPPER_QUEUE_SIZE", 10000)),
+            workers=int(os.getenv("LOG_SHIPPER_WORKERS", 2)),
+            batch_size=int(os.getenv("LOG_SHIPPER_BATCH_SIZE", 50)),
+            max_retries=int(os.getenv("LOG_SHIPPER_MAX_RETRIES", 3)),
+            backoff_sec=float(os.getenv("LOG_SHIPPER_BACKOFF_SEC", 0.5)),
+            on_refresh_token_expired=on_refresh_token_expired
+        )
@@ -0,0 +1,37 @@
+from __future__ import absolute_import, annotations
+
+from typing import List
+
+from wenet.model.callback_message.event import Event
+
+
+class MessageBatchEvent(Event):
+    """
+    Event carrying several messages from WeNet, already validated by the endpoint
+
+    Attributes:
+        - type: the type of event (only 'messageBatch' is available)
+        - messages: the raw representations of the messages
+    """
+    TYPE = "messageBatch"
+
+    def __init__(self, messages: List[dict]) -> None:
+        super().__init__(self.TYPE)
+        self.messages = messages
+
+    def __eq__(self, o: object) -> bool:
+        if not isinstance(o, MessageBatchEvent):
+            return False
+        return self.messages == o.messages and self.event_type == o.event_type
+
+    def to_repr(self) -> dict:
+        return {
+            "type": self.event_type,
+            "messages": self.messages,
+        }
+
+    @staticmethod
+    def from_repr(raw: dict) -> MessageBatchEvent:
+        return MessageBatchEvent(
+            list(raw["messages"])
+        )
@@ -0,0 +1,54 @@
+from __future__ import absolute_import, annotations
+
+from typing import Optional
+
+from wenet.model.callback_message.message import Message
+
+from common.callback_messages import MessageBuilder
+
+
+class MessageEnvelope:
+    """
+    Representation of a message already validated by the endpoint, forwarded to the bot.
+
+    It is the representation of the message with an additional `envelope` section containing the version of the
+    format and the class resolved by the endpoint, so that the bot builds the message without parsing it again.
+    Since it is still a valid message representation, bots that do not know the envelope parse it as usual.
+    """
+    KEY = "envelope"
+    VERSION = 1
+
+    @staticmethod
+    def to_repr(message: Message) -> dict:
+        raw = message.to_repr()
+        raw[MessageEnvelope.KEY] = {
+            "version": MessageEnvelope.VERSION,
+            "class": type(message).__name__,
+        }
+        return raw
+
+    @staticmethod
+    def from_repr(raw: dict) -> Optional[Message]:
+        """
+        Build the message carried by an envelope, without validating it again
+        :return: the message, None if the representation is not an envelope that can be read by this version
+        """
+        envelope = raw.get(MessageEnvelope.KEY)
+        if not isinstance(envelope, dict) or envelope.get("version") != MessageEnvelope.VERSION:
+            return None
+        cls = MessageBuilder.get_class(envelope.get("class"))
+        if cls is None:
+            return None
+        # the attributes have already been normalized by the constructor of the class on the endpoint side
+        message = cls.__new__(cls)
+        Message.__init__(message, raw["appId"], raw["receiverId"], raw["label"], raw["attributes"])
+        return message
+
+    @staticmethod
+    def build(raw: dict) -> Message:
+        """
+        Build the message from an envelope, or parse it when it is not possible (e.g. it comes from an older endpoint)
+        :raises ValueError KeyError:
+        """
+        message = MessageEnvelope.from_repr(raw)
+        return message if message is not None else MessageBuilder.build(raw)
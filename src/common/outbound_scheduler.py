@@ -0,0 +1,375 @@
+from __future__ import absolute_import, annotations
+
+import heapq
+import itertools
+import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from chatbot_core.v3.model.outgoing_event import NotificationEvent
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.outbound_scheduler")
+
+
+class OutboundQueueFullError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket allowing `rate` operations per second on average and bursts of up to `capacity` operations.
+
+    The bucket is not thread safe.
+    """
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        :return: the seconds to wait before a token is available, 0 if it is available now
+        """
+        self._refill(now)
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+
+def retry_after_of(error: Exception) -> Optional[float]:
+    """
+    :return: the seconds to wait before retrying, if the error is a Telegram "Too Many Requests" (429) response
+    """
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return float(retry_after)
+    response = getattr(error, "response", None)
+    if response is not None and getattr(response, "status_code", None) == 429:
+        try:
+            return float(response.json()["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return 1.0
+    # e.g. "Too Many Requests: retry after 5", the description of the error returned by Telegram
+    match = re.search(r"retry[ _]after\D{0,3}(\d+(\.\d+)?)", str(error), re.IGNORECASE)
+    return float(match.group(1)) if match is not None else None
+
+
+class _Outbound:
+
+    def __init__(self, notification: NotificationEvent, priority: int, seq: int, enqueued_at: float) -> None:
+        self.notification = notification
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+        self.future: Future = Future()
+
+
+class OutboundScheduler:
+    """
+    Scheduler of the notifications sent to Telegram, keeping them within the rate limits of the Bot API.
+
+    A global token bucket limits the messages of the bot, and a token bucket for each chat limits the messages sent to
+    the same chat. The chats with queued notifications are served by priority class (e.g. the replies to an action of
+    a user before the batches of reminders), and the notifications of the same chat are sent in order, one at a time.
+    When Telegram responds with "Too Many Requests", all the sends are paused for the `retry_after` returned by
+    Telegram, and the notification is sent again.
+
+    The replies returned to the user by the handlers are sent directly by the chatbot framework, so the global rate
+    should be kept below the limit of Telegram to leave room for them.
+    With no workers, notifications are sent by the thread calling `submit`, waiting for the rate limits.
+
+    Attributes:
+        - global_rate: the messages per second sent by the bot
+        - global_burst: the maximum burst of messages sent by the bot
+        - chat_rate: the messages per second sent to the same chat
+        - chat_burst: the maximum burst of messages sent to the same chat
+        - max_retries: the number of retries of a notification throttled by Telegram before giving up
+        - max_queue_size: the maximum number of notifications waiting to be sent
+        - workers: the number of threads sending the notifications
+        - stats_log_interval: the statistics are logged every this number of sent or failed notifications, 0 to disable
+    """
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_NOTIFICATION = 1
+    PRIORITY_BATCH = 2
+    PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_NOTIFICATION: "notification", PRIORITY_BATCH: "batch"}
+
+    def __init__(self, send: Callable[[NotificationEvent], None], global_rate: float = 25, global_burst: float = 25,
+                 chat_rate: float = 1, chat_burst: float = 3, max_retries: int = 3, max_queue_size: int = 10000,
+                 workers: int = 4, stats_log_interval: int = 0) -> None:
+        self._send = send
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self.stats_log_interval = stats_log_interval
+        self._condition = Condition()
+        self._seq = itertools.count()
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._chat_buckets: Dict[str, TokenBucket] = {}
+        # the queued notifications of each chat, a chat is either ready, delayed or in flight
+        self._chats: Dict[str, Deque[_Outbound]] = {}
+        self._ready: List[Tuple[int, int, str]] = []
+        self._delayed: List[Tuple[float, int, str]] = []
+        self._in_flight: Dict[str, _Outbound] = {}
+        self._paused_until = 0.0
+        self._threads: List[Thread] = []
+        self._running = False
+        # metrics
+        self.queued_by_priority: Dict[int, int] = {priority: 0 for priority in self.PRIORITY_NAMES}
+        self.sent = 0
+        self.throttled = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_wait_sec = 0.0
+
+    def start(self) -> OutboundScheduler:
+        with self._condition:
+            if self._running or self.workers == 0:
+                return self
+            self._running = True
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name=f"outbound-scheduler-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the workers after the queued notifications have been sent
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, notification: NotificationEvent, priority: int = PRIORITY_NOTIFICATION) -> Future:
+        """
+        Enqueue a notification to be sent
+        :return: a future completed when the notification has been sent, or with the error preventing it
+        """
+        chat = self._chat_of(notification)
+        with self._condition:
+            outbound = _Outbound(notification, priority, next(self._seq), time.monotonic())
+            if not self._threads:
+                self._send_now(chat, outbound)
+                return outbound.future
+
+            if self.queue_depth() >= self.max_queue_size:
+                self.rejected += 1
+                logger.warning(f"The outbound queue is full, unable to send the notification to the chat [{chat}]. Rejected so far [{self.rejected}]")
+                outbound.future.set_exception(OutboundQueueFullError(f"The outbound queue is full, [{self.max_queue_size}] notifications are waiting"))
+                return outbound.future
+
+            self.queued_by_priority[priority] = self.queued_by_priority.get(priority, 0) + 1
+            if chat in self._chats:
+                self._chats[chat].append(outbound)
+            else:
+                self._chats[chat] = deque([outbound])
+                heapq.heappush(self._ready, (outbound.priority, outbound.seq, chat))
+            self._condition.notify()
+        return outbound.future
+
+    def queue_depth(self) -> int:
+        return sum(self.queued_by_priority.values())
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "queued": self.queue_depth(),
+                "queued_by_priority": {self.PRIORITY_NAMES.get(priority, str(priority)): queued for priority, queued in self.queued_by_priority.items()},
+                "chats": len(self._chats),
+                "in_flight": len(self._in_flight),
+                "sent": self.sent,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "max_wait_sec": self.max_wait_sec,
+                "paused_sec": max(0.0, self._paused_until - time.monotonic()),
+            }
+
+    def log_stats(self) -> None:
+        logger.info(f"Outbound scheduler statistics: {self.stats()}")
+
+    @staticmethod
+    def _chat_of(notification: NotificationEvent) -> str:
+        return notification.social_details.unique_id() if notification.social_details is not None else ""
+
+    def _chat_bucket(self, chat: str, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat)
+        if bucket is None:
+            # forget the idle chats, their buckets are full anyway
+            if len(self._chat_buckets) >= self.max_queue_size:
+                for idle_chat in [c for c, b in self._chat_buckets.items() if c not in self._chats and b.is_full(now)]:
+                    del self._chat_buckets[idle_chat]
+            bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chat_buckets[chat] = bucket
+        return bucket
+
+    def _send_now(self, chat: str, outbound: _Outbound) -> None:
+        """
+        Send a notification in the calling thread, waiting for the rate limits. The caller must hold the condition.
+        """
+        while True:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self._global.wait_time(now), self._chat_bucket(chat, now).wait_time(now))
+            if wait > 0:
+                self._condition.wait(wait)
+                continue
+            self._global.take(now)
+            self._chat_bucket(chat, now).take(now)
+            if not self._attempt(chat, outbound):
+                return
+
+    def _next(self) -> Optional[Tuple[str, _Outbound]]:
+        """
+        Wait for a notification that can be sent within the rate limits. The caller must hold the condition.
+        :return: the chat and the notification, None if the scheduler has been stopped and the queue is empty
+        """
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat = heapq.heappop(self._delayed)
+                head = self._chats[chat][0]
+                heapq.heappush(self._ready, (head.priority, head.seq, chat))
+
+            if not self._ready:
+                if not self._running and not self._delayed and not self._in_flight:
+                    return None
+                self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
+
+            wait = max(self._paused_until - now, self._global.wait_time(now))
+            if wait > 0:
+                self._condition.wait(wait)
+                continue
+
+            _, _, chat = heapq.heappop(self._ready)
+            chat_wait = self._chat_bucket(chat, now).wait_time(now)
+            if chat_wait > 0:
+                heapq.heappush(self._delayed, (now + chat_wait, next(self._seq), chat))
+                continue
+
+            self._global.take(now)
+            self._chat_bucket(chat, now).take(now)
+            outbound = self._chats[chat].popleft()
+            self.queued_by_priority[outbound.priority] -= 1
+            self._in_flight[chat] = outbound
+            return chat, outbound
+
+    def _work(self) -> None:
+        with self._condition:
+            while True:
+                entry = self._next()
+                if entry is None:
+                    return
+                chat, outbound = entry
+                retry = self._attempt(chat, outbound)
+
+                del self._in_flight[chat]
+                if retry:
+                    self._chats[chat].appendleft(outbound)
+                    self.queued_by_priority[outbound.priority] += 1
+                if self._chats[chat]:
+                    head = self._chats[chat][0]
+                    heapq.heappush(self._ready, (head.priority, head.seq, chat))
+                else:
+                    del self._chats[chat]
+                self._condition.notify_all()
+
+    def _attempt(self, chat: str, outbound: _Outbound) -> bool:
+        """
+        Send a notification, releasing the condition held by the caller during the send
+        :return: True if the notification has been throttled by Telegram and it should be sent again
+        """
+        outbound.attempts += 1
+        self._condition.release()
+        error = None
+        try:
+            self._send(outbound.notification)
+        except Exception as e:
+            error = e
+        finally:
+            self._condition.acquire()
+
+        now = time.monotonic()
+        if error is None:
+            self.sent += 1
+            self.max_wait_sec = max(self.max_wait_sec, now - outbound.enqueued_at)
+            outbound.future.set_result(None)
+            self._log_stats_if_due()
+            return False
+
+        retry_after = retry_after_of(error)
+        if retry_after is not None:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, now + retry_after)
+            if outbound.attempts <= self.max_retries:
+                logger.warning(f"Throttled by Telegram sending to the chat [{chat}], pausing the sends for [{retry_after}] seconds")
+                return True
+
+        self.failed += 1
+        logger.warning(f"Unable to send the notification to the chat [{chat}] after [{outbound.attempts}] attempts", exc_info=error)
+        outbound.future.set_exception(error)
+        self._log_stats_if_due()
+        return False
+
+    def _log_stats_if_due(self) -> None:
+        """
+        Log the statistics every `stats_log_interval` sent or failed notifications. The caller must hold the condition.
+        """
+        if self.stats_log_interval > 0 and (self.sent + self.failed) % self.stats_log_interval == 0:
+            self.log_stats()
+
+    @staticmethod
+    def build_from_env(send: Callable[[NotificationEvent], None]) -> OutboundScheduler:
+        """
+        Build the scheduler using environment variables.
+
+        Optional environment variables are:
+          - OUTBOUND_GLOBAL_RATE - default to '25', messages per second of the bot
+          - OUTBOUND_GLOBAL_BURST - default to '25'
+          - OUTBOUND_CHAT_RATE - default to '1', messages per second to the same chat
+          - OUTBOUND_CHAT_BURST - default to '3'
+          - OUTBOUND_MAX_RETRIES - default to '3'
+          - OUTBOUND_QUEUE_SIZE - default to '10000'
+          - OUTBOUND_WORKERS - default to '4', with '0' notifications are sent synchronously
+          - OUTBOUND_STATS_INTERVAL - default to '1000'
+
+        :return: the scheduler, not yet started
+        """
+        return OutboundScheduler(
+            send,
+            global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", 25)),
+            global_burst=float(os.getenv("OUTBOUND_GLOBAL_BURST", 25)),
+            chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", 1)),
+            chat_burst=float(os.getenv("OUTBOUND_CHAT_BURST", 3)),
+            max_retries=int(os.getenv("OUTBOUND_MAX_RETRIES", 3)),
+            max_queue_size=int(os.getenv("OUTBOUND_QUEUE_SIZE", 10000)),
+            workers=int(os.getenv("OUTBOUND_WORKERS", 4)),
+            stats_log_interval=int(os.getenv("OUTBOUND_STATS_INTERVAL", 1000))
+        )
@@ -0,0 +1,156 @@
+from __future__ import absolute_import, annotations
+
+import logging
+import os
+import functools
+import time
+from collections import OrderedDict
+from threading import Lock, RLock
+from typing import Dict, Tuple
+
+from wenet.interface.client import Oauth2Client
+from wenet.interface.service_api import ServiceApiInterface
+from wenet.storage.cache import BaseCache
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.service_api_pool")
+
+
+class SerializedServiceApi:
+    """
+    Service API connector whose calls are serialized, so that it can be shared by several threads.
+
+    The OAuth2 client of the connector refreshes its token when it expires, and the refresh token is rotated at each
+    refresh: two threads refreshing it at once would make one of them fail with `RefreshTokenExpiredError`, forcing
+    the user to log in again. The connector is not thread-safe, so each call holds the lock of the connector.
+
+    Attributes:
+        - service_api: the wrapped connector
+    """
+
+    def __init__(self, service_api: ServiceApiInterface) -> None:
+        self.service_api = service_api
+        # reentrant, in case a method of the connector calls another one
+        self._lock = RLock()
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.service_api, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def serialized(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return serialized
+
+
+class ServiceApiPool:
+    """
+    Pool of the service API connectors of the users, so that the OAuth2 client of a user, together with its token and
+    its HTTP connections, is reused among the messages instead of being created for each of them.
+
+    Connectors are identified by the unique ID of the social details of the user. The least recently used connector is
+    evicted when the pool is full, and connectors not used for `idle_ttl_sec` are created again. A connector must be
+    invalidated when its refresh token is no longer valid or the user logs in again, so that the new token is read
+    from the OAuth cache.
+
+    The connectors are shared by the threads handling the messages and the ones working in background (e.g. the log
+    shipper and the pending messages job), so their calls are serialized by a `SerializedServiceApi`.
+
+    Attributes:
+        - max_size: the maximum number of connectors kept in the pool
+        - idle_ttl_sec: the time after which a connector not used is discarded
+    """
+
+    def __init__(self, app_id: str, client_secret: str, oauth_cache: BaseCache, wenet_authentication_management_url: str,
+                 wenet_instance_url: str, max_size: int = 1000, idle_ttl_sec: float = 600) -> None:
+        self.app_id = app_id
+        self.client_secret = client_secret
+        self.oauth_cache = oauth_cache
+        self.wenet_authentication_management_url = wenet_authentication_management_url
+        self.wenet_instance_url = wenet_instance_url
+        self.max_size = max_size
+        self.idle_ttl_sec = idle_ttl_sec
+        self._connectors: OrderedDict[str, Tuple[SerializedServiceApi, float]] = OrderedDict()
+        self._lock = Lock()
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+    def get(self, resource_id: str) -> SerializedServiceApi:
+        """
+        Get the connector of a user, creating it if it is not in the pool or it has been idle for too long
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._connectors.get(resource_id)
+            if entry is not None and now - entry[1] < self.idle_ttl_sec:
+                self._connectors[resource_id] = (entry[0], now)
+                self._connectors.move_to_end(resource_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # the client is created outside the lock, since it may read the token from the cache
+        service_api = self._create(resource_id)
+        with self._lock:
+            self._connectors[resource_id] = (service_api, now)
+            self._connectors.move_to_end(resource_id)
+            while len(self._connectors) > self.max_size:
+                self._connectors.popitem(last=False)
+                self.evicted += 1
+        return service_api
+
+    def _create(self, resource_id: str) -> SerializedServiceApi:
+        oauth_client = Oauth2Client(self.app_id, self.client_secret, resource_id, self.oauth_cache, token_endpoint_url=self.wenet_authentication_management_url)
+        return SerializedServiceApi(ServiceApiInterface(oauth_client, self.wenet_instance_url))
+
+    def invalidate(self, resource_id: str) -> None:
+        """
+        Remove the connector of a user from the pool
+        """
+        with self._lock:
+            if self._connectors.pop(resource_id, None) is not None:
+                self.invalidated += 1
+
+    def discard(self, service_api: SerializedServiceApi) -> None:
+        """
+        Remove a connector from the pool, when the user it belongs to is not known (e.g. a failure in background)
+        """
+        with self._lock:
+            for resource_id, entry in self._connectors.items():
+                if entry[0] is service_api:
+                    del self._connectors[resource_id]
+                    self.invalidated += 1
+                    return
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._connectors),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "invalidated": self.invalidated,
+            }
+
+    @staticmethod
+    def build_from_env(app_id: str, client_secret: str, oauth_cache: BaseCache, wenet_authentication_management_url: str,
+                       wenet_instance_url: str) -> ServiceApiPool:
+        """
+        Build the pool using environment variables.
+
+        Optional environment variables are:
+          - SERVICE_API_POOL_SIZE - default to '1000'
+          - SERVICE_API_POOL_IDLE_TTL - default to '600'
+
+        :return: the pool
+        """
+        return ServiceApiPool(
+            app_id, client_secret, oauth_cache, wenet_authentication_management_url, wenet_instance_url,
+            max_size=int(os.getenv("SERVICE_API_POOL_SIZE", 1000)),
+            idle_ttl_sec=float(os.getenv("SERVICE_API_POOL_IDLE_TTL", 600))
+        )
@@ -0,0 +1,172 @@
+from __future__ import absolute_import, annotations
+
+import logging
+import math
+import os
+import time
+import uuid
+import zlib
+from typing import Dict, Optional, Set
+
+from wenet.storage.cache import RedisCache
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.shard_lease")
+
+
+class ShardLeaseManager:
+    """
+    Split the users in shards and share them among the replicas of the bot, so that the work on a user is done by a
+    single replica at a time.
+
+    Each replica holds a lease on some shards, that is a Redis key with a time to live. At every `refresh` the replica
+    renews its leases and balances them: the live replicas register themselves in a sorted set, and each of them
+    takes free shards up to its fair share and releases the ones above it. A lease that is not renewed expires, so
+    the shards of a stopped replica are taken by the others. Long works should `renew` the lease of a shard before
+    acting on one of its keys, so that the lease does not expire in the middle of the work. Without a Redis client all
+    the shards are owned.
+
+    Attributes:
+        - shards: the number of shards
+        - lease_ttl_sec: the time to live of the leases, it should be longer than the time between two refreshes
+        - owner_id: the identifier of the replica
+    """
+    LEASE_KEY = "{}-lease-{}"
+    REPLICAS_KEY = "{}-replicas"
+
+    # renew the lease only if it is still held by the owner
+    _RENEW = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    # release the lease only if it is still held by the owner
+    _RELEASE = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, name: str, r=None, shards: int = 16, lease_ttl_sec: float = 300, owner_id: Optional[str] = None) -> None:
+        self.name = name
+        self._r = r
+        self.shards = shards
+        self.lease_ttl_sec = lease_ttl_sec
+        self.owner_id = owner_id if owner_id is not None else str(uuid.uuid4())
+        self._renew = r.register_script(self._RENEW) if r is not None else None
+        self._release = r.register_script(self._RELEASE) if r is not None else None
+        self._owned: Set[int] = set(range(shards)) if r is None else set()
+        # the monotonic time of the last renewal of each owned shard
+        self._renewed_at: Dict[int, float] = {}
+
+    def shard_of(self, key: str) -> int:
+        # crc32 is stable across processes, unlike the builtin hash of strings
+        return zlib.crc32(key.encode("utf-8")) % self.shards
+
+    def owns(self, key: str) -> bool:
+        return self.shard_of(key) in self._owned
+
+    def owned_shards(self) -> Set[int]:
+        return set(self._owned)
+
+    def renew(self, key: str) -> bool:
+        """
+        Renew the lease of the shard of a key, if it was last renewed more than a quarter of the time to live ago
+        :return: True if the shard is still owned by the replica, False if its lease has been lost
+        """
+        shard = self.shard_of(key)
+        if shard not in self._owned:
+            return False
+        if self._r is None:
+            return True
+
+        now = time.monotonic()
+        if now - self._renewed_at.get(shard, 0.0) < self.lease_ttl_sec / 4:
+            return True
+        if self._renew(keys=[self._lease_key(shard)], args=[self.owner_id, int(self.lease_ttl_sec * 1000)]):
+            self._renewed_at[shard] = now
+            return True
+        logger.warning(f"Lost the lease on the shard [{shard}] of [{self.name}]")
+        self._owned.discard(shard)
+        return False
+
+    def refresh(self) -> Set[int]:
+        """
+        Renew the leases of the replica and take or release shards to get its fair share
+        :return: the shards owned by the replica
+        """
+        if self._r is None:
+            return self.owned_shards()
+
+        ttl_ms = int(self.lease_ttl_sec * 1000)
+        now = time.time()
+        replicas_key = self.REPLICAS_KEY.format(self.name)
+        self._r.zadd(replicas_key, {self.owner_id: now})
+        self._r.zremrangebyscore(replicas_key, "-inf", now - self.lease_ttl_sec)
+        fair_share = math.ceil(self.shards / max(1, self._r.zcard(replicas_key)))
+
+        owned = set()
+        for shard in sorted(self._owned):
+            renewed_at = time.monotonic()
+            if self._renew(keys=[self._lease_key(shard)], args=[self.owner_id, ttl_ms]):
+                owned.add(shard)
+                self._renewed_at[shard] = renewed_at
+            else:
+                logger.warning(f"Lost the lease on the shard [{shard}] of [{self.name}]")
+
+        # release the shards above the fair share, so that new replicas can take them
+        while len(owned) > fair_share:
+            shard = owned.pop()
+            self._release(keys=[self._lease_key(shard)], args=[self.owner_id])
+
+        # start from a different shard on each replica, to avoid contention on the same keys
+        first = self.shard_of(self.owner_id)
+        for i in range(self.shards):
+            if len(owned) >= fair_share:
+                break
+            shard = (first + i) % self.shards
+            renewed_at = time.monotonic()
+            if shard not in owned and self._r.set(self._lease_key(shard), self.owner_id, nx=True, px=ttl_ms):
+                owned.add(shard)
+                self._renewed_at[shard] = renewed_at
+
+        self._owned = owned
+        self._renewed_at = {shard: renewed_at for shard, renewed_at in self._renewed_at.items() if shard in owned}
+        return self.owned_shards()
+
+    def release_all(self) -> None:
+        if self._r is None:
+            return
+        for shard in self._owned:
+            self._release(keys=[self._lease_key(shard)], args=[self.owner_id])
+        self._r.zrem(self.REPLICAS_KEY.format(self.name), self.owner_id)
+        self._owned = set()
+        self._renewed_at = {}
+
+    def _lease_key(self, shard: int) -> str:
+        return self.LEASE_KEY.format(self.name, shard)
+
+    @staticmethod
+    def build_from_env(name: str) -> ShardLeaseManager:
+        """
+        Build the lease manager using environment variables.
+
+        Required environment variables are:
+          - REDIS_HOST - default to 'localhost'
+          - REDIS_PORT - default to '6379'
+          - REDIS_DB - default to '0'
+
+        Optional environment variables are:
+          - SHARD_LEASE_SHARDS - default to '16', it must be the same for all the replicas
+          - SHARD_LEASE_TTL - default to '300'
+
+        :return: the lease manager, owning no shards until the first refresh
+        """
+        return ShardLeaseManager(
+            name,
+            RedisCache._build_redis_from_env(),
+            shards=int(os.getenv("SHARD_LEASE_SHARDS", 16)),
+            lease_ttl_sec=float(os.getenv("SHARD_LEASE_TTL", 300))
+        )
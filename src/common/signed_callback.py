@@ -0,0 +1,201 @@
+from __future__ import absolute_import, annotations
+
+import base64
+import hashlib
+import hmac
+import os
+import re
+import struct
+import time
+from typing import Callable, Dict, List, Optional
+
+from common.button_payload import ButtonPayload
+
+
+SIGNED_BUTTON_MARKER = "."
+
+
+class InvalidCallbackDataError(Exception):
+    """
+    The callback data of a button is not a valid signed payload, e.g. it was altered by the client
+    """
+
+
+def is_signed_button(button_id: str) -> bool:
+    """
+    :return: if the payload of the button is signed in its callback data, instead of being stored in the cache
+    """
+    return button_id.startswith(SIGNED_BUTTON_MARKER)
+
+
+class SignedButton:
+    """
+    A button decoded from its signed callback data
+
+    Attributes:
+        - nonce: the identifier of the group of buttons, shared by the buttons invalidating each other
+        - button_payload: the payload of the button
+        - expires_at: the timestamp after which the button is expired
+    """
+
+    def __init__(self, nonce: str, button_payload: ButtonPayload, expires_at: float) -> None:
+        self.nonce = nonce
+        self.button_payload = button_payload
+        self.expires_at = expires_at
+
+
+class SignedCallbackCodec:
+    """
+    Codec packing small button payloads directly into the callback data of Telegram, which is at most 64 bytes, so
+    that the buttons do not need to be stored in the cache.
+
+    The payload is encoded with a compact binary layout: a byte with the version of the layout and the code of the
+    intent, the minute the button was created, a random nonce shared by the buttons of the same group, the values of
+    the fields of the intent and a truncated HMAC of all the previous bytes. The fields of each intent are fixed by a
+    schema, so that only their values are encoded, each one after a byte with its type and its length: hexadecimal
+    strings (e.g. the IDs of WeNet) take half of their length. The bytes are encoded in base85 after a marker. With
+    this layout, a button carrying two IDs of WeNet and a short text fits in the callback data; larger payloads cannot
+    be signed, and the buttons are stored in the cache instead.
+
+    The codes of the intents are their positions in the schemas, new intents must only be appended.
+
+    Attributes:
+        - schemas: the fields of the payload of each intent that can be signed
+        - ttl_sec: the time to live of the buttons
+        - max_length: the maximum length of the encoded button, without the prefix of the intent with payload
+    """
+    VERSION = 2
+    NONCE_SIZE = 4
+    SIGNATURE_SIZE = 8
+    # the minutes are counted from 2020-01-01, so that they fit in 3 bytes until 2051
+    EPOCH = 1577836800
+
+    _HEADER = struct.Struct(">B3s")
+    _NONE, _FALSE, _TRUE, _HEX, _TEXT = range(5)
+    # the type of a value is in the 3 high bits of its first byte, its length in the 5 low bits
+    _MAX_VALUE_LENGTH = 31
+    _MAX_INTENTS = 32
+    _HEX_PATTERN = re.compile(r"(?:[0-9a-f]{2})+")
+
+    def __init__(self, secret: bytes, schemas: Dict[str, List[str]], ttl_sec: int = 604800, max_length: int = 59,
+                 now: Callable[[], float] = time.time) -> None:
+        self.schemas = schemas
+        self.ttl_sec = ttl_sec
+        self.max_length = max_length
+        self._secret = secret
+        self._now = now
+        self._intents = list(schemas.keys())
+        if len(self._intents) > self._MAX_INTENTS:
+            raise ValueError(f"At most [{self._MAX_INTENTS}] intents can be signed, got [{len(self._intents)}]")
+
+    def _sign(self, data: bytes) -> bytes:
+        return hmac.new(self._secret, data, hashlib.sha256).digest()[:self.SIGNATURE_SIZE]
+
+    def _encode_value(self, value) -> Optional[bytes]:
+        if value is None:
+            return bytes([self._NONE << 5])
+        if isinstance(value, bool):
+            return bytes([(self._TRUE if value else self._FALSE) << 5])
+        if isinstance(value, str):
+            if self._HEX_PATTERN.fullmatch(value):
+                value_type, raw = self._HEX, bytes.fromhex(value)
+            else:
+                value_type, raw = self._TEXT, value.encode("utf-8")
+            if len(raw) > self._MAX_VALUE_LENGTH:
+                return None
+            return bytes([value_type << 5 | len(raw)]) + raw
+        return None
+
+    def _encode(self, button: ButtonPayload, nonce: bytes, issued_minute: int) -> Optional[str]:
+        fields = self.schemas.get(button.intent)
+        if fields is None or set(button.payload.keys()) - set(fields):
+            return None
+        data = bytearray(self._HEADER.pack(self.VERSION << 5 | self._intents.index(button.intent), issued_minute.to_bytes(3, "big")))
+        data += nonce
+        for field in fields:
+            value = self._encode_value(button.payload.get(field))
+            if value is None:
+                return None
+            data += value
+        data += self._sign(bytes(data))
+        button_id = SIGNED_BUTTON_MARKER + base64.b85encode(bytes(data)).decode("ascii")
+        return button_id if len(button_id) <= self.max_length else None
+
+    def encode(self, buttons: List[ButtonPayload]) -> Optional[List[str]]:
+        """
+        Encode a group of buttons, clicking one of them invalidates all the others
+
+        :return: the IDs of the buttons, holding their signed payloads, None if any of them cannot be signed because its intent has no schema or its payload is too large
+        """
+        nonce = os.urandom(self.NONCE_SIZE)
+        issued_minute = int((self._now() - self.EPOCH) // 60)
+        button_ids = []
+        for button in buttons:
+            button_id = self._encode(button, nonce, issued_minute)
+            if button_id is None:
+                return None
+            button_ids.append(button_id)
+        return button_ids
+
+    def decode(self, button_id: str) -> Optional[SignedButton]:
+        """
+        :return: the decoded button, None if it is expired
+        :raise InvalidCallbackDataError: if the button is not valid or its signature does not match
+        """
+        try:
+            data = base64.b85decode(button_id[len(SIGNED_BUTTON_MARKER):])
+        except ValueError as e:
+            raise InvalidCallbackDataError(f"The button [{button_id}] is not encoded in base85") from e
+        header_size = self._HEADER.size + self.NONCE_SIZE
+        if len(data) < header_size + self.SIGNATURE_SIZE:
+            raise InvalidCallbackDataError(f"The button [{button_id}] is too short")
+        body, signature = data[:-self.SIGNATURE_SIZE], data[-self.SIGNATURE_SIZE:]
+        if not hmac.compare_digest(self._sign(body), signature):
+            raise InvalidCallbackDataError(f"The signature of the button [{button_id}] does not match")
+        version_and_intent, raw_minute = self._HEADER.unpack_from(body)
+        version, intent_code = version_and_intent >> 5, version_and_intent & 0x1f
+        if version != self.VERSION or intent_code >= len(self._intents):
+            raise InvalidCallbackDataError(f"The button [{button_id}] has an unknown version [{version}] or intent [{intent_code}]")
+        issued_minute = int.from_bytes(raw_minute, "big")
+        nonce = body[self._HEADER.size:header_size]
+
+        intent = self._intents[intent_code]
+        payload = {}
+        position = header_size
+        try:
+            for field in self.schemas[intent]:
+                value_type, length = body[position] >> 5, body[position] & 0x1f
+                position += 1
+                if value_type in (self._HEX, self._TEXT):
+                    raw = body[position:position + length]
+                    if len(raw) != length:
+                        raise IndexError(position)
+                    position += length
+                    payload[field] = raw.hex() if value_type == self._HEX else raw.decode("utf-8")
+                else:
+                    payload[field] = None if value_type == self._NONE else value_type == self._TRUE
+        except (IndexError, UnicodeDecodeError) as e:
+            raise InvalidCallbackDataError(f"The payload of the button [{button_id}] is malformed") from e
+
+        expires_at = self.EPOCH + issued_minute * 60 + self.ttl_sec
+        if expires_at <= self._now():
+            return None
+        # the nonce is short, the minute makes it unique among the groups of buttons
+        return SignedButton(f"{issued_minute:x}-{nonce.hex()}", ButtonPayload(payload, intent), expires_at)
+
+    @staticmethod
+    def build_from_env(bot_token: str, schemas: Dict[str, List[str]], max_length: int) -> SignedCallbackCodec:
+        """
+        Build the codec using environment variables.
+
+        Optional environment variables are:
+          - CALLBACK_SIGNING_KEY - default to a key derived from the token of the bot
+
+        :return: the codec
+        """
+        secret = os.getenv("CALLBACK_SIGNING_KEY")
+        if secret:
+            key = secret.encode("utf-8")
+        else:
+            key = hashlib.sha256(f"signed-callback:{bot_token}".encode("utf-8")).digest()
+        return SignedCallbackCodec(key, schemas, max_length=max_length)
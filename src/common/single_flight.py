@@ -0,0 +1,67 @@
+from __future__ import absolute_import, annotations
+
+import threading
+from typing import Callable, Dict, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+
+class _Call:
+    """
+    A call in flight, shared by all the callers asking for the same key
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesce the concurrent calls for the same key: the first caller runs the function, while the others wait for it
+    and get its result (or its exception) instead of running it again.
+
+    Attributes:
+        - coalesced: the number of calls that waited for a call in flight instead of running the function
+    """
+
+    def __init__(self) -> None:
+        self.coalesced = 0
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, function: Callable[[], T]) -> T:
+        """
+        Run the function, unless a call for the same key is already in flight
+
+        :return: the result of the function, computed by this caller or by the one in flight
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,160 @@
+from __future__ import absolute_import, annotations
+
+import logging
+import os
+import random
+import time
+from threading import Lock
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.telegram_api")
+
+
+class TelegramApiError(Exception):
+
+    def __init__(self, method: str, error_code: int, description: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(f"Telegram API [{method}] responded with code [{error_code}]: {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class _EndpointMetrics:
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency_sec = 0.0
+        self.max_latency_sec = 0.0
+
+
+class TelegramApiClient:
+    """
+    Client of the Telegram Bot API for the calls made directly by the bots (e.g. `getMe` and `getChat`).
+
+    A single HTTP session is shared by all the calls, keeping the connections to Telegram alive in a pool instead of
+    opening a new TCP and TLS connection for each call. Calls failing for network errors, server errors or
+    "Too Many Requests" are retried with an exponential backoff with full jitter, waiting at least the `retry_after`
+    returned by Telegram. The latency of the calls is measured for each method of the API.
+
+    Attributes:
+        - token: the token of the bot
+        - base_url: the URL of the Bot API, it can point to a local server for testing
+        - timeout_sec: the connect and read timeout of each request
+        - max_retries: the number of retries of a failed call before giving up
+        - backoff_sec: the maximum waiting time before the first retry, doubled at every retry
+    """
+
+    def __init__(self, token: str, base_url: str = "https://api.telegram.org", session: Optional[requests.Session] = None,
+                 timeout_sec: float = 10, max_retries: int = 2, backoff_sec: float = 0.5, pool_size: int = 10) -> None:
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.timeout_sec = timeout_sec
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self._session = session
+        self._metrics: Dict[str, _EndpointMetrics] = {}
+        self._metrics_lock = Lock()
+
+    @property
+    def bot_url(self) -> str:
+        return f"{self.base_url}/bot{self.token}"
+
+    def call(self, method: str, params: Optional[dict] = None) -> dict:
+        """
+        Call a method of the Bot API
+        :return: the result of the call
+        :raise TelegramApiError: if Telegram responds with an error, after the retries
+        :raise requests.RequestException: if Telegram cannot be reached, after the retries
+        """
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = self._session.get(f"{self.bot_url}/{method}", params=params, timeout=self.timeout_sec)
+                body = response.json()
+                self._record(method, time.monotonic() - start, error=not body.get("ok", False))
+                if body.get("ok", False):
+                    return body["result"]
+                error = TelegramApiError(method, body.get("error_code", response.status_code), body.get("description", ""), body.get("parameters", {}).get("retry_after"))
+                if response.status_code != 429 and response.status_code < 500:
+                    raise error
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+                self._record(method, time.monotonic() - start, error=True)
+                error = e
+
+            if attempt >= self.max_retries:
+                logger.warning(f"Unable to call the Telegram API [{method}] after [{attempt + 1}] attempts")
+                raise error
+            wait = random.uniform(0, self.backoff_sec * (2 ** attempt))
+            if isinstance(error, TelegramApiError) and error.retry_after is not None:
+                wait = max(wait, error.retry_after)
+            time.sleep(wait)
+            attempt += 1
+            with self._metrics_lock:
+                self._metrics[method].retries += 1
+
+    def get_me(self) -> dict:
+        return self.call("getMe")
+
+    def get_chat(self, chat_id) -> dict:
+        return self.call("getChat", {"chat_id": chat_id})
+
+    def _record(self, method: str, latency_sec: float, error: bool) -> None:
+        with self._metrics_lock:
+            metrics = self._metrics.setdefault(method, _EndpointMetrics())
+            metrics.calls += 1
+            metrics.errors += 1 if error else 0
+            metrics.total_latency_sec += latency_sec
+            metrics.max_latency_sec = max(metrics.max_latency_sec, latency_sec)
+
+    def stats(self) -> dict:
+        """
+        :return: for each method of the API, the number of calls, errors and retries and the latency of the calls
+        """
+        with self._metrics_lock:
+            return {
+                method: {
+                    "calls": metrics.calls,
+                    "errors": metrics.errors,
+                    "retries": metrics.retries,
+                    "avg_latency_ms": 1000 * metrics.total_latency_sec / metrics.calls if metrics.calls else 0.0,
+                    "max_latency_ms": 1000 * metrics.max_latency_sec,
+                }
+                for method, metrics in self._metrics.items()
+            }
+
+    def close(self) -> None:
+        self._session.close()
+
+    @staticmethod
+    def build_from_env(token: str) -> TelegramApiClient:
+        """
+        Build the client using environment variables.
+
+        Optional environment variables are:
+          - TELEGRAM_API_URL - default to 'https://api.telegram.org'
+          - TELEGRAM_API_TIMEOUT - default to '10'
+          - TELEGRAM_API_MAX_RETRIES - default to '2'
+          - TELEGRAM_API_POOL_SIZE - default to '10'
+
+        :return: the client
+        """
+        return TelegramApiClient(
+            token,
+            base_url=os.getenv("TELEGRAM_API_URL", "https://api.telegram.org"),
+            timeout_sec=float(os.getenv("TELEGRAM_API_TIMEOUT", 10)),
+            max_retries=int(os.getenv("TELEGRAM_API_MAX_RETRIES", 2)),
+            pool_size=int(os.getenv("TELEGRAM_API_POOL_SIZE", 10))
+        )
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, annotations
+
+import math
+from typing import Any, List, Tuple
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel, keeping items until they are due.
+
+    Each level has `wheel_size` slots, a slot of the first level lasts one tick and a slot of the next levels lasts as
+    much as a whole turn of the previous one. Items are added to the level and slot of their due time in constant time,
+    and they are moved to the lower levels when the wheel reaches their slot, so that each item is moved at most
+    `levels` times. Items due after the range of the last level are kept aside and added again when it turns.
+
+    The wheel is not thread safe.
+
+    Attributes:
+        - tick_sec: the duration of a tick, items are returned at the end of the tick containing their due time
+        - wheel_size: the number of slots of each level
+        - levels: the number of levels
+    """
+
+    def __init__(self, start: float, tick_sec: float = 1, wheel_size: int = 64, levels: int = 4) -> None:
+        self.tick_sec = tick_sec
+        self.wheel_size = wheel_size
+        self.levels = levels
+        self._current_tick = math.floor(start / tick_sec)
+        self._slots: List[List[List[Tuple[float, Any]]]] = [[[] for _ in range(wheel_size)] for _ in range(levels)]
+        self._overflow: List[Tuple[float, Any]] = []
+        self._due: List[Tuple[float, Any]] = []
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _tick(self, timestamp: float) -> int:
+        return math.ceil(timestamp / self.tick_sec)
+
+    def add(self, due_at: float, item: Any) -> None:
+        self._size += 1
+        self._insert(due_at, item)
+
+    def _insert(self, due_at: float, item: Any) -> None:
+        delta = self._tick(due_at) - self._current_tick
+        if delta <= 0:
+            self._due.append((due_at, item))
+            return
+
+        span = self.wheel_size
+        for level in range(self.levels):
+            if delta < span:
+                slot = (self._tick(due_at) // (span // self.wheel_size)) % self.wheel_size
+                self._slots[level][slot].append((due_at, item))
+                return
+            span *= self.wheel_size
+        self._overflow.append((due_at, item))
+
+    def advance(self, now: float) -> List[Tuple[float, Any]]:
+        """
+        Move the wheel up to the given time
+        :return: the due items, with their due time
+        """
+        target = math.floor(now / self.tick_sec)
+        while self._current_tick < target:
+            self._current_tick += 1
+            # move down the items of the slots reached by the upper levels, starting from the highest one
+            if self._current_tick % (self.wheel_size ** self.levels) == 0:
+                overflow, self._overflow = self._overflow, []
+                for due_at, item in overflow:
+                    self._insert(due_at, item)
+            for level in range(self.levels - 1, 0, -1):
+                slot_ticks = self.wheel_size ** level
+                if self._current_tick % slot_ticks == 0:
+                    slot = (self._current_tick // slot_ticks) % self.wheel_size
+                    entries, self._slots[level][slot] = self._slots[level][slot], []
+                    for due_at, item in entries:
+                        self._insert(due_at, item)
+            slot = self._current_tick % self.wheel_size
+            self._due.extend(self._slots[0][slot])
+            self._slots[0][slot] = []
+
+        due, self._due = self._due, []
+        self._size -= len(due)
+        return due
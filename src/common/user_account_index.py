@@ -0,0 +1,146 @@
+from __future__ import absolute_import, annotations
+
+import argparse
+import logging
+import os
+from threading import Lock
+from typing import Optional
+
+from chatbot_core.model.details import SocialDetails
+from chatbot_core.model.user_context import UserConversationContext
+from wenet.storage.cache import BaseCache
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.user_account_index")
+
+
+class UserAccountIndex:
+    """
+    Index from the WeNet user ID to the social details of the user, so that the context of a user is fetched directly
+    instead of searching it among all the contexts.
+
+    Attributes:
+        - cache: the cache storing the index
+        - ttl: the time to live of each entry, in seconds
+        - wenet_user_id_key: the key of the static state of the context containing the WeNet user ID
+        - stats_log_interval: the statistics are logged every this number of lookups, 0 to disable
+    """
+    CACHE_KEY = "wenet-user-{}"
+
+    def __init__(self, cache: BaseCache, ttl: int = 2592000, wenet_user_id_key: str = "wenet_user_id", stats_log_interval: int = 0) -> None:
+        self.cache = cache
+        self.ttl = ttl
+        self.wenet_user_id_key = wenet_user_id_key
+        self.stats_log_interval = stats_log_interval
+        self._counters_lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, wenet_user_id: str) -> Optional[SocialDetails]:
+        """
+        Get the social details of a user, None if the user is not in the index
+        """
+        entry = self.cache.get(self.CACHE_KEY.format(wenet_user_id))
+        if entry is None or entry.get("version") != UserConversationContext.VERSION_V3:
+            return None
+        return SocialDetails.from_repr(entry["social_details"])
+
+    def update(self, user_context: UserConversationContext) -> None:
+        """
+        Add or update the entry of the user owning the context, if the context belongs to a WeNet user
+        """
+        if user_context.social_details is None or user_context.context is None:
+            return
+        wenet_user_id = user_context.context.get_static_state(self.wenet_user_id_key, None)
+        if wenet_user_id is None:
+            return
+        self.cache.cache({
+            "social_details": user_context.social_details.to_repr(),
+            "version": user_context.version,
+        }, ttl=self.ttl, key=self.CACHE_KEY.format(wenet_user_id))
+
+    def remove(self, wenet_user_id: str) -> None:
+        self.cache.remove(self.CACHE_KEY.format(wenet_user_id))
+
+    def record_hit(self) -> None:
+        self._increment("hits")
+        self._log_stats_if_due()
+
+    def record_miss(self) -> None:
+        self._increment("misses")
+        self._log_stats_if_due()
+
+    def record_stale(self) -> None:
+        """
+        Record an entry pointing to a context that no longer belongs to the user, it is also counted as a miss
+        """
+        self._increment("stale")
+        self._increment("misses")
+        self._log_stats_if_due()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+        }
+
+    def log_stats(self) -> None:
+        logger.info(f"User account index statistics: {self.stats()}")
+
+    def rebuild(self, interface_connector, instance_namespace: str, bot_id: Optional[str]) -> int:
+        """
+        Add to the index all the contexts of the bot belonging to a WeNet user
+        :return: the number of indexed contexts
+        """
+        indexed = 0
+        for user_context in interface_connector.get_user_contexts(instance_namespace, bot_id):
+            if user_context.context is not None and user_context.context.has_static_state(self.wenet_user_id_key):
+                self.update(user_context)
+                indexed += 1
+        logger.info(f"Indexed [{indexed}] user contexts")
+        return indexed
+
+    def _increment(self, counter: str) -> None:
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _log_stats_if_due(self) -> None:
+        if self.stats_log_interval <= 0:
+            return
+        with self._counters_lock:
+            should_log = (self.hits + self.misses) % self.stats_log_interval == 0
+        if should_log:
+            self.log_stats()
+
+    @staticmethod
+    def build_from_env(cache: BaseCache) -> UserAccountIndex:
+        """
+        Build the index using environment variables.
+
+        Optional environment variables are:
+          - USER_ACCOUNT_INDEX_TTL - default to '2592000' (30 days)
+          - USER_ACCOUNT_INDEX_STATS_INTERVAL - default to '1000'
+
+        :return: the index
+        """
+        return UserAccountIndex(
+            cache,
+            ttl=int(os.getenv("USER_ACCOUNT_INDEX_TTL", 2592000)),
+            stats_log_interval=int(os.getenv("USER_ACCOUNT_INDEX_STATS_INTERVAL", 1000))
+        )
+
+
+if __name__ == "__main__":
+    from chatbot_core.v3.connector.chatbot_interface import ChatbotInterfaceConnectorV3
+    from common.cache import BotCache
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Rebuild the index from WeNet user IDs to user contexts")
+    parser.add_argument("bot_id", help="the ID of the bot, e.g. wenet-ask-for-help")
+    args = parser.parse_args()
+
+    instance_namespace = os.getenv("INSTANCE_NAMESPACE")
+    connector = ChatbotInterfaceConnectorV3.build_from_env()
+    UserAccountIndex.build_from_env(BotCache.build_from_env()).rebuild(connector, instance_namespace, args.bot_id)
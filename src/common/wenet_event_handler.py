@@ -1,9 +1,9 @@
 import abc
+import atexit
 import logging
-from typing import Optional, List
-from threading import Lock
-
-import requests
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, List
 
 from chatbot_core.model.context import ConversationContext
 from chatbot_core.model.details import TelegramDetails
@@ -19,18 +19,24 @@ from chatbot_core.v3.logger.event_logger import LoggerConnector
 from chatbot_core.v3.model.actions import UrlButton
 from chatbot_core.v3.model.messages import RapidAnswerResponse, TextualResponse, TelegramTextualResponse
 from chatbot_core.v3.model.outgoing_event import OutgoingEvent, NotificationEvent
-from common.cache import BotCache
+from common.cache import BotCache, NearCache
+from common.locks import StripedLock
+from common.message_batch import MessageBatchEvent
+from common.log_shipper import LogShipper
+from common.outbound_scheduler import OutboundScheduler
+from common.service_api_pool import ServiceApiPool
+from common.telegram_api import TelegramApiClient, TelegramApiError
 from common.messages_to_log import LogMessageHandler
+from common.user_account_index import UserAccountIndex
 from uhopper.utils.alert.module import AlertModule
 from wenet.interface.client import Oauth2Client
 from wenet.interface.exceptions import NotFound, RefreshTokenExpiredError
-from common.authentication_event import CreationError
 from wenet.interface.service_api import ServiceApiInterface
 from common.authentication_event import WeNetAuthenticationEvent
 from common.callback_messages import TextualMessage
 from wenet.model.callback_message.message import Message
 from wenet.storage.cache import RedisCache
-from common.callback_messages import MessageBuilder
+from common.message_envelope import MessageEnvelope
 
 logger = logging.getLogger("uhopper.chatbot.wenet")
 
@@ -61,8 +67,6 @@ class WenetEventHandler(EventHandler, abc.ABC):
         - wenet_authentication_management_url
         - task_type_id: the type of the task used by the bot
     """
-    TELEGRAM_GET_ME_API = 'https://api.telegram.org/bot{}/getMe'
-
     PREVIOUS_INTENT = "previous_message_intent"
 
     # context keys
@@ -96,21 +100,27 @@ class WenetEventHandler(EventHandler, abc.ABC):
                  translator: Optional[Translator],
                  delay_between_messages_sec: Optional[int] = None,
                  delay_between_text_sec: Optional[float] = None,
-                 logger_connectors: Optional[List[LoggerConnector]] = None):
+                 logger_connectors: Optional[List[LoggerConnector]] = None,
+                 telegram_api_client: Optional[TelegramApiClient] = None):
         super().__init__(instance_namespace, bot_id, handler_id, alert_module, connector, nlp_handler, translator,
                          delay_between_messages_sec, delay_between_text_sec, logger_connectors)
 
         self.cache = BotCache.build_from_env()
+        if int(os.getenv("NEAR_CACHE_SIZE", 0)) > 0:
+            self.cache = NearCache.build_from_env(self.cache).start()
+        self.user_account_index = UserAccountIndex.build_from_env(self.cache)
         self.oauth_cache = RedisCache.build_from_env()
 
         self.telegram_id = telegram_id
+        self.telegram_api_client = telegram_api_client if telegram_api_client is not None else TelegramApiClient.build_from_env(self.telegram_id)
         # getting information about the bot
-        info = requests.get(self.TELEGRAM_GET_ME_API.format(self.telegram_id)).json()
-        if not info["ok"]:
-            logger.error("Not able to get bot's info, Telegram APIs returned: %s" % info["description"])
+        try:
+            info = self.telegram_api_client.get_me()
+        except TelegramApiError as e:
+            logger.error("Not able to get bot's info, Telegram APIs returned: %s" % e.description)
             raise Exception("Something went wrong with Telegram APIs")
-        self.bot_username = info["result"]["username"]
-        self.bot_name = info["result"]["first_name"]
+        self.bot_username = info["username"]
+        self.bot_name = info["first_name"]
 
         self.wenet_instance_url = wenet_instance_url
         self.wenet_hub_url = wenet_hub_url
@@ -122,8 +132,15 @@ class WenetEventHandler(EventHandler, abc.ABC):
         self.task_type_id = task_type_id
         self.community_id = community_id
         self.intent_manager = IntentManagerV3()
-        self.messages_lock = Lock()
+        self.messages_lock = StripedLock.build_from_env()
+        self.batch_workers = int(os.getenv("MESSAGES_BATCH_WORKERS", 8))
+        self._batch_executor = ThreadPoolExecutor(max_workers=self.batch_workers, thread_name_prefix="message-batch") if self.batch_workers > 1 else None
+        self.service_api_pool = ServiceApiPool.build_from_env(self.app_id, self.client_secret, self.oauth_cache, self.wenet_authentication_management_url, self.wenet_instance_url)
+        self.log_shipper = LogShipper.build_from_env(on_refresh_token_expired=self.service_api_pool.discard).start()
+        # the workers of the log shipper are daemon threads, the queued logs are sent before the process exits
+        atexit.register(self.stop_log_shipper, float(os.getenv("LOG_SHIPPER_SHUTDOWN_TIMEOUT", 10)))
         self.message_parser_for_logs = LogMessageHandler(self.app_id, "Telegram")
+        self.outbound_scheduler = OutboundScheduler.build_from_env(super().send_notification).start()
         # redirecting the flow in the corresponding points
         self.intent_manager.with_fulfiller(
             IntentFulfillerV3(self.INTENT_START, self.action_start).with_rule(intent=self.INTENT_START)
@@ -138,6 +155,14 @@ class WenetEventHandler(EventHandler, abc.ABC):
             IntentFulfillerV3(self.INTENT_INFO, self.action_info).with_rule(intent=self.INTENT_INFO)
         )
 
+    def stop_log_shipper(self, timeout: float) -> None:
+        """
+        Send the interaction logs still in the queue and stop the log shipper
+        """
+        if not self.log_shipper.flush(timeout):
+            logger.warning(f"Unable to send [{self.log_shipper.stats()['queued']}] interaction logs before shutting down")
+        self.log_shipper.stop(timeout)
+
     @abc.abstractmethod
     def action_start(self, incoming_event: IncomingSocialEvent, intent: str) -> OutgoingEvent:
         """
@@ -203,8 +228,7 @@ class WenetEventHandler(EventHandler, abc.ABC):
         return response
 
     def _get_service_connector_from_social_details(self, social_details: TelegramDetails) -> ServiceApiInterface:
-        oauth_client = Oauth2Client(self.app_id, self.client_secret, social_details.unique_id(), self.oauth_cache, token_endpoint_url=self.wenet_authentication_management_url)
-        return ServiceApiInterface(oauth_client, self.wenet_instance_url)
+        return self.service_api_pool.get(social_details.unique_id())
 
     def _get_service_api_interface_connector_from_context(self, context: ConversationContext) -> ServiceApiInterface:
         if not context.has_static_state(self.CONTEXT_TELEGRAM_USER_ID):
@@ -217,6 +241,18 @@ class WenetEventHandler(EventHandler, abc.ABC):
         return self._get_service_connector_from_social_details(social_details)
 
     def get_user_accounts(self, wenet_id) -> List[UserConversationContext]:
+        social_details = self.user_account_index.get(wenet_id)
+        if social_details is not None:
+            user_context = self._interface_connector.get_user_context(social_details)
+            if user_context.context is not None and user_context.context.get_static_state(self.CONTEXT_WENET_USER_ID, None) == wenet_id:
+                self.user_account_index.record_hit()
+                return [user_context]
+            # the user has logged in with another account in the meantime
+            self.user_account_index.record_stale()
+            self.user_account_index.remove(wenet_id)
+        else:
+            self.user_account_index.record_miss()
+
         result = self._interface_connector.get_user_contexts(
             self._instance_namespace,
             self._bot_id,
@@ -224,77 +260,128 @@ class WenetEventHandler(EventHandler, abc.ABC):
             static_context_value=wenet_id
         )
         logger.info(f"Retrieved [{len(result)}] user conversation context for account [{wenet_id}]")
+        if len(result) == 1:
+            self.user_account_index.update(result[0])
         return result
 
+    def _update_user_context(self, user_context: UserConversationContext) -> None:
+        """
+        Save the context of a user, keeping the user account index up to date
+        """
+        self._interface_connector.update_user_context(user_context)
+        self.user_account_index.update(user_context)
+
     # handle messages coming from WeNet
     def _handle_custom_event(self, custom_event: IncomingCustomEvent):
         """
         This function handles all the incoming messages from the bot endpoint
         """
         logger.debug(f"Received event {type(custom_event)} {custom_event.to_repr()}")
-        # this lock is needed to avoid that different threads write concurrently the static context,
-        # in particular the oauth tokens
-        self.messages_lock.acquire()
+        payload = custom_event.payload
+        if "type" in payload and payload["type"] == MessageBatchEvent.TYPE:
+            try:
+                batch = MessageBatchEvent.from_repr(payload)
+            except (KeyError, ValueError, TypeError) as e:
+                logger.error("Malformed batch from WeNet, the parser raised the following exception: %s \n event: [%s]" % (e, custom_event.to_repr()))
+                return
+            logger.info(f"Handling a batch of [{len(batch.messages)}] messages")
+            self._handle_wenet_batch(custom_event, batch.messages)
+        else:
+            self._handle_wenet_payload(custom_event, payload)
+
+    def _handle_wenet_batch(self, custom_event: IncomingCustomEvent, payloads: List[dict]) -> None:
+        """
+        Handle the messages of a batch in the worker threads: the messages addressed to the same user are handled in
+        order by the same thread, while the ones of different users are handled in parallel
+        """
+        groups: Dict[str, List[dict]] = {}
+        for payload in payloads:
+            receiver = payload.get("receiverId", payload.get("externalId")) if isinstance(payload, dict) else None
+            groups.setdefault(str(receiver), []).append(payload)
+
+        def handle_group(group: List[dict]) -> None:
+            for group_payload in group:
+                self._handle_wenet_payload(custom_event, group_payload)
+
+        if self._batch_executor is None or len(groups) == 1:
+            for group in groups.values():
+                handle_group(group)
+            return
+        futures = [self._batch_executor.submit(handle_group, group) for group in groups.values()]
+        for future in futures:
+            future.result()
+
+    def _handle_wenet_payload(self, custom_event: IncomingCustomEvent, payload: dict) -> None:
+        """
+        Handle a single message or authentication event, the custom event is the one carrying it
+        """
         try:
-            payload = custom_event.payload
             if "type" in payload and payload["type"] == WeNetAuthenticationEvent.TYPE:
                 message = WeNetAuthenticationEvent.from_repr(payload)
             elif "label" in payload:
-                message = MessageBuilder.build(custom_event.payload)
+                message = MessageEnvelope.build(payload)
             else:
                 raise ValueError(f"Unable to handle an event of type [{type(custom_event)}]")
 
             if isinstance(message, WeNetAuthenticationEvent):
-                notification = self.handle_wenet_authentication_result(message)
-                self.send_notification(notification)
+                # this lock is needed to avoid that different threads write concurrently the static context of the
+                # same user, in particular the oauth tokens, that are associated with the Telegram user ID
+                with self.messages_lock.acquire(str(message.external_id)):
+                    notification = self.handle_wenet_authentication_result(message)
+                    self.send_notification(notification)
             else:
                 # getting service api handler
                 user_accounts = self.get_user_accounts(message.receiver_id)
                 if len(user_accounts) != 1:
                     raise Exception(f"No context associated with Wenet user {message.receiver_id}")
-                service_api = self._get_service_api_interface_connector_from_context(user_accounts[0].context)
-                # logging incoming notification
-                logged_notification = self.message_parser_for_logs.create_notification(message, message.receiver_id)
-                try:
-                    service_api.log_message(logged_notification)
-                except TypeError as e:
-                    logger.warning("Unsupported message to log", exc_info=e)
-                except CreationError:
-                    logger.warning("Unable to log the incoming message to the service API")
-
-                if isinstance(message, TextualMessage):
-                    notification = self.handle_wenet_textual_message(message, response_to=logged_notification.message_id)
-                    self.send_notification(notification)
-                elif isinstance(message, Message):
-                    notification = self.handle_wenet_message(message, response_to=logged_notification.message_id)
-                    self.send_notification(notification)
-                else:
-                    raise ValueError(f"Unable to handle an event of type [{type(custom_event)}]")
-
-                # logging outgoing messages
-                for outgoing_message in notification.messages:
-                    try:
-                        service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, user_accounts[0].context.get_static_state(self.CONTEXT_WENET_USER_ID), logged_notification.message_id))
-                    except TypeError as e:
-                        logger.warning("Unsupported message to log", exc_info=e)
-                    except CreationError:
-                        logger.warning("Unable to send logs to the service API")
-
-                if notification.context is not None:
-                    self._interface_connector.update_user_context(UserConversationContext(
-                        social_details=notification.social_details,
-                        context=notification.context,
-                        version=UserConversationContext.VERSION_V3)
-                    )
+                telegram_user_id = user_accounts[0].context.get_static_state(self.CONTEXT_TELEGRAM_USER_ID, message.receiver_id)
+                with self.messages_lock.acquire(str(telegram_user_id)):
+                    self._handle_wenet_message_for_account(custom_event, message, user_accounts[0])
         except (KeyError, ValueError) as e:
-            logger.error("Malformed message from WeNet, the parser raised the following exception: %s \n event: [%s]" % (e, custom_event.to_repr()))
+            logger.error("Malformed message from WeNet, the parser raised the following exception: %s \n event: [%s]" % (e, payload))
         except NotFound as e:
             logger.error(e.server_response)
         except Exception as e:
             logger.exception("Unable to handle to command", exc_info=e)
-        finally:
-            # in any case the lock must be released, otherwise all the other messages are blocked forever
-            self.messages_lock.release()
+
+    def _handle_wenet_message_for_account(self, custom_event: IncomingCustomEvent, message: Message, user_account: UserConversationContext) -> None:
+        """
+        Handle a message from WeNet addressed to the given user account. The caller must hold the lock of the user.
+        """
+        service_api = self._get_service_api_interface_connector_from_context(user_account.context)
+        # logging incoming notification
+        logged_notification = self.message_parser_for_logs.create_notification(message, message.receiver_id)
+        self.log_shipper.ship(service_api, logged_notification)
+
+        if isinstance(message, TextualMessage):
+            notification = self.handle_wenet_textual_message(message, response_to=logged_notification.message_id)
+            self.send_notification(notification)
+        elif isinstance(message, Message):
+            notification = self.handle_wenet_message(message, response_to=logged_notification.message_id)
+            self.send_notification(notification)
+        else:
+            raise ValueError(f"Unable to handle an event of type [{type(custom_event)}]")
+
+        # logging outgoing messages
+        for outgoing_message in notification.messages:
+            try:
+                self.log_shipper.ship(service_api, self.message_parser_for_logs.create_response(outgoing_message, user_account.context.get_static_state(self.CONTEXT_WENET_USER_ID), logged_notification.message_id))
+            except TypeError as e:
+                logger.warning("Unsupported message to log", exc_info=e)
+
+        if notification.context is not None:
+            self._update_user_context(UserConversationContext(
+                social_details=notification.social_details,
+                context=notification.context,
+                version=UserConversationContext.VERSION_V3)
+            )
+
+    def send_notification(self, notification: NotificationEvent, priority: int = OutboundScheduler.PRIORITY_NOTIFICATION) -> None:
+        """
+        Send a notification through the outbound scheduler, waiting until it has been sent within the rate limits of
+        Telegram, so that the notifications of a user are still sent while holding the lock of the user
+        """
+        self.outbound_scheduler.submit(notification, priority).result()
 
     @abc.abstractmethod
     def handle_wenet_textual_message(self, message: TextualMessage, response_to: str) -> NotificationEvent:
@@ -328,18 +415,14 @@ class WenetEventHandler(EventHandler, abc.ABC):
         logged_incoming_message = self.message_parser_for_logs.create_request(incoming_event.incoming_message, context.get_static_state(self.CONTEXT_WENET_USER_ID))
         try:
             # logging incoming event
-            try:
-                service_api.log_message(logged_incoming_message)
-            except TypeError as e:
-                logger.warning("Unsupported message to log", exc_info=e)
-            except CreationError:
-                logger.warning("Unable to log the incoming message to the service API")
+            self.log_shipper.ship(service_api, logged_incoming_message)
 
             incoming_event.incoming_message.message_id = logged_incoming_message.message_id  # change to this id in order to have this information in the various methods to allow to log messages related to responses sent to other users
             outgoing_event, fulfiller, satisfying_rule = self.intent_manager.manage(incoming_event)
             context.with_dynamic_state(self.PREVIOUS_INTENT, fulfiller.intent_id)
             outgoing_event.with_context(context)
         except RefreshTokenExpiredError:
+            self.service_api_pool.invalidate(incoming_event.social_details.unique_id())
             return self.handle_oauth_login(incoming_event, "")
         except Exception as e:
             logger.exception("Something went wrong while handling incoming message", exc_info=e)
@@ -348,13 +431,9 @@ class WenetEventHandler(EventHandler, abc.ABC):
         # logging outgoing messages
         for outgoing_message in outgoing_event.messages:
             try:
-                service_api.log_message(self.message_parser_for_logs.create_response(outgoing_message, context.get_static_state(self.CONTEXT_WENET_USER_ID), logged_incoming_message.message_id))
+                self.log_shipper.ship(service_api, self.message_parser_for_logs.create_response(outgoing_message, context.get_static_state(self.CONTEXT_WENET_USER_ID), logged_incoming_message.message_id))
             except TypeError as e:
                 logger.warning("Unsupported message to log", exc_info=e)
-            except RefreshTokenExpiredError:
-                outgoing_event = self.handle_oauth_login(incoming_event, "")
-            except CreationError:
-                logger.warning("Unable to send logs to the service API")
         return outgoing_event
 
     def _save_wenet_and_telegram_user_id_to_context(self, message: WeNetAuthenticationEvent, social_details: TelegramDetails) -> None:
@@ -366,6 +445,8 @@ class WenetEventHandler(EventHandler, abc.ABC):
             self.oauth_cache, token_endpoint_url=self.wenet_authentication_management_url
         )
 
+        # the pooled connector of the user may hold the token of the previous login
+        self.service_api_pool.invalidate(social_details.unique_id())
         service_api = ServiceApiInterface(client, self.wenet_instance_url)
         context = self._interface_connector.get_user_context(social_details)
         context.context.with_static_state(self.CONTEXT_TELEGRAM_USER_ID, social_details.user_id)
@@ -376,7 +457,7 @@ class WenetEventHandler(EventHandler, abc.ABC):
         logger.debug(f"Wenet user ID is {wenet_user_id}")
         context.context.with_static_state(self.CONTEXT_WENET_USER_ID, wenet_user_id)
 
-        self._interface_connector.update_user_context(context)
+        self._update_user_context(context)
 
     @staticmethod
     def parse_text_with_markdown(text: str) -> str:
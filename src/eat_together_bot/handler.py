@@ -23,6 +23,7 @@ from chatbot_core.v3.model.messages import TextualResponse, RapidAnswerResponse,
 from chatbot_core.v3.model.outgoing_event import OutgoingEvent, NotificationEvent
 from common.utils import Utils
 from common.wenet_event_handler import WenetEventHandler
+from common.telegram_api import TelegramApiClient
 from uhopper.utils.alert.module import AlertModule
 from wenet.interface.exceptions import RefreshTokenExpiredError
 from common.authentication_event import CreationError
@@ -100,7 +101,8 @@ class EatTogetherHandler(WenetEventHandler):
                  translator: Optional[Translator],
                  delay_between_messages_sec: Optional[int] = None,
                  delay_between_text_sec: Optional[float] = None,
-                 logger_connectors: Optional[List[LoggerConnector]] = None):
+                 logger_connectors: Optional[List[LoggerConnector]] = None,
+                 telegram_api_client: Optional[TelegramApiClient] = None):
         """
         Constructor
         :param instance_namespace: instance namespace of the bot
@@ -118,11 +120,12 @@ class EatTogetherHandler(WenetEventHandler):
         :param delay_between_messages_sec:
         :param delay_between_text_sec:
         :param logger_connectors:
+        :param telegram_api_client: the client of the Telegram APIs, by default built using environment variables
         """
         super().__init__(instance_namespace, bot_id, handler_id, telegram_id, wenet_instance_url, wenet_hub_url, app_id,
                          client_secret, redirect_url, wenet_authentication_url, wenet_authentication_management_url,
                          task_type_id, community_id, alert_module, connector, nlp_handler, translator,
-                         delay_between_messages_sec, delay_between_text_sec, logger_connectors)
+                         delay_between_messages_sec, delay_between_text_sec, logger_connectors, telegram_api_client)
         # redirecting the flow in the corresponding points
         self.intent_manager.with_fulfiller(
             IntentFulfillerV3(self.ORGANIZE_Q1, self.organize_q1).with_rule(intent=self.INTENT_ORGANIZE)
@@ -267,7 +270,7 @@ class EatTogetherHandler(WenetEventHandler):
                     }
                     context.with_static_state(self.CONTEXT_CURRENT_STATE, self.PROPOSAL)
                     context.with_static_state(self.CONTEXT_PROPOSAL_TASK_DICT, task_proposals)
-                    self._interface_connector.update_user_context(UserConversationContext(
+                    self._update_user_context(UserConversationContext(
                         social_details=user_account.social_details,
                         context=context,
                         version=UserConversationContext.VERSION_V3
@@ -303,7 +306,7 @@ class EatTogetherHandler(WenetEventHandler):
                 if user_object is None:
                     error_message = "Error, userId [%s] does not give any user profile" % str(message.volunteer_id)
                     logger.error(error_message)
-                    self._interface_connector.update_user_context(UserConversationContext(
+                    self._update_user_context(UserConversationContext(
                         social_details=user_account.social_details,
                         context=context,
                         version=UserConversationContext.VERSION_V3
@@ -326,7 +329,7 @@ class EatTogetherHandler(WenetEventHandler):
                                              self.INTENT_CANCEL_VOLUNTEER_PROPOSAL.format(candidature_id))
                 response.with_textual_option(emojize(":white_check_mark: Yes, why not!?!", use_aliases=True),
                                              self.INTENT_CONFIRM_VOLUNTEER_PROPOSAL.format(candidature_id))
-                self._interface_connector.update_user_context(UserConversationContext(
+                self._update_user_context(UserConversationContext(
                     social_details=user_account.social_details,
                     context=context,
                     version=UserConversationContext.VERSION_V3
@@ -356,6 +359,7 @@ class EatTogetherHandler(WenetEventHandler):
                 raise Exception(f"Unrecognized message of type {type(message)}")
         except RefreshTokenExpiredError:
             logger.exception("Refresh token is not longer valid")
+            self.service_api_pool.invalidate(user_account.social_details.unique_id())
             notification_event = NotificationEvent(social_details=user_account.social_details)
             notification_event.with_message(
                 TelegramTextualResponse(
@@ -978,7 +982,7 @@ class EatTogetherHandler(WenetEventHandler):
             logger.error(error_message)
             self._alert_module.alert(error_message)
             raise ValueError(error_message)
-        self._interface_connector.update_user_context(context)
+        self._update_user_context(context)
         return carousel_update
 
     def action_task_conclusion_cancel(self, incoming_event: IncomingSocialEvent, _: str) -> OutgoingEvent:
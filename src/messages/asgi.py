@@ -0,0 +1,219 @@
+from __future__ import absolute_import, annotations
+
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple
+from urllib.parse import parse_qs
+
+from chatbot_core.model.event import IncomingCustomEvent
+from uhopper.utils.mqtt.handler import MqttPublishHandler
+from common.authentication_event import WeNetAuthenticationEvent
+from common.callback_messages import MessageBuilder
+from common.message_batch import MessageBatchEvent
+from common.message_envelope import MessageEnvelope
+
+logger = logging.getLogger("uhopper.chatbot.wenet.messages.asgi")
+
+
+class AsyncMessageInterface:
+    """
+    ASGI application exposing the same routes of the Flask one (`/message`, `/messages` and `/auth`).
+
+    Requests never wait for MQTT: the events of each request are put together in a bounded queue, and a single task
+    publishes them through the MQTT publisher of the process, in a dedicated thread. When the queue is full, requests
+    wait up to `enqueue_timeout_sec` for a free slot and then fail with 503, without having queued any of their events.
+    Failed publications are retried with an exponential backoff, since the requests have already been accepted. At
+    shutdown the queue is drained before stopping.
+
+    Attributes:
+        - mqtt_publisher: the publisher shared by all the requests of the process
+        - max_queue_size: the maximum number of requests whose events are waiting to be published
+        - max_batch_size: the maximum number of messages published together by the `/messages` route
+        - enqueue_timeout_sec: the maximum time a request waits for a free slot in the queue
+        - drain_timeout_sec: the maximum time spent publishing the queued events at shutdown
+        - retry_backoff_sec: the maximum waiting time between two publication attempts of an event
+    """
+
+    def __init__(self, mqtt_publisher: MqttPublishHandler, mqtt_topic: str, instance_namespace: str, bot_id: str,
+                 wenet_app_id: str, oauth_successful_redirect_url: str, max_queue_size: int = 1000,
+                 max_batch_size: int = 100, enqueue_timeout_sec: float = 5, drain_timeout_sec: float = 30,
+                 retry_backoff_sec: float = 5) -> None:
+        self.mqtt_publisher = mqtt_publisher
+        self.mqtt_topic = mqtt_topic
+        self.instance_namespace = instance_namespace
+        self.bot_id = bot_id
+        self._app_id = wenet_app_id
+        self.oauth_successful_redirect_url = oauth_successful_redirect_url
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.enqueue_timeout_sec = enqueue_timeout_sec
+        self.drain_timeout_sec = drain_timeout_sec
+        self.retry_backoff_sec = retry_backoff_sec
+        self._queue: Optional[asyncio.Queue] = None
+        self._publisher_task: Optional[asyncio.Task] = None
+        # a single thread, so that the publisher is never used concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mqtt-publisher")
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._publisher_task = asyncio.ensure_future(self._publish_loop())
+
+    async def stop(self) -> None:
+        """
+        Publish the events still in the queue and stop the publisher task
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), self.drain_timeout_sec)
+        except asyncio.TimeoutError:
+            logger.error(f"Unable to publish [{self._queue.qsize()}] events before shutting down")
+        self._publisher_task.cancel()
+        self._executor.shutdown(wait=True)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _publish_loop(self) -> None:
+        while True:
+            events = await self._queue.get()
+            try:
+                for data in events:
+                    await self._publish(data)
+            finally:
+                self._queue.task_done()
+
+    async def _publish(self, data: dict) -> None:
+        """
+        Publish an event, retrying until it succeeds
+        """
+        loop = asyncio.get_event_loop()
+        backoff = 0.1
+        while True:
+            try:
+                await loop.run_in_executor(self._executor, self.mqtt_publisher.publish_data, self.mqtt_topic, data)
+                return
+            except Exception as e:
+                logger.warning(f"Unable to publish an event, retrying in [{backoff}] seconds", exc_info=e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.retry_backoff_sec)
+
+    async def _enqueue(self, events: List[IncomingCustomEvent]) -> bool:
+        if self._queue is None:
+            # the server does not support the lifespan protocol
+            await self.start()
+        try:
+            # the events of a request are queued together, so that a rejected request has none of them published
+            await asyncio.wait_for(self._queue.put([event.to_repr() for event in events]), self.enqueue_timeout_sec)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning("The publish queue is full, rejecting the request")
+            return False
+
+    async def _http(self, scope: dict, receive, send) -> None:
+        path, method = scope["path"], scope["method"]
+        if path == "/message" and method == "POST":
+            status, body = await self._post_message(await self._read_body(receive))
+        elif path == "/messages" and method == "POST":
+            status, body = await self._post_messages(await self._read_body(receive))
+        elif path == "/auth" and method == "GET":
+            status, location = await self._get_auth(scope.get("query_string", b"").decode("utf-8"))
+            if location is not None:
+                await send({"type": "http.response.start", "status": status, "headers": [(b"location", location.encode("utf-8"))]})
+                await send({"type": "http.response.body", "body": b""})
+                return
+            body = {"message": "Missing authorization code or external id"} if status == 400 else {"Error": "Too many messages, try again later"}
+        elif path in ("/message", "/messages", "/auth"):
+            status, body = 405, {"message": "The method is not allowed for the requested URL."}
+        else:
+            status, body = 404, {"message": "The requested URL was not found on the server."}
+
+        payload = json.dumps(body).encode("utf-8")
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode("utf-8"))]})
+        await send({"type": "http.response.body", "body": payload})
+
+    @staticmethod
+    async def _read_body(receive) -> Optional[object]:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        try:
+            return json.loads(b"".join(chunks))
+        except ValueError:
+            return None
+
+    async def _post_message(self, data) -> Tuple[int, dict]:
+        try:
+            message = MessageBuilder.build(data)
+        except (KeyError, TypeError) as e:
+            logger.exception("Bad payload: parsing error. Received %s" % json.dumps(data), exc_info=e)
+            return 400, {"Error": "One or more required keys are missing"}
+        except ValueError:
+            logger.error("Error, enum values not respected. Received %s" % json.dumps(data))
+            return 400, {"Error": "One or more values of the enum fields are not respected. Please check the documentation and try again"}
+
+        logger.info("Message received: [%s] %s" % (type(message), str(message.to_repr())))
+        if not await self._enqueue([IncomingCustomEvent(self.instance_namespace, MessageEnvelope.to_repr(message), self.bot_id)]):
+            return 503, {"Error": "Too many messages, try again later"}
+        return 200, {}
+
+    async def _post_messages(self, data) -> Tuple[int, dict]:
+        if not isinstance(data, list):
+            logger.error("Bad payload: expected a list of messages. Received %s" % json.dumps(data))
+            return 400, {"Error": "The payload must be a list of messages"}
+
+        results = []
+        valid_messages: List[dict] = []
+        for raw_message in data:
+            try:
+                valid_messages.append(MessageEnvelope.to_repr(MessageBuilder.build(raw_message)))
+                results.append({"status": 200})
+            except (KeyError, TypeError) as e:
+                logger.warning("Bad message in batch: parsing error. Received %s" % json.dumps(raw_message), exc_info=e)
+                results.append({"status": 400, "Error": "One or more required keys are missing"})
+            except ValueError:
+                logger.warning("Bad message in batch, enum values not respected. Received %s" % json.dumps(raw_message))
+                results.append({"status": 400, "Error": "One or more values of the enum fields are not respected"})
+
+        logger.info(f"Batch received: [{len(valid_messages)}] valid messages out of [{len(data)}]")
+        events = [
+            IncomingCustomEvent(self.instance_namespace, MessageBatchEvent(valid_messages[i:i + self.max_batch_size]).to_repr(), self.bot_id)
+            for i in range(0, len(valid_messages), self.max_batch_size)
+        ]
+        if not await self._enqueue(events):
+            return 503, {"Error": "Too many messages, try again later"}
+        return 200, {"results": results}
+
+    async def _get_auth(self, query_string: str) -> Tuple[int, Optional[str]]:
+        args = parse_qs(query_string)
+        code = args.get("code", [None])[0]
+        external_id = args.get("external_id", [None])[0]
+        if code is None or code == "" or external_id is None or external_id == "":
+            error = args.get("error", [None])[0]
+            logger.warning(f"Missing authorization code or external id, error {error}")
+            return 400, None
+
+        logger.info(f"Authentication credentials received: code [{code}] and external id [{external_id}]")
+        message = WeNetAuthenticationEvent(external_id, code)
+        if not await self._enqueue([IncomingCustomEvent(self.instance_namespace, message.to_repr(), self.bot_id)]):
+            return 503, None
+        return 302, f"{self.oauth_successful_redirect_url}?app_id={self._app_id}"
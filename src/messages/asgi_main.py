@@ -0,0 +1,51 @@
+import logging.config
+import os
+import uuid
+import sentry_sdk
+
+from common.logging_config import get_logging_configuration
+from messages.asgi import AsyncMessageInterface
+from uhopper.utils.mqtt.handler import MqttPublishHandler
+from sentry_sdk.integrations.logging import LoggingIntegration
+
+sentry_logging = LoggingIntegration(
+    level=logging.INFO,  # Capture info and above as breadcrumbs
+    event_level=logging.ERROR  # Send errors as events
+)
+
+sentry_sdk.init(
+    integrations=[sentry_logging],
+    traces_sample_rate=1.0
+)
+
+bot_id = os.getenv("BOT_ID")
+
+project_name = os.getenv("PROJECT_NAME", "wenet-ask-for-help-chatbot")
+logging.config.dictConfig(get_logging_configuration(f"{project_name}-messages"))
+logger = logging.getLogger("uhopper.chatbot.wenet.messages")
+
+topic = os.getenv("MQTT_TOPIC")
+publisher = MqttPublishHandler(
+    os.getenv("MQTT_HOST"),
+    f"{os.getenv('MQTT_PUBLISHER_ID')}_{uuid.uuid4()}",
+    os.getenv("MQTT_USER"),
+    os.getenv("MQTT_PASSWORD")
+)
+instance_namespace = os.getenv("INSTANCE_NAMESPACE")
+app_id = os.getenv("WENET_APP_ID")
+hub_url = os.getenv("WENET_HUB_URL")
+oauth_success_url = f"{hub_url}/oauth/complete"
+
+publisher.connect()
+
+bot_messages_app = AsyncMessageInterface(
+    publisher,
+    topic,
+    instance_namespace,
+    bot_id,
+    app_id,
+    oauth_success_url,
+    max_queue_size=int(os.getenv("MESSAGES_QUEUE_SIZE", 1000)),
+    max_batch_size=int(os.getenv("MESSAGES_BATCH_MAX_SIZE", 100)),
+    enqueue_timeout_sec=float(os.getenv("MESSAGES_ENQUEUE_TIMEOUT", 5))
+)
@@ -1,5 +1,7 @@
 import json
 import logging
+import os
+from typing import List
 
 from flask import request, redirect
 from flask_restful import Resource, abort
@@ -8,6 +10,8 @@ from chatbot_core.model.event import IncomingCustomEvent
 from uhopper.utils.mqtt.handler import MqttPublishHandler
 from common.authentication_event import WeNetAuthenticationEvent
 from common.callback_messages import MessageBuilder
+from common.message_batch import MessageBatchEvent
+from common.message_envelope import MessageEnvelope
 
 logger = logging.getLogger("uhopper.chatbot.wenet.messages")
 
@@ -27,7 +31,7 @@ class WeNetMessageInterface(Resource):
         try:
             message = MessageBuilder.build(data)
             logger.info("Message received: [%s] %s" % (type(message), str(message.to_repr())))
-            event = IncomingCustomEvent(self.instance_namespace, message.to_repr(), self.bot_id)
+            event = IncomingCustomEvent(self.instance_namespace, MessageEnvelope.to_repr(message), self.bot_id)
             self.mqtt_publisher.publish_data(self.mqtt_topic, event.to_repr())
             return {}, 200
         except KeyError as e:
@@ -39,6 +43,49 @@ class WeNetMessageInterface(Resource):
                              "and try again"}, 400
 
 
+class WeNetMessagesInterface(Resource):
+    """
+    Receive several messages at once. Each message is validated independently, the valid ones are published in
+    batches of at most `max_batch_size` messages and the status of each message is returned.
+    """
+
+    def __init__(self, mqtt_publisher: MqttPublishHandler, mqtt_topic: str, instance_namespace: str,
+                 bot_id: str, max_batch_size: int) -> None:
+
+        self.mqtt_publisher = mqtt_publisher
+        self.instance_namespace = instance_namespace
+        self.bot_id = bot_id
+        self.mqtt_topic = mqtt_topic
+        self.max_batch_size = max_batch_size
+
+    def post(self):
+        data = request.get_json()
+        if not isinstance(data, list):
+            logger.error("Bad payload: expected a list of messages. Received %s" % json.dumps(data))
+            return {"Error": "The payload must be a list of messages"}, 400
+
+        results = []
+        valid_messages: List[dict] = []
+        for raw_message in data:
+            try:
+                message = MessageBuilder.build(raw_message)
+                valid_messages.append(MessageEnvelope.to_repr(message))
+                results.append({"status": 200})
+            except (KeyError, TypeError) as e:
+                logger.warning("Bad message in batch: parsing error. Received %s" % json.dumps(raw_message), exc_info=e)
+                results.append({"status": 400, "Error": "One or more required keys are missing"})
+            except ValueError:
+                logger.warning("Bad message in batch, enum values not respected. Received %s" % json.dumps(raw_message))
+                results.append({"status": 400, "Error": "One or more values of the enum fields are not respected"})
+
+        logger.info(f"Batch received: [{len(valid_messages)}] valid messages out of [{len(data)}]")
+        for i in range(0, len(valid_messages), self.max_batch_size):
+            batch = MessageBatchEvent(valid_messages[i:i + self.max_batch_size])
+            event = IncomingCustomEvent(self.instance_namespace, batch.to_repr(), self.bot_id)
+            self.mqtt_publisher.publish_data(self.mqtt_topic, event.to_repr())
+        return {"results": results}, 200
+
+
 class WeNetLoginCallbackInterface(Resource):
 
     def __init__(self, mqtt_publisher: MqttPublishHandler, mqtt_topic: str, instance_namespace: str,
@@ -76,5 +123,6 @@ class InstanceResourcesBuilder:
     def routes(mqtt_publisher: MqttPublishHandler, mqtt_topic: str, instance_namespace: str, bot_id: str, wenet_app_id: str, oauth_successful_redirect_url: str):
         return [
             (WeNetMessageInterface, '/message', (mqtt_publisher, mqtt_topic, instance_namespace, bot_id)),
+            (WeNetMessagesInterface, '/messages', (mqtt_publisher, mqtt_topic, instance_namespace, bot_id, int(os.getenv("MESSAGES_BATCH_MAX_SIZE", 100)))),
             (WeNetLoginCallbackInterface, '/auth', (mqtt_publisher, mqtt_topic, instance_namespace, bot_id, wenet_app_id, oauth_successful_redirect_url))
         ]
@@ -4,6 +4,7 @@ import uuid
 import sentry_sdk
 
 from common.logging_config import get_logging_configuration
+from messages.spool import SpooledPublisher
 from messages.ws import MessageInterface
 from uhopper.utils.mqtt.handler import MqttPublishHandler
 from sentry_sdk.integrations.logging import LoggingIntegration
@@ -42,7 +43,10 @@ oauth_success_url = f"{hub_url}/oauth/complete"
 
 publisher.connect()
 
-ws = MessageInterface(publisher, topic, instance_namespace, bot_id, app_id, oauth_success_url)
+# when a spool directory is configured, messages are stored on disk and forwarded to MQTT in background
+spooled_publisher = SpooledPublisher.build_from_env(publisher).start() if os.getenv("MESSAGES_SPOOL_DIR") else None
+
+ws = MessageInterface(spooled_publisher if spooled_publisher is not None else publisher, topic, instance_namespace, bot_id, app_id, oauth_success_url)
 bot_messages_app = ws.get_application()
 
 host = os.getenv("MESSAGES_HOST", "0.0.0.0")
@@ -52,4 +56,6 @@ if __name__ == "__main__":
     try:
         ws.run(host, port)
     except KeyboardInterrupt:
+        if spooled_publisher is not None:
+            spooled_publisher.stop()
         publisher.disconnect()
@@ -0,0 +1,430 @@
+from __future__ import absolute_import, annotations
+
+import fcntl
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from threading import Condition, Event, Lock, Thread
+from typing import BinaryIO, List, Optional, Tuple
+
+from uhopper.utils.mqtt.handler import MqttPublishHandler
+
+
+logger = logging.getLogger("uhopper.chatbot.wenet.messages.spool")
+
+
+class SpoolRecord:
+    """
+    A message stored in the spool
+    Attributes:
+        - topic: the MQTT topic where the message should be published
+        - data: the message to publish
+        - created: the timestamp of the moment in which the message has been appended to the spool
+    """
+    # length of the payload, crc32 of the payload, creation timestamp
+    HEADER = struct.Struct(">IId")
+
+    def __init__(self, topic: str, data: dict, created: float) -> None:
+        self.topic = topic
+        self.data = data
+        self.created = created
+
+    def encode(self) -> bytes:
+        payload = json.dumps({"topic": self.topic, "data": self.data}).encode("utf-8")
+        return self.HEADER.pack(len(payload), zlib.crc32(payload), self.created) + payload
+
+    @staticmethod
+    def read(stream: BinaryIO) -> Optional[SpoolRecord]:
+        """
+        Read the next record from the stream
+        :return: the record, None if the stream does not contain a complete record
+        :raise ValueError: if the record is corrupted
+        """
+        header = stream.read(SpoolRecord.HEADER.size)
+        if len(header) < SpoolRecord.HEADER.size:
+            return None
+        length, crc, created = SpoolRecord.HEADER.unpack(header)
+        payload = stream.read(length)
+        if len(payload) < length:
+            return None
+        if zlib.crc32(payload) != crc:
+            raise ValueError("Checksum mismatch")
+        raw = json.loads(payload.decode("utf-8"))
+        return SpoolRecord(raw["topic"], raw["data"], created)
+
+
+class MessageSpool:
+    """
+    Append-only write-ahead log of the messages to publish, split into segments of bounded size.
+
+    Appends return once the record is on disk. Concurrent appends share the same fsync (group commit): records keep
+    being appended while a sync is running, and the next sync covers all of them.
+    Records are consumed in order by a single reader, whose position is persisted in a checkpoint file, and the
+    segments that have been completely consumed are deleted.
+    When the reader finds a corrupted record, the rest of the segment cannot be read: the segment is renamed with the
+    `.corrupted` suffix, so that it can be inspected, and the reader moves to the next one.
+
+    Attributes:
+        - directory: the directory containing the segments, it is owned by a single process
+        - segment_max_bytes: the size after which a new segment is started
+    """
+    SEGMENT_SUFFIX = ".log"
+    CORRUPTED_SUFFIX = ".corrupted"
+    CHECKPOINT_FILE = "checkpoint"
+
+    def __init__(self, directory: str, segment_max_bytes: int = 16 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = Lock()
+        self._sync_lock = Lock()
+        self._appended = Condition(self._lock)
+        self._written = 0  # number of records written since the spool was opened
+        self._synced = 0  # number of records written and synced since the spool was opened
+        segments = self._segments()
+        self._read_segment, self._read_offset = self._load_checkpoint(segments)
+        # writes always start in a new segment, so the ones left by a previous process are never modified
+        self._write_segment = max(segments[-1] + 1 if segments else 0, self._read_segment + 1)
+        self._write_file = open(self._segment_path(self._write_segment), "ab")
+        self._write_offset = 0
+        self._synced_segment, self._synced_offset = self._write_segment, 0
+        self._fsync_directory()
+
+    def append(self, topic: str, data: dict) -> None:
+        """
+        Append a message to the spool, returning once it is durably stored
+        """
+        record = SpoolRecord(topic, data, time.time()).encode()
+        with self._lock:
+            if self._write_offset > 0 and self._write_offset + len(record) > self.segment_max_bytes:
+                self._rotate()
+            self._write_file.write(record)
+            self._write_offset += len(record)
+            self._written += 1
+            ticket = self._written
+
+        # the first writer getting here syncs also the records appended in the meantime by the others
+        with self._sync_lock:
+            with self._lock:
+                if self._synced >= ticket:
+                    return
+                self._write_file.flush()
+                fd = os.dup(self._write_file.fileno())
+                written, segment, offset = self._written, self._write_segment, self._write_offset
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self._lock:
+                if written > self._synced:
+                    self._mark_synced(written, segment, offset)
+
+    def read(self, max_records: int, timeout: float) -> List[Tuple[SpoolRecord, Tuple[int, int]]]:
+        """
+        Read the next synced records after the current reader position, without consuming them
+        :return: the records with the position following each of them, empty if none is available within the timeout
+        """
+        with self._lock:
+            if not self._has_unread():
+                self._appended.wait(timeout)
+            synced_segment, synced_offset = self._synced_segment, self._synced_offset
+
+        records = []
+        segment, offset = self._read_segment, self._read_offset
+        while len(records) < max_records and (segment, offset) < (synced_segment, synced_offset):
+            path = self._segment_path(segment)
+            if not os.path.exists(path):
+                segment, offset = segment + 1, 0
+                continue
+            corrupted = False
+            with open(path, "rb") as stream:
+                stream.seek(offset)
+                while len(records) < max_records and (segment, offset) < (synced_segment, synced_offset):
+                    try:
+                        record = SpoolRecord.read(stream)
+                    except ValueError:
+                        corrupted = True
+                        record = None
+                    if record is None:
+                        break
+                    offset = stream.tell()
+                    records.append((record, (segment, offset)))
+            if corrupted:
+                if not records:
+                    # the corrupted record is the next one to consume
+                    logger.error(f"Corrupted record in the segment [{path}] at offset [{offset}], skipping the rest of the segment")
+                    self._quarantine(segment)
+                    self.commit((segment + 1, 0))
+                # the records before the corrupted one are consumed first, the segment is skipped by the next read
+                break
+            if len(records) < max_records and segment < synced_segment:
+                segment, offset = segment + 1, 0
+            else:
+                break
+        return records
+
+    def commit(self, position: Tuple[int, int]) -> None:
+        """
+        Move the reader after a consumed record, deleting the segments that are no longer needed
+        """
+        segment, offset = position
+        self._save_checkpoint(segment, offset)
+        for old_segment in range(self._read_segment, segment):
+            try:
+                os.remove(self._segment_path(old_segment))
+            except FileNotFoundError:
+                pass
+        self._read_segment, self._read_offset = segment, offset
+
+    def depth_bytes(self) -> int:
+        """
+        The size of the records not yet consumed
+        """
+        total = 0
+        for segment in self._segments():
+            if segment >= self._read_segment:
+                try:
+                    total += os.path.getsize(self._segment_path(segment))
+                except FileNotFoundError:
+                    pass
+        return max(total - self._read_offset, 0)
+
+    def close(self) -> None:
+        with self._lock:
+            self._sync()
+            self._write_file.close()
+
+    def has_unread(self) -> bool:
+        with self._lock:
+            return self._has_unread()
+
+    def _quarantine(self, segment: int) -> None:
+        """
+        Move a segment with a corrupted record out of the way of the reader, the writer moves to a new segment first
+        """
+        with self._lock:
+            if segment == self._write_segment:
+                self._rotate()
+            path = self._segment_path(segment)
+            os.replace(path, f"{path}{self.CORRUPTED_SUFFIX}")
+            self._fsync_directory()
+
+    def _has_unread(self) -> bool:
+        return (self._read_segment, self._read_offset) < (self._synced_segment, self._synced_offset)
+
+    def _sync(self) -> None:
+        # must be called holding the lock
+        self._write_file.flush()
+        os.fsync(self._write_file.fileno())
+        self._mark_synced(self._written, self._write_segment, self._write_offset)
+
+    def _mark_synced(self, written: int, segment: int, offset: int) -> None:
+        # must be called holding the lock
+        self._synced = written
+        self._synced_segment, self._synced_offset = segment, offset
+        self._appended.notify_all()
+
+    def _rotate(self) -> None:
+        # must be called holding the lock
+        self._sync()
+        self._write_file.close()
+        self._write_segment += 1
+        self._write_file = open(self._segment_path(self._write_segment), "ab")
+        self._write_offset = 0
+        self._fsync_directory()
+        self._synced_segment, self._synced_offset = self._write_segment, 0
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(name[:-len(self.SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(self.SEGMENT_SUFFIX) and name[:-len(self.SEGMENT_SUFFIX)].isdigit()
+        )
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:020d}{self.SEGMENT_SUFFIX}")
+
+    def _load_checkpoint(self, segments: List[int]) -> Tuple[int, int]:
+        try:
+            with open(os.path.join(self.directory, self.CHECKPOINT_FILE)) as f:
+                segment, offset = (int(value) for value in f.read().split())
+                return segment, offset
+        except (FileNotFoundError, ValueError):
+            return (segments[0], 0) if segments else (0, 0)
+
+    def _save_checkpoint(self, segment: int, offset: int) -> None:
+        path = os.path.join(self.directory, self.CHECKPOINT_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(f"{segment} {offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _fsync_directory(self) -> None:
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SpoolForwarder:
+    """
+    Background thread publishing the messages of a spool to MQTT, in order.
+    A message is consumed only once it has been published, a failed publication is retried until it succeeds.
+    Attributes:
+        - spool: the spool to drain
+        - mqtt_publisher: the publisher used to forward the messages
+        - batch_size: the maximum number of messages read from the spool at once
+        - retry_backoff_sec: the maximum waiting time between two publication attempts
+        - metrics_interval_sec: the spool depth and age are logged every this number of seconds
+    """
+
+    def __init__(self, spool: MessageSpool, mqtt_publisher: MqttPublishHandler, batch_size: int = 100,
+                 retry_backoff_sec: float = 5, metrics_interval_sec: float = 60) -> None:
+        self.spool = spool
+        self.mqtt_publisher = mqtt_publisher
+        self.batch_size = batch_size
+        self.retry_backoff_sec = retry_backoff_sec
+        self.metrics_interval_sec = metrics_interval_sec
+        self.forwarded = 0
+        self.failed_attempts = 0
+        self._oldest_pending: Optional[float] = None
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+        self._last_metrics = time.monotonic()
+
+    def start(self) -> SpoolForwarder:
+        self._thread = Thread(target=self._run, name="spool-forwarder", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def metrics(self) -> dict:
+        return {
+            "depth_bytes": self.spool.depth_bytes(),
+            "age_sec": time.time() - self._oldest_pending if self._oldest_pending is not None else 0,
+            "forwarded": self.forwarded,
+            "failed_attempts": self.failed_attempts,
+        }
+
+    def forward_available(self, timeout: float = 1) -> int:
+        """
+        Publish the messages currently available in the spool.
+        The reader position is persisted once per batch, so after a crash the last batch may be published again.
+        :return: the number of published messages
+        """
+        published = 0
+        last_position = None
+        try:
+            for record, position in self.spool.read(self.batch_size, timeout):
+                self._oldest_pending = record.created
+                backoff = 0.1
+                while True:
+                    try:
+                        self.mqtt_publisher.publish_data(record.topic, record.data)
+                        break
+                    except Exception as e:
+                        self.failed_attempts += 1
+                        logger.warning(f"Unable to publish a spooled message, retrying in [{backoff}] seconds", exc_info=e)
+                        if self._stop.wait(backoff):
+                            return published
+                        backoff = min(backoff * 2, self.retry_backoff_sec)
+                        self._log_metrics_if_due()
+                last_position = position
+                self.forwarded += 1
+                published += 1
+            self._oldest_pending = None
+        finally:
+            if last_position is not None:
+                self.spool.commit(last_position)
+        return published
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.forward_available() == 0 and self.spool.has_unread():
+                    # the unread records cannot be read yet (e.g. a corrupted segment has just been skipped)
+                    self._stop.wait(min(1.0, self.retry_backoff_sec))
+            except Exception as e:
+                logger.exception("Unexpected error while forwarding spooled messages", exc_info=e)
+                self._stop.wait(self.retry_backoff_sec)
+            self._log_metrics_if_due()
+
+    def _log_metrics_if_due(self) -> None:
+        if time.monotonic() - self._last_metrics >= self.metrics_interval_sec:
+            self._last_metrics = time.monotonic()
+            logger.info(f"Spool metrics: {self.metrics()}")
+
+
+class SpooledPublisher:
+    """
+    Publisher storing the messages in a local spool and forwarding them to MQTT in background.
+    It exposes the same `publish_data` of the MQTT publisher, so that the resources can use it in place of that.
+    Attributes:
+        - spool: the spool where the messages are appended
+        - forwarder: the forwarder draining the spool
+    """
+
+    def __init__(self, spool: MessageSpool, forwarder: SpoolForwarder, slot_lock: Optional[BinaryIO] = None) -> None:
+        self.spool = spool
+        self.forwarder = forwarder
+        self._slot_lock = slot_lock
+
+    def publish_data(self, topic: str, data: dict) -> None:
+        self.spool.append(topic, data)
+
+    def start(self) -> SpooledPublisher:
+        self.forwarder.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self.forwarder.stop(timeout)
+        self.spool.close()
+        if self._slot_lock is not None:
+            self._slot_lock.close()
+
+    @staticmethod
+    def claim_slot(directory: str, slots: int) -> Tuple[str, BinaryIO]:
+        """
+        Claim one of the spool directories, each process must own a different one.
+        A slot left by a terminated process is claimed again by the next process, that forwards its messages.
+        :return: the directory of the slot and the file holding the lock on it
+        """
+        for slot in range(slots):
+            slot_directory = os.path.join(directory, f"slot-{slot}")
+            os.makedirs(slot_directory, exist_ok=True)
+            lock_file = open(os.path.join(slot_directory, ".lock"), "ab")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_directory, lock_file
+            except BlockingIOError:
+                lock_file.close()
+        raise RuntimeError(f"All the [{slots}] spool slots in [{directory}] are already in use")
+
+    @staticmethod
+    def build_from_env(mqtt_publisher: MqttPublishHandler) -> SpooledPublisher:
+        """
+        Build the spooled publisher using environment variables.
+
+        Required environment variables are:
+          - MESSAGES_SPOOL_DIR
+
+        Optional environment variables are:
+          - MESSAGES_SPOOL_SLOTS - default to '16', must not be lower than the number of workers
+          - MESSAGES_SPOOL_SEGMENT_BYTES - default to '16777216'
+          - MESSAGES_SPOOL_METRICS_INTERVAL - default to '60'
+
+        :return: the spooled publisher, not yet started
+        """
+        directory, slot_lock = SpooledPublisher.claim_slot(os.getenv("MESSAGES_SPOOL_DIR"), int(os.getenv("MESSAGES_SPOOL_SLOTS", 16)))
+        logger.info(f"Spooling messages in [{directory}]")
+        spool = MessageSpool(directory, int(os.getenv("MESSAGES_SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024)))
+        forwarder = SpoolForwarder(spool, mqtt_publisher, metrics_interval_sec=float(os.getenv("MESSAGES_SPOOL_METRICS_INTERVAL", 60)))
+        return SpooledPublisher(spool, forwarder, slot_lock)
@@ -0,0 +1,72 @@
+"""
+Compare the time needed to store the button payloads of a question expiration message with the maximum number of
+answers, and the memory they take in Redis, writing them one at a time, in a single pipeline and as a group of buttons
+sharing their payload. It needs a local Redis, configured with the usual
+`REDIS_HOST`, `REDIS_PORT` and `REDIS_DB` environment variables.
+Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_bot_cache [messages] [answers]
+"""
+from __future__ import absolute_import, annotations
+
+import sys
+import time
+import uuid
+from typing import Dict, List
+
+from common.button_payload import ButtonPayload
+from common.cache import BUTTON_GROUP_KEY, BotCache
+
+
+def build_message(answers: int) -> Dict[str, dict]:
+    """
+    :return: the button payloads of a question expiration message, one button for each answer plus the one asking for more answers
+    """
+    button_ids = [str(uuid.uuid4()) for _ in range(answers + 1)]
+    payloads = {
+        button_ids[i]: {"payload": {"task_id": "task_id", "transaction_id": f"transaction_{i}", "order": f"#{1 + i}", "related_buttons": button_ids}, "intent": "best_answer"}
+        for i in range(answers)
+    }
+    payloads[button_ids[answers]] = {"payload": {"task_id": "task_id", "related_buttons": button_ids}, "intent": "ask_more_answers"}
+    return payloads
+
+
+def one_at_a_time(cache: BotCache, messages: List[Dict[str, dict]]) -> List[str]:
+    for message in messages:
+        for key, data in message.items():
+            cache.cache(data, key=key)
+    return [key for message in messages for key in message]
+
+
+def pipelined(cache: BotCache, messages: List[Dict[str, dict]]) -> List[str]:
+    for message in messages:
+        cache.cache_many(message)
+    return [key for message in messages for key in message]
+
+
+def grouped(cache: BotCache, messages: List[Dict[str, dict]]) -> List[str]:
+    keys = []
+    for message in messages:
+        buttons = []
+        for data in message.values():
+            extra = {key: value for key, value in data["payload"].items() if key not in ("task_id", "related_buttons")}
+            buttons.append(ButtonPayload(extra, data["intent"]))
+        button_ids = cache.cache_button_group({"task_id": "task_id"}, buttons)
+        keys.append(BUTTON_GROUP_KEY.format(button_ids[0].split("-")[0]))
+    return keys
+
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    answers = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    cache = BotCache.build_from_env()
+    for name, run, round_trips in [("one write per button", one_at_a_time, answers + 1), ("pipelined writes", pipelined, 1), ("button group", grouped, 1)]:
+        workload = [build_message(answers) for _ in range(messages)]
+        used_memory = cache._r.info("memory")["used_memory"]
+        start = time.perf_counter()
+        keys = run(cache, workload)
+        elapsed = time.perf_counter() - start
+        memory_per_message = (cache._r.info("memory")["used_memory"] - used_memory) / messages
+        print(f"{name}: {round_trips} round trips per message, {elapsed * 1000 / messages:.3f} ms and {memory_per_message:.0f} bytes per message over {messages} messages")
+        for key in keys:
+            cache.remove(key)
@@ -0,0 +1,53 @@
+"""
+Compare the size of the payloads of the buttons of the ask4help bot and the time needed to encode and decode them,
+serialized in JSON, in msgpack and in msgpack compressed with zstd. The payloads have the shapes of the ones stored by
+the handler. Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_cache_codec [iterations]
+"""
+from __future__ import absolute_import, annotations
+
+import sys
+import time
+import uuid
+from typing import Dict
+
+from common.button_payload import ButtonPayload
+from common.cache_codec import CacheCodec, JsonCodec, MsgpackCodec
+
+
+def build_payloads() -> Dict[str, dict]:
+    related_buttons = [str(uuid.uuid4()) for _ in range(4)]
+    question = "Does anybody know a quiet place near the campus where I can study in the evening, possibly with some plugs for the laptop? The library closes too early for me."
+    answer = "The study room on the second floor of the department is open until midnight and it has plugs at every desk."
+    return {
+        "question (previous versions)": ButtonPayload({"task_id": "62a1b2c3d4e5f60718293a4b", "question": question, "sensitive": False, "username": "Alice", "related_buttons": related_buttons}, "answer_question").to_repr(),
+        "question group": {"task_id": "62a1b2c3d4e5f60718293a4b", "question": question, "sensitive": False, "username": "Alice"},
+        "answered question group": {"answerer_user_id": "2713", "answerer_name": "Bob", "answer": answer, "transaction_id": "17", "task_id": "62a1b2c3d4e5f60718293a4b", "question": question, "questioner_user_id": "1264"},
+        "best answer button": {"intent": "best_answer", "extra": {"task_id": "62a1b2c3d4e5f60718293a4b", "transaction_id": "17", "order": "#3"}},
+        "follow up group": {"answerer_user_id": "2713", "answerer_name": "Bob", "transaction_id": "17", "task_id": "62a1b2c3d4e5f60718293a4b", "questioner_user_id": "1264", "questioner_name": "Alice"},
+        "locale": {"locale": "en"},
+    }
+
+
+def measure(codec: CacheCodec, payload: dict, iterations: int):
+    raw = codec.encode(payload)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.encode(payload)
+    encode_us = (time.perf_counter() - start) * 1e6 / iterations
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.decode(raw)
+    decode_us = (time.perf_counter() - start) * 1e6 / iterations
+    return len(raw), encode_us, decode_us
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    codecs = [("json", JsonCodec()), ("msgpack", MsgpackCodec(zstd_threshold=None)), ("msgpack+zstd", MsgpackCodec(zstd_threshold=0))]
+    for name, payload in build_payloads().items():
+        print(f"{name}:")
+        for codec_name, codec in codecs:
+            size, encode_us, decode_us = measure(codec, payload, iterations)
+            print(f"  {codec_name}: {size} bytes, encode {encode_us:.2f} us, decode {decode_us:.2f} us")
@@ -0,0 +1,84 @@
+"""
+Compare the memory used by 100k messages from WeNet kept as message objects, as the raw dictionaries the endpoints
+and the batches keep, and as a `__slots__` record storing the attributes as a tuple of values with a shared tuple of
+names (the compact record considered for the messages buffered in memory).
+
+This is the record of why the compact record was not added. With Python 3.11 it measured:
+
+    message objects: 71.6 MiB, 751 bytes per message
+    raw dictionaries: 107.2 MiB, 1124 bytes per message
+    slots records: 35.4 MiB, 371 bytes per message
+
+The record halves the memory of the message objects, but nothing in the bots keeps many of them in memory: the
+pending queues store the outgoing responses, and the endpoints and the batches keep the raw dictionaries, only until
+they are published or handled. The record should be reconsidered if message objects are ever buffered.
+
+Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_compact_message [messages]
+"""
+from __future__ import absolute_import, annotations
+
+import gc
+import json
+import sys
+import tracemalloc
+from typing import Dict, Tuple
+
+from common.callback_messages import MessageBuilder
+from test.benchmark.bench_message_builder import build_workload
+
+
+class SlotsRecord:
+    """
+    Prototype of the compact record: `__slots__` instead of the dictionary of the object, and the attributes stored as
+    a tuple of values whose tuple of names is shared by all the messages with the same layout
+    """
+    __slots__ = ("app_id", "receiver_id", "label", "_keys", "_values")
+
+    _layouts: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+    def __init__(self, app_id: str, receiver_id: str, label: str, attributes: dict) -> None:
+        self.app_id = sys.intern(app_id) if isinstance(app_id, str) else app_id
+        self.receiver_id = receiver_id
+        self.label = sys.intern(label)
+        keys = tuple(attributes)
+        self._keys = self._layouts.setdefault(keys, keys)
+        self._values = tuple(attributes.values())
+
+    @property
+    def attributes(self) -> dict:
+        return dict(zip(self._keys, self._values))
+
+    @staticmethod
+    def from_repr(raw: dict) -> SlotsRecord:
+        message = MessageBuilder.build(raw)
+        return SlotsRecord(message.app_id, message.receiver_id, message.label, message.attributes)
+
+
+def measure(create, count: int) -> int:
+    """
+    :return: the memory retained by the created messages, including their attributes
+    """
+    workload = build_workload()
+    payloads = []
+    for i in range(count):
+        raw_message = dict(workload[i % len(workload)])
+        # every message has its own receiver, as in a fan-out
+        raw_message["receiverId"] = str(i)
+        payloads.append(json.dumps(raw_message))
+    gc.collect()
+    tracemalloc.start()
+    messages = [create(json.loads(payload)) for payload in payloads]
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del messages
+    return current
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, create in [("message objects", MessageBuilder.build), ("raw dictionaries", lambda raw: raw), ("slots records", SlotsRecord.from_repr)]:
+        used = measure(create, count)
+        print(f"{name}: {used / 1024 / 1024:.1f} MiB, {used / count:.0f} bytes per message")
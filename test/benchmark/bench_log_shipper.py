@@ -0,0 +1,71 @@
+"""
+Compare sending the interaction logs inline, as the handlers did, and through the log shipper, against a local HTTP
+stub of the service API answering with a fixed latency.
+Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_log_shipper [messages] [latency_ms]
+"""
+from __future__ import absolute_import, annotations
+
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from common.authentication_event import CreationError
+from common.log_shipper import LogShipper
+
+
+class SlowLogHandler(BaseHTTPRequestHandler):
+
+    latency_sec = 0.02
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency_sec)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServiceApi:
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+    def log_message(self, message) -> None:
+        response = requests.post(self.url, json=message)
+        if response.status_code != 201:
+            raise CreationError(response.status_code, response.text)
+
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    SlowLogHandler.latency_sec = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowLogHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    service_api = StubServiceApi(f"http://127.0.0.1:{server.server_address[1]}/log")
+    try:
+        start = time.perf_counter()
+        for i in range(messages):
+            service_api.log_message({"id": i})
+        inline_sec = time.perf_counter() - start
+        print(f"inline: {inline_sec * 1000:.1f} ms for {messages} messages")
+
+        shipper = LogShipper(workers=4, batch_size=5).start()
+        start = time.perf_counter()
+        for i in range(messages):
+            shipper.ship(service_api, {"id": i})
+        enqueue_sec = time.perf_counter() - start
+        shipper.flush(60)
+        shipped_sec = time.perf_counter() - start
+        shipper.stop()
+        print(f"log shipper: {enqueue_sec * 1000:.1f} ms to enqueue, {shipped_sec * 1000:.1f} ms to deliver, stats {shipper.stats()}")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,105 @@
+"""
+Measure the time spent by `MessageBuilder.build` on a mix of messages similar to the one received from WeNet.
+Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_message_builder [iterations]
+"""
+from __future__ import absolute_import, annotations
+
+import copy
+import sys
+import time
+from collections import Counter
+
+from wenet.model.callback_message.message import Message
+
+from common.callback_messages import MessageBuilder, TextualMessage, TaskConcludedNotification, \
+    TaskVolunteerNotification, TaskProposalNotification, TaskSelectionNotification, IncentiveMessage, IncentiveBadge, \
+    QuestionExpirationMessage, QuestionToAnswerMessage, AnsweredQuestionMessage, AnsweredPickedMessage
+from test.unit.common.mock import raw_callback_messages
+
+
+# relative frequency of the labels: most of the traffic is made of questions and answers
+MIX = {
+    "QuestionToAnswerMessage": 40,
+    "AnsweredQuestionMessage": 20,
+    "TextualMessage": 10,
+    "QuestionExpirationMessage": 8,
+    "AnsweredPickedMessage": 6,
+    "INCENTIVE": 6,
+    "IncentiveMessage": 2,
+    "IncentiveBadge": 2,
+    "TaskProposalNotification": 2,
+    "TaskVolunteerNotification": 2,
+    "TaskSelectionNotification": 1,
+    "TaskConcludedNotification": 1,
+}
+
+
+def chain_build(raw_message: dict) -> Message:
+    """
+    The if/elif chain used by MessageBuilder before the registry, kept for comparison
+    """
+    message_label = raw_message["label"]
+    if message_label == TextualMessage.LABEL:
+        return TextualMessage.from_repr(raw_message)
+    elif message_label == TaskConcludedNotification.LABEL:
+        return TaskConcludedNotification.from_repr(raw_message)
+    elif message_label == TaskVolunteerNotification.LABEL:
+        return TaskVolunteerNotification.from_repr(raw_message)
+    elif message_label == TaskProposalNotification.LABEL:
+        return TaskProposalNotification.from_repr(raw_message)
+    elif message_label == TaskSelectionNotification.LABEL:
+        return TaskSelectionNotification.from_repr(raw_message)
+    elif message_label == IncentiveMessage.LABEL:
+        return IncentiveMessage.from_repr(raw_message)
+    elif message_label == IncentiveBadge.LABEL:
+        return IncentiveBadge.from_repr(raw_message)
+    elif message_label == QuestionExpirationMessage.LABEL:
+        return QuestionExpirationMessage.from_repr(raw_message)
+    elif message_label == "INCENTIVE":
+        if "IncentiveType" in raw_message["attributes"] and raw_message["attributes"]["IncentiveType"] == "Message":
+            return IncentiveMessage.from_repr(raw_message)
+        elif "IncentiveType" in raw_message["attributes"] and raw_message["attributes"]["IncentiveType"] == "Badge":
+            return IncentiveBadge.from_repr(raw_message)
+        else:
+            return Message.from_repr(raw_message)
+    elif message_label == QuestionToAnswerMessage.LABEL:
+        return QuestionToAnswerMessage.from_repr(raw_message)
+    elif message_label == AnsweredQuestionMessage.LABEL:
+        return AnsweredQuestionMessage.from_repr(raw_message)
+    elif message_label == AnsweredPickedMessage.LABEL:
+        return AnsweredPickedMessage.from_repr(raw_message)
+    else:
+        return Message.from_repr(raw_message)
+
+
+def measure(build, workload: list, iterations: int) -> float:
+    # the parsers update the attributes of the raw messages, so each build gets its own copy
+    copies = [copy.deepcopy(workload) for _ in range(iterations)]
+    start = time.perf_counter()
+    for messages in copies:
+        for raw_message in messages:
+            build(raw_message)
+    return time.perf_counter() - start
+
+
+def build_workload() -> list:
+    samples = {}
+    for raw_message in raw_callback_messages():
+        samples.setdefault(raw_message["label"], []).append(raw_message)
+    workload = []
+    for label, weight in MIX.items():
+        for i in range(weight):
+            workload.append(samples[label][i % len(samples[label])])
+    return workload
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workload = build_workload()
+    total = iterations * len(workload)
+    print(f"{total} messages, labels: {dict(Counter(raw_message['label'] for raw_message in workload))}")
+    for name, build in [("if/elif chain", chain_build), ("registry", MessageBuilder.build)]:
+        elapsed = measure(build, workload, iterations)
+        print(f"{name}: {elapsed:.3f}s, {elapsed / total * 1e9:.0f} ns per message")
@@ -0,0 +1,36 @@
+"""
+Compare the size and the decoding time of the events published by the endpoint, with and without the envelope.
+Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_message_envelope [iterations]
+"""
+from __future__ import absolute_import, annotations
+
+import json
+import sys
+import time
+
+from common.callback_messages import MessageBuilder
+from common.message_envelope import MessageEnvelope
+from test.benchmark.bench_message_builder import build_workload
+
+
+def measure(payloads: list, decode, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for payload in payloads:
+            decode(json.loads(payload))
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    messages = [MessageBuilder.build(raw_message) for raw_message in build_workload()]
+    legacy = [json.dumps(message.to_repr()) for message in messages]
+    enveloped = [json.dumps(MessageEnvelope.to_repr(message)) for message in messages]
+    total = iterations * len(messages)
+
+    print(f"average size: legacy {sum(map(len, legacy)) / len(legacy):.0f} bytes, envelope {sum(map(len, enveloped)) / len(enveloped):.0f} bytes")
+    for name, payloads, decode in [("legacy", legacy, MessageBuilder.build), ("envelope", enveloped, MessageEnvelope.build)]:
+        elapsed = measure(payloads, decode, iterations)
+        print(f"{name}: {elapsed:.3f}s, {elapsed / total * 1e9:.0f} ns per message (json decoding included)")
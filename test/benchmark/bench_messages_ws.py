@@ -0,0 +1,115 @@
+"""
+Compare the throughput of the Flask and the ASGI messages web services.
+
+Both apps run locally against a stand-in of the MQTT publisher that blocks for a few milliseconds on each publish,
+like a publish waiting for the broker. Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_messages_ws [requests] [concurrency] [publish_delay_ms]
+"""
+from __future__ import absolute_import, annotations
+
+import json
+import socket
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from werkzeug.serving import make_server
+
+from messages.asgi import AsyncMessageInterface
+from messages.ws import MessageInterface
+from test.unit.messages.mock import MockMqttPublishHandler
+
+
+RAW_MESSAGE = {
+    "appId": 1,
+    "communityId": "",
+    "label": "TextualMessage",
+    "receiverId": "1",
+    "taskId": "5f773c9e34a5436bf1321ef0",
+    "attributes": {
+        "title": "title",
+        "text": "text"
+    }
+}
+
+
+class SlowMqttPublishHandler(MockMqttPublishHandler):
+
+    def __init__(self, delay_sec: float) -> None:
+        super().__init__()
+        self.delay_sec = delay_sec
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def publish_data(self, topic: str, data: dict) -> None:
+        time.sleep(self.delay_sec)
+        with self._lock:
+            self.published += 1
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port: int) -> None:
+    for _ in range(100):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server on port [{port}] did not start")
+
+
+def run_load(port: int, requests: int, concurrency: int) -> float:
+    body = json.dumps(RAW_MESSAGE).encode("utf-8")
+
+    def post(_):
+        request = urllib.request.Request(f"http://127.0.0.1:{port}/message", data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(post, range(requests)))
+    return time.monotonic() - start
+
+
+def bench_flask(requests: int, concurrency: int, delay_sec: float) -> None:
+    publisher = SlowMqttPublishHandler(delay_sec)
+    app = MessageInterface(publisher, "topic", "namespace", "bot", "app", "redirect").get_application()
+    port = free_port()
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_until_up(port)
+    elapsed = run_load(port, requests, concurrency)
+    server.shutdown()
+    print(f"flask: {requests / elapsed:.0f} req/s, published [{publisher.published}]")
+
+
+def bench_asgi(requests: int, concurrency: int, delay_sec: float) -> None:
+    publisher = SlowMqttPublishHandler(delay_sec)
+    app = AsyncMessageInterface(publisher, "topic", "namespace", "bot", "app", "redirect", max_queue_size=requests)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    wait_until_up(port)
+    elapsed = run_load(port, requests, concurrency)
+    server.should_exit = True
+    thread.join()
+    print(f"asgi: {requests / elapsed:.0f} req/s, published [{publisher.published}] after draining")
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    delay_sec = (float(sys.argv[3]) if len(sys.argv) > 3 else 5) / 1000
+    bench_flask(requests, concurrency, delay_sec)
+    bench_asgi(requests, concurrency, delay_sec)
@@ -0,0 +1,68 @@
+"""
+Count the round trips to the OAuth cache needed to get the service API connectors of the users, creating a new
+connector for each message and reusing them from the pool. The cache is a local stub counting the accesses.
+Run it from the repository root with:
+
+    PYTHONPATH=src:. python -m test.benchmark.bench_service_api_pool [messages] [users]
+"""
+from __future__ import absolute_import, annotations
+
+import random
+import sys
+import time
+from typing import List
+
+from wenet.interface.client import Oauth2Client
+from wenet.interface.service_api import ServiceApiInterface
+from wenet.storage.cache import InMemoryCache
+
+from common.service_api_pool import ServiceApiPool
+
+
+class CountingCache(InMemoryCache):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.round_trips = 0
+
+    def get(self, key: str):
+        self.round_trips += 1
+        return super().get(key)
+
+    def cache(self, data: dict, ttl=None, key=None, **kwargs):
+        self.round_trips += 1
+        return super().cache(data, ttl=ttl, key=key, **kwargs)
+
+
+def build_workload(messages: int, users: int) -> List[str]:
+    """
+    :return: the resource IDs of the users receiving the messages, few users receive most of them
+    """
+    rng = random.Random(42)
+    weights = [1 / (i + 1) for i in range(users)]
+    return rng.choices([f"telegram_{i}" for i in range(users)], weights=weights, k=messages)
+
+
+def without_pool(workload: List[str], oauth_cache: CountingCache) -> None:
+    for resource_id in workload:
+        oauth_client = Oauth2Client("app_id", "client_secret", resource_id, oauth_cache, token_endpoint_url="http://127.0.0.1:1")
+        ServiceApiInterface(oauth_client, "http://127.0.0.1:1")
+
+
+def with_pool(workload: List[str], oauth_cache: CountingCache) -> None:
+    pool = ServiceApiPool("app_id", "client_secret", oauth_cache, "http://127.0.0.1:1", "http://127.0.0.1:1", max_size=100)
+    for resource_id in workload:
+        pool.get(resource_id)
+    print(f"  pool stats: {pool.stats()}")
+
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    workload = build_workload(messages, users)
+    for name, run in [("new connector per message", without_pool), ("pooled connectors", with_pool)]:
+        oauth_cache = CountingCache()
+        start = time.perf_counter()
+        run(workload, oauth_cache)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {oauth_cache.round_trips} cache round trips, {elapsed * 1000:.1f} ms for {messages} messages")
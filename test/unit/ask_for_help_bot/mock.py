@@ -1,5 +1,7 @@
 from __future__ import absolute_import, annotations
 
+from unittest.mock import Mock
+
 from chatbot_core.translator.translator import Translator
 from chatbot_core.v3.connector.chatbot_interface import ChatbotInterfaceConnectorV3
 from chatbot_core.v3.connector.social_connectors.telegram_connector import TelegramSocialConnector
@@ -9,7 +11,17 @@ from uhopper.utils.language.detector import LanguageDetector
 from wenet.storage.cache import InMemoryCache
 
 from ask_for_help_bot.handler import AskForHelpHandler
+from ask_for_help_bot.pending_queue_store import PendingQueueStore
+from ask_for_help_bot.pending_users_index import PendingUsersIndex
+from ask_for_help_bot.reminder_scheduler import ReminderScheduler
+from common.cache import InMemoryBotCache
+from common.log_shipper import LogShipper
 from common.messages_to_log import LogMessageHandler
+from common.outbound_scheduler import OutboundScheduler
+from common.service_api_pool import ServiceApiPool
+from common.signed_callback import SignedCallbackCodec
+from common.telegram_api import TelegramApiClient
+from common.user_account_index import UserAccountIndex
 
 
 class MockAskForHelpHandler(AskForHelpHandler):
@@ -27,9 +39,11 @@ class MockAskForHelpHandler(AskForHelpHandler):
         self._interface_connector = ChatbotInterfaceConnectorV3("instance_namespace", "api_key", "host")
         self._language_detector = LanguageDetector.build()
         self._logger_handler = LoggerHandler(None)
-        self.cache = InMemoryCache()
+        self.cache = InMemoryBotCache()
         self.oauth_cache = InMemoryCache()
+        self.user_account_index = UserAccountIndex(InMemoryCache())
         self.telegram_id = "bot_token"
+        self.telegram_api_client = TelegramApiClient(self.telegram_id)
         self.bot_username = "username"
         self.bot_name = "first_name"
         self.wenet_instance_url = "wenet_instance_url"
@@ -47,6 +61,16 @@ class MockAskForHelpHandler(AskForHelpHandler):
         self.channel_id = "channel_id"
         self.publication_language = "en"
         self.max_answers = 15
+        self.pending_users_index = PendingUsersIndex()
+        self.pending_queue_store = PendingQueueStore()
+        self.reminder_scheduler = ReminderScheduler()
+        self.callback_codec = SignedCallbackCodec(b"secret", AskForHelpHandler.SIGNED_BUTTON_SCHEMAS, max_length=59)
+        self.flushed_pending_wenet_messages = 0
         self.expiration_duration = 1
         self.nearby_expiration_duration = 1
         self.message_parser_for_logs = LogMessageHandler(self.app_id, "Telegram")
+        self.log_shipper = LogShipper(workers=0)
+        self.batch_workers = 1
+        self._batch_executor = None
+        self.outbound_scheduler = OutboundScheduler(Mock(), workers=0)
+        self.service_api_pool = ServiceApiPool(self.app_id, self.client_secret, self.oauth_cache, self.wenet_authentication_management_url, self.wenet_instance_url)
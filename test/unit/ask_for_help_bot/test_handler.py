@@ -1,8 +1,9 @@
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List
 from unittest import TestCase
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from chatbot_core.model.context import ConversationContext
 from chatbot_core.model.details import TelegramDetails
@@ -20,8 +21,10 @@ from wenet.model.task.task import Task, TaskGoal
 from wenet.model.task.transaction import TaskTransaction
 from wenet.model.user.profile import WeNetUserProfile
 
+from ask_for_help_bot.pending_conversations import PendingWenetMessage
 from common.button_payload import ButtonPayload
 from common.callback_messages import QuestionExpirationMessage, QuestionToAnswerMessage, AnsweredQuestionMessage, AnsweredPickedMessage
+from common.wenet_event_handler import WenetEventHandler
 from test.unit.ask_for_help_bot.mock import MockAskForHelpHandler
 
 
@@ -51,9 +54,9 @@ class TestAskForHelpHandler(TestCase):
             "user_id"), user_object=WeNetUserProfile.empty("receiver_id"), questioning_user=questioning_user)
         self.assertIsInstance(response, TelegramRapidAnswerResponse)
         self.assertEqual(4, len(response.options))
-        self.assertEqual(4, len(handler.cache._cache))
-        for key in handler.cache._cache:
-            cached_item = handler.cache.get(key)
+        self.assertEqual(1, len(handler.cache._cache))
+        for cached_item in handler.cache._cache.values():
+            self.assertEqual(4, len(cached_item["buttons"]))
             self.assertEqual("task_id", cached_item["payload"]["task_id"])
             self.assertEqual("question", cached_item["payload"]["question"])
             self.assertEqual(True, cached_item["payload"]["sensitive"])
@@ -82,9 +85,9 @@ class TestAskForHelpHandler(TestCase):
             "user_id"), user_object=WeNetUserProfile.empty("receiver_id"), questioning_user=questioning_user)
         self.assertIsInstance(response, TelegramRapidAnswerResponse)
         self.assertEqual(4, len(response.options))
-        self.assertEqual(4, len(handler.cache._cache))
-        for key in handler.cache._cache:
-            cached_item = handler.cache.get(key)
+        self.assertEqual(1, len(handler.cache._cache))
+        for cached_item in handler.cache._cache.values():
+            self.assertEqual(4, len(cached_item["buttons"]))
             self.assertEqual("task_id", cached_item["payload"]["task_id"])
             self.assertEqual("question", cached_item["payload"]["question"])
             self.assertEqual(True, cached_item["payload"]["sensitive"])
@@ -114,9 +117,9 @@ class TestAskForHelpHandler(TestCase):
             "user_id"), user_object=WeNetUserProfile.empty("receiver_id"), questioning_user=questioning_user)
         self.assertIsInstance(response, TelegramRapidAnswerResponse)
         self.assertEqual(4, len(response.options))
-        self.assertEqual(4, len(handler.cache._cache))
-        for key in handler.cache._cache:
-            cached_item = handler.cache.get(key)
+        self.assertEqual(1, len(handler.cache._cache))
+        for cached_item in handler.cache._cache.values():
+            self.assertEqual(4, len(cached_item["buttons"]))
             self.assertEqual("task_id", cached_item["payload"]["task_id"])
             self.assertEqual("question", cached_item["payload"]["question"])
             self.assertEqual(False, cached_item["payload"]["sensitive"])
@@ -147,9 +150,9 @@ class TestAskForHelpHandler(TestCase):
             }), user_object=WeNetUserProfile.empty("questioning_user"), answerer_user=answerer_user)
         self.assertIsInstance(response, TelegramRapidAnswerResponse)
         self.assertEqual(3, len(response.options))
-        self.assertEqual(3, len(handler.cache._cache))
-        for key in handler.cache._cache:
-            cached_item = handler.cache.get(key)
+        self.assertEqual(2, len(handler.cache._cache))
+        self.assertEqual(3, sum(len(cached_item["buttons"]) for cached_item in handler.cache._cache.values()))
+        for cached_item in handler.cache._cache.values():
             self.assertEqual("transaction_id", cached_item["payload"]["transaction_id"])
             self.assertEqual("task_id", cached_item["payload"]["task_id"])
             self.assertEqual("answerer_user", cached_item["payload"]["answerer_user_id"])
@@ -183,9 +186,9 @@ class TestAskForHelpHandler(TestCase):
             }), user_object=WeNetUserProfile.empty("questioning_user"), answerer_user=answerer_user)
         self.assertIsInstance(response, TelegramRapidAnswerResponse)
         self.assertEqual(3, len(response.options))
-        self.assertEqual(3, len(handler.cache._cache))
-        for key in handler.cache._cache:
-            cached_item = handler.cache.get(key)
+        self.assertEqual(2, len(handler.cache._cache))
+        self.assertEqual(3, sum(len(cached_item["buttons"]) for cached_item in handler.cache._cache.values()))
+        for cached_item in handler.cache._cache.values():
             self.assertEqual("transaction_id", cached_item["payload"]["transaction_id"])
             self.assertEqual("task_id", cached_item["payload"]["task_id"])
             self.assertEqual("answerer_user", cached_item["payload"]["answerer_user_id"])
@@ -279,7 +282,39 @@ class TestAskForHelpHandler(TestCase):
         self.assertIsInstance(response, List)
         self.assertEqual(1, len(response))
         self.assertIsInstance(response[0], TelegramRapidAnswerResponse)
-        self.assertEqual(2, len(handler.cache._cache))
+        # the payloads of the buttons are small enough to be signed in their callback data
+        self.assertEqual(0, len(handler.cache._cache))
+
+    def test_flush_pending_wenet_messages_on_leaving_state(self):
+        handler = MockAskForHelpHandler()
+        pending_wenet_message = PendingWenetMessage("pending_wenet_message_id", [TextualResponse("pending")], TelegramDetails(1, 1, ""), deferred=datetime.now())
+        context = ConversationContext(static_context={handler.CONTEXT_CURRENT_STATE: handler.STATE_QUESTION_6})
+        handler.pending_queue_store.push_wenet_message(TelegramDetails(1, 1, ""), pending_wenet_message.to_repr())
+        incoming_event = IncomingTelegramEvent("", TelegramDetails(1, 1, ""), IncomingTextMessage("message_id", int(datetime.now().timestamp()), "user_id", "chat_id", "text"), context)
+
+        def respond(event, text: str) -> OutgoingEvent:
+            outgoing_event = OutgoingEvent(social_details=event.social_details, messages=[TextualResponse(text)])
+            outgoing_event.with_context(event.context)
+            return outgoing_event
+
+        def leave_state(_, event):
+            event.context.delete_static_state(handler.CONTEXT_CURRENT_STATE)
+            return respond(event, "done")
+
+        with patch.object(WenetEventHandler, "_create_response", leave_state):
+            response = handler._create_response(incoming_event)
+        self.assertEqual([TextualResponse("done"), TextualResponse("pending")], response.messages)
+        self.assertEqual(0, response.context.get_static_state(handler.CONTEXT_PENDING_WENET_MESSAGES_COUNT))
+        self.assertEqual(0, handler.pending_queue_store.count_wenet_messages(TelegramDetails(1, 1, "")))
+        self.assertEqual(1, handler.flushed_pending_wenet_messages)
+
+        # the messages are kept while the user is still doing another action
+        context.with_static_state(handler.CONTEXT_CURRENT_STATE, handler.STATE_QUESTION_6)
+        handler.pending_queue_store.push_wenet_message(TelegramDetails(1, 1, ""), pending_wenet_message.to_repr())
+        with patch.object(WenetEventHandler, "_create_response", lambda _, event: respond(event, "next")):
+            response = handler._create_response(incoming_event)
+        self.assertEqual([TextualResponse("next")], response.messages)
+        self.assertEqual(1, handler.pending_queue_store.count_wenet_messages(TelegramDetails(1, 1, "")))
 
     def test_action_question(self):
         handler = MockAskForHelpHandler()
@@ -729,6 +764,26 @@ class TestAskForHelpHandler(TestCase):
         self.assertIsInstance(response.messages[0], TelegramRapidAnswerResponse)
         self.assertEqual(1, len(response.messages[0].options))
 
+    def test_get_telegram_user_cached(self):
+        handler = MockAskForHelpHandler()
+        handler.telegram_api_client.get_chat = Mock(return_value={"id": 1, "username": "user_name"})
+        context = ConversationContext(static_context={handler.CONTEXT_TELEGRAM_USER_ID: 1})
+
+        self.assertEqual("@user\\_name", handler._get_telegram_user(context))
+        self.assertEqual("@user\\_name", handler._get_telegram_user(context))
+        handler.telegram_api_client.get_chat.assert_called_once_with(1)
+
+        # the users without a username are cached too, until they say to have set it
+        handler.telegram_api_client.get_chat = Mock(return_value={"id": 2})
+        context = ConversationContext(static_context={handler.CONTEXT_TELEGRAM_USER_ID: 2})
+        self.assertIsNone(handler._get_telegram_user(context))
+        self.assertIsNone(handler._get_telegram_user(context))
+        handler.telegram_api_client.get_chat.assert_called_once_with(2)
+        handler.telegram_api_client.get_chat = Mock(return_value={"id": 2, "username": "username"})
+        self.assertEqual("@username", handler._get_telegram_user(context, refresh=True))
+        self.assertEqual("@username", handler._get_telegram_user(context))
+        handler.telegram_api_client.get_chat.assert_called_once_with(2)
+
     def test_action_follow_up_1(self):
         handler = MockAskForHelpHandler()
         translator_instance = TranslatorInstance("wenet-ask-for-help", None, handler._alert_module)
@@ -1333,3 +1388,44 @@ class TestAskForHelpHandler(TestCase):
         self.assertIsInstance(response.messages[4], TextualResponse)
         self.assertIsInstance(response.messages[5], TelegramRapidAnswerResponse)
         self.assertEqual(1, len(response.messages[5].options))
+
+    def test_get_user_locale_missing_profile_is_cached(self):
+        handler = MockAskForHelpHandler()
+        service_api = ServiceApiInterface(Oauth2Client("app_id", "app_secret", "id", handler.oauth_cache, token_endpoint_url=""), "")
+        service_api.get_user_profile = Mock(return_value=None)
+        handler._get_service_api_interface_connector_from_context = Mock(return_value=service_api)
+
+        self.assertEqual("en", handler._get_user_locale_from_wenet_id("user_id", context=ConversationContext()))
+        self.assertEqual("en", handler._get_user_locale_from_wenet_id("user_id", context=ConversationContext()))
+        service_api.get_user_profile.assert_called_once_with("user_id")
+
+    def test_get_user_locale_early_refresh(self):
+        handler = MockAskForHelpHandler()
+        profile = WeNetUserProfile.empty("user_id")
+        profile.locale = "it"
+        service_api = ServiceApiInterface(Oauth2Client("app_id", "app_secret", "id", handler.oauth_cache, token_endpoint_url=""), "")
+        service_api.get_user_profile = Mock(return_value=profile)
+        handler._get_service_api_interface_connector_from_context = Mock(return_value=service_api)
+
+        handler.cache.cache({"locale": "en", "delta": 1, "expires_at": datetime.now().timestamp() + 86400}, key=handler.CACHE_LOCALE.format("user_id"))
+        self.assertEqual("en", handler._get_user_locale_from_wenet_id("user_id", context=ConversationContext()))
+        service_api.get_user_profile.assert_not_called()
+
+        # the cached locale is about to expire and it took long to fetch it
+        handler.cache.cache({"locale": "en", "delta": 3600, "expires_at": datetime.now().timestamp() + 1}, key=handler.CACHE_LOCALE.format("user_id"))
+        with patch("ask_for_help_bot.handler.random.random", return_value=0.5):
+            self.assertEqual("it", handler._get_user_locale_from_wenet_id("user_id", context=ConversationContext()))
+        self.assertEqual("it", handler.cache.get(handler.CACHE_LOCALE.format("user_id"))["locale"])
+
+    def test_handle_wenet_batch_keeps_user_order(self):
+        handler = MockAskForHelpHandler()
+        handler._batch_executor = ThreadPoolExecutor(max_workers=4)
+        handled = []
+        handler._handle_wenet_payload = Mock(side_effect=lambda event, payload: handled.append((payload["receiverId"], payload["n"])))
+
+        payloads = [{"receiverId": f"user_{n % 3}", "n": n} for n in range(12)]
+        handler._handle_wenet_batch(Mock(), payloads)
+
+        self.assertEqual(12, len(handled))
+        for user in ["user_0", "user_1", "user_2"]:
+            self.assertEqual([n for n in range(12) if f"user_{n % 3}" == user], [n for receiver, n in handled if receiver == user])
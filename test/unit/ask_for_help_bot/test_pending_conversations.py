@@ -14,6 +14,8 @@ class TestPendingWenetMessage(TestCase):
         social_details = TelegramDetails(1, 1, "bot_id")
         pending_wenet_message = PendingWenetMessage("pending_wenet_message_id", [message], social_details)
         self.assertEqual(PendingWenetMessage.from_repr(pending_wenet_message.to_repr()), pending_wenet_message)
+        pending_wenet_message = PendingWenetMessage("pending_wenet_message_id", [message], social_details, deferred=datetime.now())
+        self.assertEqual(PendingWenetMessage.from_repr(pending_wenet_message.to_repr()), pending_wenet_message)
 
 
 class TestPendingQuestionToAnswer(TestCase):
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, annotations
 
 import datetime
+import time
 import uuid
 from unittest import TestCase
 from unittest.mock import Mock
@@ -20,6 +21,9 @@ from wenet.storage.cache import InMemoryCache
 
 from ask_for_help_bot.pending_conversations import PendingQuestionToAnswer, PendingWenetMessage
 from ask_for_help_bot.pending_messages_job import PendingMessagesJob
+from ask_for_help_bot.pending_queue_store import PendingQueueStore
+from ask_for_help_bot.pending_users_index import PendingUsersIndex
+from ask_for_help_bot.reminder_scheduler import Reminder, ReminderScheduler
 
 
 class TestPendingMessagesJob(TestCase):
@@ -49,7 +53,7 @@ class TestPendingMessagesJob(TestCase):
         message_job._interface_connector.update_user_context.assert_called_once()
         message_job._interface_connector.update_user_context.assert_called_with(UserConversationContext(
             social_details=TelegramDetails(1, 1, "telegram_bot_id"),
-            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_ANSWERS: {}})
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 0, PendingMessagesJob.CONTEXT_PENDING_ANSWERS_COUNT: 0})
         ))
 
     def test_handle_remind_me_later_messages_wrong_repr(self):
@@ -71,7 +75,7 @@ class TestPendingMessagesJob(TestCase):
         message_job._interface_connector.update_user_context.assert_called_once()
         message_job._interface_connector.update_user_context.assert_called_with(UserConversationContext(
             social_details=TelegramDetails(1, 1, "telegram_bot_id"),
-            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_ANSWERS: {}})
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 0, PendingMessagesJob.CONTEXT_PENDING_ANSWERS_COUNT: 0})
         ))
 
     def test_handle_remind_me_later_messages_exception_sending_message(self):
@@ -99,7 +103,7 @@ class TestPendingMessagesJob(TestCase):
         message_job._interface_connector.update_user_context.assert_called_once()
         message_job._interface_connector.update_user_context.assert_called_with(UserConversationContext(
             social_details=TelegramDetails(1, 1, "telegram_bot_id"),
-            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_ANSWERS: {}})
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 0, PendingMessagesJob.CONTEXT_PENDING_ANSWERS_COUNT: 0})
         ))
 
     def test_handle_remind_me_later_messages_is_doing_another_action(self):
@@ -145,7 +149,7 @@ class TestPendingMessagesJob(TestCase):
         message_job._interface_connector.update_user_context.assert_called_once()
         message_job._interface_connector.update_user_context.assert_called_with(UserConversationContext(
             social_details=TelegramDetails(1, 1, "telegram_bot_id"),
-            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES: {}})
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 0, PendingMessagesJob.CONTEXT_PENDING_ANSWERS_COUNT: 0})
         ))
 
     def test_handle_delayed_wenet_messages_wrong_repr(self):
@@ -167,7 +171,7 @@ class TestPendingMessagesJob(TestCase):
         message_job._interface_connector.update_user_context.assert_called_once()
         message_job._interface_connector.update_user_context.assert_called_with(UserConversationContext(
             social_details=TelegramDetails(1, 1, "telegram_bot_id"),
-            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES: {}})
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 0, PendingMessagesJob.CONTEXT_PENDING_ANSWERS_COUNT: 0})
         ))
 
     def test_handle_delayed_wenet_messages_exception_sending_message(self):
@@ -194,7 +198,7 @@ class TestPendingMessagesJob(TestCase):
         message_job._interface_connector.update_user_context.assert_called_once()
         message_job._interface_connector.update_user_context.assert_called_with(UserConversationContext(
             social_details=TelegramDetails(1, 1, "telegram_bot_id"),
-            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES: {}})
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 0, PendingMessagesJob.CONTEXT_PENDING_ANSWERS_COUNT: 0})
         ))
 
     def test_handle_delayed_wenet_messages_is_doing_another_action(self):
@@ -214,3 +218,147 @@ class TestPendingMessagesJob(TestCase):
 
         message_job.send_notification.assert_not_called()
         message_job._interface_connector.update_user_context.assert_not_called()
+
+    def test_execute_with_pending_users_index(self):
+        pending_wenet_message = PendingWenetMessage("wenet_message_id", [TelegramTextualResponse("text")], TelegramDetails(1, 1, "telegram_bot_id"))
+        context = UserConversationContext(
+            social_details=TelegramDetails(1, 1, "telegram_bot_id"),
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES: {"wenet_message_id": pending_wenet_message.to_repr()}})
+        )
+        pending_users_index = PendingUsersIndex()
+        pending_users_index.mark(TelegramDetails(1, 1, "telegram_bot_id"))
+        pending_users_index.mark(TelegramDetails(2, 2, "telegram_bot_id"))
+
+        ChatbotInterfaceConnectorV3.build_from_env = Mock()
+        message_job = PendingMessagesJob("job_id", "instance_namespace", TelegramSocialConnector("bot_token"), logger_connectors=None, app_id="app_id", client_secret="client_secret", oauth_cache=InMemoryCache(), wenet_authentication_management_url="", wenet_instance_url="", pending_users_index=pending_users_index)
+        message_job.INDEX_GRACE_SEC = 0
+        message_job._last_full_scan = time.monotonic()
+        message_job._interface_connector.get_user_contexts = Mock()
+        message_job._interface_connector.get_user_context = Mock(side_effect=lambda social_details: context if social_details.get_user_id() == 1 else UserConversationContext(social_details=social_details, context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_CURRENT_STATE: PendingMessagesJob.STATE_QUESTION_0, PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES: {"wenet_message_id": pending_wenet_message.to_repr()}})))
+        message_job._interface_connector.update_user_context = Mock()
+        message_job.send_notification = Mock()
+        message_job.execute()
+
+        message_job._interface_connector.get_user_contexts.assert_not_called()
+        message_job.send_notification.assert_called_once()
+        # the second user is busy, so its messages are still pending
+        self.assertEqual([2], [social_details.get_user_id() for social_details, _ in pending_users_index.get_all()])
+
+    def test_handle_due_reminders(self):
+        pending_question_to_answer = PendingQuestionToAnswer("question_id", TelegramTextualResponse("text"), TelegramDetails(1, 1, "telegram_bot_id"), sent=datetime.datetime.now())
+        other_question_to_answer = PendingQuestionToAnswer("other_question_id", TelegramTextualResponse("text"), TelegramDetails(1, 1, "telegram_bot_id"), sent=datetime.datetime.now())
+        context = UserConversationContext(
+            social_details=TelegramDetails(1, 1, "telegram_bot_id"),
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_ANSWERS: {"question_id": pending_question_to_answer.to_repr(), "other_question_id": other_question_to_answer.to_repr()}})
+        )
+        busy_context = UserConversationContext(
+            social_details=TelegramDetails(2, 2, "telegram_bot_id"),
+            context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_CURRENT_STATE: PendingMessagesJob.STATE_ANSWERING})
+        )
+        reminder_scheduler = ReminderScheduler()
+
+        ChatbotInterfaceConnectorV3.build_from_env = Mock()
+        message_job = PendingMessagesJob("job_id", "instance_namespace", TelegramSocialConnector("bot_token"), logger_connectors=None, app_id="app_id", client_secret="client_secret", oauth_cache=InMemoryCache(), wenet_authentication_management_url="", wenet_instance_url="", reminder_scheduler=reminder_scheduler)
+        message_job._interface_connector.get_user_context = Mock(side_effect=lambda social_details: context if social_details.get_user_id() == 1 else busy_context)
+        message_job._interface_connector.update_user_context = Mock()
+        message_job.send_notification = Mock()
+        message_job.handle_due_reminders([
+            Reminder(TelegramDetails(1, 1, "telegram_bot_id"), "question_id", time.time()),
+            Reminder(TelegramDetails(2, 2, "telegram_bot_id"), "question_id", time.time())
+        ])
+
+        # only the due question is sent, even if the usual waiting time is not passed
+        message_job.send_notification.assert_called_once()
+        self.assertEqual(["other_question_id"], list(message_job.pending_queue_store.get_answers(TelegramDetails(1, 1, "telegram_bot_id"))))
+        self.assertEqual(1, context.context.get_static_state(PendingMessagesJob.CONTEXT_PENDING_ANSWERS_COUNT))
+        # the reminder of the busy user is scheduled again
+        self.assertEqual(1, reminder_scheduler.stats()["scheduled"])
+
+    def test_execute_in_parallel_on_owned_shards(self):
+        contexts = []
+        for user_id in range(20):
+            pending_wenet_messages = {
+                f"message_{i}": PendingWenetMessage(f"message_{i}", [TelegramTextualResponse(f"text_{i}")], TelegramDetails(user_id, user_id, "telegram_bot_id")).to_repr()
+                for i in range(3)
+            }
+            contexts.append(UserConversationContext(
+                social_details=TelegramDetails(user_id, user_id, "telegram_bot_id"),
+                context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES: pending_wenet_messages})
+            ))
+        shard_lease_manager = Mock()
+        shard_lease_manager.owns = Mock(side_effect=lambda unique_id: unique_id != TelegramDetails(0, 0, "telegram_bot_id").unique_id())
+        shard_lease_manager.owned_shards = Mock(return_value={0})
+        shard_lease_manager.lease_ttl_sec = 300
+
+        ChatbotInterfaceConnectorV3.build_from_env = Mock()
+        message_job = PendingMessagesJob("job_id", "instance_namespace", TelegramSocialConnector("bot_token"), logger_connectors=None, app_id="app_id", client_secret="client_secret", oauth_cache=InMemoryCache(), wenet_authentication_management_url="", wenet_instance_url="", workers=4, shard_lease_manager=shard_lease_manager)
+        message_job._interface_connector.get_user_contexts = Mock(return_value=contexts)
+        message_job._interface_connector.get_user_context = Mock(side_effect=lambda social_details: contexts[social_details.get_user_id()])
+        message_job._interface_connector.update_user_context = Mock()
+        sent = []
+        message_job.send_notification = Mock(side_effect=lambda notification: sent.append((notification.social_details.get_user_id(), notification.messages[0])))
+        message_job.execute()
+
+        shard_lease_manager.refresh.assert_called_once()
+        # the user of a shard owned by another replica is not handled
+        self.assertEqual(19 * 3, len(sent))
+        self.assertNotIn(0, [user_id for user_id, _ in sent])
+        # the messages of each user are sent in order
+        for user_id in range(1, 20):
+            self.assertEqual([TelegramTextualResponse(f"text_{i}") for i in range(3)], [message for sent_user_id, message in sent if sent_user_id == user_id])
+        self.assertEqual(19, message_job.last_run_stats["users"])
+
+    def test_execute_skips_users_of_lost_shards(self):
+        contexts = []
+        for user_id in range(2):
+            pending_wenet_messages = {"message": PendingWenetMessage("message", [TelegramTextualResponse("text")], TelegramDetails(user_id, user_id, "telegram_bot_id")).to_repr()}
+            contexts.append(UserConversationContext(
+                social_details=TelegramDetails(user_id, user_id, "telegram_bot_id"),
+                context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES: pending_wenet_messages})
+            ))
+        shard_lease_manager = Mock()
+        shard_lease_manager.owns = Mock(return_value=True)
+        # the shard of the first user is taken by another replica during the run
+        shard_lease_manager.renew = Mock(side_effect=lambda unique_id: unique_id != TelegramDetails(0, 0, "telegram_bot_id").unique_id())
+        shard_lease_manager.owned_shards = Mock(side_effect=[{0, 1}, {1}, {1}])
+        shard_lease_manager.lease_ttl_sec = 300
+
+        ChatbotInterfaceConnectorV3.build_from_env = Mock()
+        message_job = PendingMessagesJob("job_id", "instance_namespace", TelegramSocialConnector("bot_token"), logger_connectors=None, app_id="app_id", client_secret="client_secret", oauth_cache=InMemoryCache(), wenet_authentication_management_url="", wenet_instance_url="", shard_lease_manager=shard_lease_manager)
+        message_job._interface_connector.get_user_contexts = Mock(return_value=contexts)
+        message_job._interface_connector.get_user_context = Mock(side_effect=lambda social_details: contexts[social_details.get_user_id()])
+        message_job._interface_connector.update_user_context = Mock()
+        message_job.send_notification = Mock()
+        message_job.execute()
+
+        message_job.send_notification.assert_called_once()
+        self.assertEqual(1, message_job.send_notification.call_args[0][0].social_details.get_user_id())
+        self.assertEqual(1, message_job.last_run_stats["lost_shards"])
+
+    def test_handle_delayed_wenet_messages_from_pending_queue_store(self):
+        social_details = TelegramDetails(1, 1, "telegram_bot_id")
+        context = UserConversationContext(social_details=social_details, context=ConversationContext(static_context={PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 2}))
+
+        ChatbotInterfaceConnectorV3.build_from_env = Mock()
+        message_job = PendingMessagesJob("job_id", "instance_namespace", TelegramSocialConnector("bot_token"), logger_connectors=None, app_id="app_id", client_secret="client_secret", oauth_cache=InMemoryCache(), wenet_authentication_management_url="", wenet_instance_url="", pending_queue_store=PendingQueueStore())
+        for i in range(2):
+            message_job.pending_queue_store.push_wenet_message(social_details, PendingWenetMessage(f"message_{i}", [TelegramTextualResponse(f"text_{i}")], social_details).to_repr())
+        message_job._interface_connector.update_user_context = Mock()
+        sent = []
+        message_job.send_notification = Mock(side_effect=lambda notification: sent.append(notification.messages[0]))
+        message_job._handle_delayed_wenet_messages(context)
+
+        self.assertEqual([TelegramTextualResponse("text_0"), TelegramTextualResponse("text_1")], sent)
+        self.assertEqual(0, message_job.pending_queue_store.count_wenet_messages(social_details))
+        self.assertEqual(0, context.context.get_static_state(PendingMessagesJob.CONTEXT_PENDING_WENET_MESSAGES_COUNT))
+        message_job._interface_connector.update_user_context.assert_called_once()
+
+    def test_execute_leaves_reminders_to_scheduler(self):
+        reminder_scheduler = Mock()
+        ChatbotInterfaceConnectorV3.build_from_env = Mock()
+        message_job = PendingMessagesJob("job_id", "instance_namespace", TelegramSocialConnector("bot_token"), logger_connectors=None, app_id="app_id", client_secret="client_secret", oauth_cache=InMemoryCache(), wenet_authentication_management_url="", wenet_instance_url="", pending_users_index=PendingUsersIndex(), reminder_scheduler=reminder_scheduler)
+        message_job._last_full_scan = time.monotonic()
+        message_job.execute()
+
+        # the due reminders are fired only by the thread of the scheduler
+        reminder_scheduler.pop_due.assert_not_called()
@@ -0,0 +1,61 @@
+from __future__ import absolute_import, annotations
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from chatbot_core.model.context import ConversationContext
+from chatbot_core.model.details import TelegramDetails
+from chatbot_core.model.user_context import UserConversationContext
+
+from ask_for_help_bot.pending_queue_store import PendingQueueStore, migrate_all
+from ask_for_help_bot.state_mixin import StateMixin
+
+
+class TestPendingQueueStore(TestCase):
+
+    def test_wenet_messages(self):
+        store = PendingQueueStore()
+        social_details = TelegramDetails(1, 1, "telegram_bot_id")
+        self.assertEqual(1, store.push_wenet_message(social_details, {"pendingWenetMessageId": "1"}))
+        self.assertEqual(2, store.push_wenet_message(social_details, {"pendingWenetMessageId": "2"}))
+        store.push_wenet_message(TelegramDetails(2, 2, "telegram_bot_id"), {"pendingWenetMessageId": "3"})
+
+        self.assertEqual([{"pendingWenetMessageId": "1"}, {"pendingWenetMessageId": "2"}], store.pop_wenet_messages(social_details))
+        self.assertEqual([], store.pop_wenet_messages(social_details))
+        self.assertEqual(1, store.count_wenet_messages(TelegramDetails(2, 2, "telegram_bot_id")))
+
+    def test_answers(self):
+        store = PendingQueueStore()
+        social_details = TelegramDetails(1, 1, "telegram_bot_id")
+        store.put_answer(social_details, "question_1", {"questionId": "question_1"})
+        self.assertEqual(2, store.put_answer(social_details, "question_2", {"questionId": "question_2"}))
+
+        self.assertEqual({"question_1": {"questionId": "question_1"}}, store.pop_answers(social_details, ["question_1", "question_3"]))
+        self.assertEqual({"question_2": {"questionId": "question_2"}}, store.get_answers(social_details))
+        self.assertEqual(1, store.count_answers(social_details))
+
+    def test_migrate(self):
+        store = PendingQueueStore()
+        social_details = TelegramDetails(1, 1, "telegram_bot_id")
+        context = ConversationContext(static_context={
+            StateMixin.CONTEXT_PENDING_WENET_MESSAGES: {"1": {"pendingWenetMessageId": "1"}},
+            StateMixin.CONTEXT_PENDING_ANSWERS: {"question_1": {"questionId": "question_1"}}
+        })
+
+        self.assertTrue(store.migrate(social_details, context))
+        self.assertEqual(ConversationContext(static_context={StateMixin.CONTEXT_PENDING_WENET_MESSAGES_COUNT: 1, StateMixin.CONTEXT_PENDING_ANSWERS_COUNT: 1}), context)
+        self.assertEqual([{"pendingWenetMessageId": "1"}], store.pop_wenet_messages(social_details))
+        self.assertEqual({"question_1": {"questionId": "question_1"}}, store.get_answers(social_details))
+        # a migrated context is not modified again
+        self.assertFalse(store.migrate(social_details, context))
+
+    def test_migrate_all(self):
+        store = PendingQueueStore()
+        interface_connector = Mock()
+        interface_connector.get_user_contexts = Mock(return_value=[
+            UserConversationContext(social_details=TelegramDetails(1, 1, "telegram_bot_id"), context=ConversationContext(static_context={StateMixin.CONTEXT_PENDING_ANSWERS: {}})),
+            UserConversationContext(social_details=TelegramDetails(2, 2, "telegram_bot_id"), context=ConversationContext(static_context={}))
+        ])
+
+        self.assertEqual(1, migrate_all(store, interface_connector, "instance_namespace", "bot_id"))
+        interface_connector.update_user_context.assert_called_once()
@@ -0,0 +1,29 @@
+from __future__ import absolute_import, annotations
+
+from unittest import TestCase
+
+from chatbot_core.model.details import TelegramDetails
+
+from ask_for_help_bot.pending_users_index import PendingUsersIndex
+
+
+class TestPendingUsersIndex(TestCase):
+
+    def test_mark_and_remove(self):
+        index = PendingUsersIndex()
+        index.mark(TelegramDetails(1, 1, "telegram_bot_id"))
+        index.mark(TelegramDetails(2, 2, "telegram_bot_id"))
+        index.mark(TelegramDetails(1, 1, "telegram_bot_id"))
+        self.assertEqual(2, index.size())
+
+        users = dict((social_details.get_user_id(), version) for social_details, version in index.get_all())
+        self.assertTrue(index.remove(TelegramDetails(1, 1, "telegram_bot_id"), users[1]))
+        self.assertEqual([2], [social_details.get_user_id() for social_details, _ in index.get_all()])
+
+    def test_remove_marked_again(self):
+        index = PendingUsersIndex()
+        index.mark(TelegramDetails(1, 1, "telegram_bot_id"))
+        _, version = index.get_all()[0]
+        index._local[next(iter(index._local))] = repr(index.marked_at(version) + 1)
+        self.assertFalse(index.remove(TelegramDetails(1, 1, "telegram_bot_id"), version))
+        self.assertEqual(1, index.size())
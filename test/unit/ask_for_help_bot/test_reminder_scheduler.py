@@ -0,0 +1,48 @@
+from __future__ import absolute_import, annotations
+
+import threading
+import time
+from unittest import TestCase
+
+from chatbot_core.model.details import TelegramDetails
+
+from ask_for_help_bot.reminder_scheduler import Reminder, ReminderScheduler
+
+
+class TestReminderScheduler(TestCase):
+
+    def test_pop_due(self):
+        scheduler = ReminderScheduler(tick_sec=0.01)
+        scheduler.schedule(Reminder(TelegramDetails(1, 1, "telegram_bot_id"), "question_1", time.time() - 1))
+        scheduler.schedule(Reminder(TelegramDetails(1, 1, "telegram_bot_id"), "question_2", time.time() + 60))
+        reminders = scheduler.pop_due()
+        self.assertEqual(["question_1"], [reminder.question_id for reminder in reminders])
+        self.assertEqual(1, reminders[0].social_details.get_user_id())
+        self.assertEqual([], scheduler.pop_due())
+        stats = scheduler.stats()
+        self.assertEqual(1, stats["scheduled"])
+        self.assertEqual(1, stats["fired"])
+        self.assertGreaterEqual(stats["max_lag_sec"], 1)
+
+    def test_schedule_again(self):
+        scheduler = ReminderScheduler(tick_sec=0.01)
+        scheduler.schedule(Reminder(TelegramDetails(1, 1, "telegram_bot_id"), "question_1", time.time() - 1))
+        scheduler.schedule(Reminder(TelegramDetails(1, 1, "telegram_bot_id"), "question_1", time.time() + 60))
+        self.assertEqual([], scheduler.pop_due())
+        self.assertEqual(1, scheduler.stats()["scheduled"])
+
+    def test_thread_fires_when_due(self):
+        scheduler = ReminderScheduler(tick_sec=0.01)
+        fired = []
+        done = threading.Event()
+
+        def callback(reminders):
+            fired.extend(reminders)
+            done.set()
+
+        scheduler.start(callback)
+        scheduler.schedule(Reminder(TelegramDetails(1, 1, "telegram_bot_id"), "question_1", time.time() + 0.05))
+        self.assertTrue(done.wait(5))
+        scheduler.stop()
+        self.assertEqual(["question_1"], [reminder.question_id for reminder in fired])
+        self.assertLess(scheduler.stats()["max_lag_sec"], 1)
@@ -0,0 +1,98 @@
+from __future__ import absolute_import, annotations
+
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeTelegramServer:
+    """
+    Local HTTP server answering like the Telegram Bot API, for testing the clients of the API without the network.
+
+    It answers `getMe`, `getChat` and `sendMessage`, recording the time and the parameters of each request. The next
+    requests can be throttled with a "Too Many Requests" response, or failed with a server error.
+    """
+
+    def __init__(self, token: str = "token") -> None:
+        self.token = token
+        self.requests: List[Tuple[float, str, dict]] = []
+        self._lock = Lock()
+        self._throttled = 0
+        self._retry_after = 1
+        self._failed = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread: Optional[Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/bot{self.token}"
+
+    def start(self) -> FakeTelegramServer:
+        self._thread = Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def throttle_next(self, requests: int, retry_after: int = 1) -> None:
+        with self._lock:
+            self._throttled = requests
+            self._retry_after = retry_after
+
+    def fail_next(self, requests: int) -> None:
+        with self._lock:
+            self._failed = requests
+
+    def requests_of(self, method: str) -> List[Tuple[float, dict]]:
+        with self._lock:
+            return [(at, params) for at, request_method, params in self.requests if request_method == method]
+
+    def _answer(self, method: str, params: dict) -> Tuple[int, dict]:
+        with self._lock:
+            self.requests.append((time.monotonic(), method, params))
+            if self._failed > 0:
+                self._failed -= 1
+                return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+            if self._throttled > 0:
+                self._throttled -= 1
+                return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self._retry_after}", "parameters": {"retry_after": self._retry_after}}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "first_name", "username": "username"}}
+        if method == "getChat":
+            return 200, {"ok": True, "result": {"id": int(params["chat_id"]), "type": "private", "first_name": "user", "username": f"user_{params['chat_id']}"}}
+        if method == "sendMessage":
+            return 200, {"ok": True, "result": {"message_id": len(self.requests), "chat": {"id": params.get("chat_id")}, "text": params.get("text")}}
+        return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _handle(self, params: dict) -> None:
+                path = urlparse(self.path)
+                params.update({key: values[0] for key, values in parse_qs(path.query).items()})
+                status, body = server._answer(path.path.rsplit("/", 1)[-1], params)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self) -> None:
+                self._handle({})
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                self._handle(json.loads(self.rfile.read(length)) if length else {})
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
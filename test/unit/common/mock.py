@@ -0,0 +1,25 @@
+from __future__ import absolute_import, annotations
+
+from typing import List
+
+
+def raw_callback_messages() -> List[dict]:
+    """
+    One raw message for each type of message received from WeNet
+    """
+    return [
+        {"appId": "app", "receiverId": "1", "label": "QuestionExpirationMessage", "attributes": {"taskId": "task", "question": "question?", "listOfTransactionIds": ["t1", "t2"]}},
+        {"appId": "app", "receiverId": "1", "label": "TextualMessage", "attributes": {"title": "title", "text": "text", "communityId": "community"}},
+        {"appId": "app", "receiverId": "1", "label": "TaskProposalNotification", "attributes": {"taskId": "task", "communityId": "community"}},
+        {"appId": "app", "receiverId": "1", "label": "TaskVolunteerNotification", "attributes": {"taskId": "task", "volunteerId": "2"}},
+        {"appId": "app", "receiverId": "1", "label": "TaskSelectionNotification", "attributes": {"taskId": "task", "outcome": "accepted"}},
+        {"appId": "app", "receiverId": "1", "label": "TaskConcludedNotification", "attributes": {"taskId": "task", "outcome": "completed"}},
+        {"appId": "app", "receiverId": "1", "label": "IncentiveMessage", "attributes": {"issuer": "issuer", "content": "content"}},
+        {"appId": "app", "receiverId": "1", "label": "INCENTIVE", "attributes": {"IncentiveType": "Message", "Issuer": "issuer", "Message": {"content": "content"}}},
+        {"appId": "app", "receiverId": "1", "label": "IncentiveBadge", "attributes": {"issuer": "issuer", "badgeClass": "class", "imageUrl": "url", "criteria": "criteria", "message": "message"}},
+        {"appId": "app", "receiverId": "1", "label": "INCENTIVE", "attributes": {"IncentiveType": "Badge", "Issuer": "issuer", "Badge": {"BadgeClass": "class", "ImgUrl": "url", "Criteria": "criteria", "Message": "message"}}},
+        {"appId": "app", "receiverId": "1", "label": "QuestionToAnswerMessage", "attributes": {"taskId": "task", "question": "question?", "userId": "2"}},
+        {"appId": "app", "receiverId": "1", "label": "AnsweredQuestionMessage", "attributes": {"taskId": "task", "answer": "answer", "transactionId": "t1", "userId": "2"}},
+        {"appId": "app", "receiverId": "1", "label": "AnsweredPickedMessage", "attributes": {"taskId": "task", "transactionId": "t1"}},
+        {"appId": "app", "receiverId": "1", "label": "UnknownMessage", "attributes": {"key": "value"}},
+    ]
@@ -0,0 +1,197 @@
+from __future__ import absolute_import, annotations
+
+import json
+from threading import Barrier, Thread
+from unittest import TestCase
+from unittest.mock import Mock
+
+from common.button_payload import ButtonPayload
+from common.cache import BUTTON_CONSUMED_TTL, BotCache, ButtonAlreadyConsumedError, InMemoryBotCache, NearCache, is_group_button
+from common.cache_codec import MsgpackCodec
+
+
+class TestBotCache(TestCase):
+
+    def test_cache_many_single_round_trip(self):
+        r = Mock()
+        cache = BotCache(r)
+        cache.cache_many({"key1": {"a": 1}, "key2": {"b": 2}, "key3": {"c": 3}}, ttl=60)
+        r.pipeline.assert_called_once_with(transaction=False)
+        r.pipeline.return_value.execute.assert_called_once()
+        r.set.assert_not_called()
+
+    def test_cache_many_empty(self):
+        r = Mock()
+        cache = BotCache(r)
+        cache.cache_many({})
+        r.pipeline.assert_not_called()
+
+    def test_in_memory_cache_many(self):
+        cache = InMemoryBotCache()
+        cache.cache_many({"key1": {"a": 1}, "key2": {"b": 2}})
+        self.assertEqual({"a": 1}, cache.get("key1"))
+        self.assertEqual({"b": 2}, cache.get("key2"))
+
+    def test_button_group(self):
+        cache = InMemoryBotCache()
+        button_ids = cache.cache_button_group({"task_id": "task_id"}, [ButtonPayload({"order": "#1"}, "intent_1"), ButtonPayload({}, "intent_2")])
+        self.assertEqual(2, len(button_ids))
+        self.assertTrue(all(is_group_button(button_id) for button_id in button_ids))
+        self.assertEqual(1, len(cache._cache))
+        button_payload = cache.consume_group_button(button_ids[0])
+        self.assertEqual("intent_1", button_payload.intent)
+        self.assertEqual({"task_id": "task_id", "order": "#1"}, button_payload.payload)
+        self.assertEqual(0, len(cache._cache))
+        with self.assertRaises(ButtonAlreadyConsumedError):
+            cache.consume_group_button(button_ids[1])
+
+    def test_button_group_expired(self):
+        cache = InMemoryBotCache()
+        self.assertIsNone(cache.consume_group_button("0123456789abcdef0123456789abcdef-0"))
+
+    def test_consume(self):
+        cache = InMemoryBotCache()
+        cache.cache({"intent": "intent", "payload": {}}, key="key")
+        self.assertEqual({"intent": "intent", "payload": {}}, cache.consume("key"))
+        with self.assertRaises(ButtonAlreadyConsumedError):
+            cache.consume("key")
+        self.assertIsNone(cache.consume("expired_key"))
+
+    def test_parallel_clicks(self):
+        cache = InMemoryBotCache()
+        button_ids = cache.cache_button_group({"task_id": "task_id"}, [ButtonPayload({}, "intent_1"), ButtonPayload({}, "intent_2")])
+        start = Barrier(8)
+        results = []
+
+        def click(button_id: str) -> None:
+            start.wait()
+            try:
+                results.append(cache.consume_group_button(button_id))
+            except ButtonAlreadyConsumedError:
+                results.append("already_consumed")
+
+        threads = [Thread(target=click, args=(button_ids[i % 2],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len([result for result in results if isinstance(result, ButtonPayload)]))
+        self.assertEqual(7, results.count("already_consumed"))
+
+    def test_button_group_single_key(self):
+        r = Mock()
+        cache = BotCache(r)
+        button_ids = cache.cache_button_group({"task_id": "task_id"}, [ButtonPayload({}, "intent_1"), ButtonPayload({}, "intent_2")], ttl=60)
+        group_id = button_ids[0].rsplit("-", 1)[0]
+        self.assertEqual([f"{group_id}-0", f"{group_id}-1"], button_ids)
+        pipeline = r.pipeline.return_value
+        pipeline.hset.assert_called_once()
+        pipeline.expire.assert_called_once()
+        self.assertEqual({"payload", "0", "1"}, set(pipeline.hset.call_args[1]["mapping"].keys()))
+
+    def test_consume_group_button(self):
+        r = Mock()
+        consume_group_button = Mock(return_value=[json.dumps({"task_id": "task_id"}), json.dumps({"intent": "intent_2", "extra": {"order": "#2"}})])
+        r.register_script.side_effect = lambda script: consume_group_button if "HMGET" in script else Mock()
+        cache = BotCache(r)
+        button_payload = cache.consume_group_button("0123456789abcdef0123456789abcdef-1")
+        consume_group_button.assert_called_once_with(keys=["button-group-0123456789abcdef0123456789abcdef", "button-consumed-0123456789abcdef0123456789abcdef"], args=["payload", "1", BUTTON_CONSUMED_TTL, "1"])
+        self.assertEqual("intent_2", button_payload.intent)
+        self.assertEqual({"task_id": "task_id", "order": "#2"}, button_payload.payload)
+        consume_group_button.return_value = 1
+        with self.assertRaises(ButtonAlreadyConsumedError):
+            cache.consume_group_button("0123456789abcdef0123456789abcdef-0")
+        consume_group_button.return_value = 0
+        self.assertIsNone(cache.consume_group_button("0123456789abcdef0123456789abcdef-0"))
+
+    def test_is_group_button(self):
+        self.assertTrue(is_group_button("0123456789abcdef0123456789abcdef-3"))
+        self.assertFalse(is_group_button("01234567-89ab-cdef-0123-456789abcdef"))
+
+    def test_codec(self):
+        r = Mock()
+        cache = BotCache(r, codec=MsgpackCodec())
+        cache.cache({"locale": "en"}, ttl=60, key="key")
+        raw = r.set.call_args[0][1]
+        self.assertEqual(MsgpackCodec.VERSION_MSGPACK, raw[0])
+        r.get.return_value = raw
+        self.assertEqual({"locale": "en"}, cache.get("key"))
+        r.get.return_value = json.dumps({"locale": "it"}).encode("utf-8")
+        self.assertEqual({"locale": "it"}, cache.get("key"))
+
+
+class TestNearCache(TestCase):
+
+    def test_get_from_memory(self):
+        inner = InMemoryBotCache()
+        inner.get = Mock(wraps=inner.get)
+        cache = NearCache(inner)
+        cache.cache({"locale": "en"}, key="key")
+        self.assertEqual({"locale": "en"}, cache.get("key"))
+        inner.get.assert_not_called()
+        self.assertIsNone(cache.get("missing"))
+        self.assertEqual({"size": 1, "hits": 1, "misses": 1, "hit_ratio": 0.5, "evictions": 0, "invalidations": 0}, cache.stats())
+
+    def test_values_are_copied(self):
+        cache = NearCache(InMemoryBotCache())
+        data = {"answers": ["first"]}
+        cache.cache(data, key="key")
+        data["answers"].append("changed by the writer")
+        cache.get("key")["answers"].append("changed by a reader")
+        self.assertEqual({"answers": ["first"]}, cache.get("key"))
+        self.assertEqual(2, cache.stats()["hits"])
+
+    def test_ttl_and_eviction(self):
+        now = [0.0]
+        inner = InMemoryBotCache()
+        cache = NearCache(inner, max_size=2, ttl_sec=10, now=lambda: now[0])
+        cache.cache({"a": 1}, key="key1")
+        cache.cache({"b": 2}, key="key2")
+        cache.cache({"c": 3}, key="key3")
+        self.assertEqual(1, cache.stats()["evictions"])
+        self.assertEqual({"a": 1}, cache.get("key1"))  # read again from the inner cache
+        self.assertEqual(1, cache.stats()["misses"])
+        now[0] = 11
+        self.assertEqual({"c": 3}, cache.get("key3"))
+        self.assertEqual(2, cache.stats()["misses"])
+
+    def test_stats_are_logged(self):
+        cache = NearCache(InMemoryBotCache(), stats_log_interval=2)
+        cache.cache({"locale": "en"}, key="key")
+        with self.assertLogs("uhopper.chatbot.wenet.cache", level="INFO") as logs:
+            cache.get("key")
+            cache.get("missing")
+            cache.get("key")
+        self.assertEqual(["INFO:uhopper.chatbot.wenet.cache:Near cache statistics: {'size': 1, 'hits': 1, 'misses': 1, 'hit_ratio': 0.5, 'evictions': 0, 'invalidations': 0}"], logs.output)
+
+    def test_consume_group_button_from_memory(self):
+        inner = InMemoryBotCache()
+        inner.consume_group_button = Mock(wraps=inner.consume_group_button)
+        cache = NearCache(inner)
+        button_ids = cache.cache_button_group({"task_id": "task_id"}, [ButtonPayload({"order": "#1"}, "intent_1"), ButtonPayload({}, "intent_2")])
+        button_payload = cache.consume_group_button(button_ids[0])
+        self.assertEqual("intent_1", button_payload.intent)
+        self.assertEqual({"task_id": "task_id", "order": "#1"}, button_payload.payload)
+        self.assertEqual(1, cache.stats()["hits"])
+        # the group is claimed in the inner cache, shared with the other replicas
+        self.assertEqual(0, len(inner._cache))
+        with self.assertRaises(ButtonAlreadyConsumedError):
+            cache.consume_group_button(button_ids[1])
+
+    def test_invalidation_broadcast(self):
+        r = Mock()
+        cache = NearCache(InMemoryBotCache(), r=r)
+        other_cache = NearCache(InMemoryBotCache(), r=r)
+        other_cache.cache({"locale": "en"}, key="key")
+        cache.remove("key")
+        channel, message = r.publish.call_args[0]
+        self.assertEqual(NearCache.CHANNEL, channel)
+        cache.on_invalidation(message)  # own invalidations are ignored
+        other_cache.on_invalidation(message)
+        self.assertEqual(0, other_cache.stats()["size"])
+        self.assertEqual(1, other_cache.stats()["invalidations"])
+
+    def test_mark_consumed(self):
+        cache = NearCache(InMemoryBotCache())
+        self.assertTrue(cache.mark_consumed("nonce"))
+        self.assertFalse(cache.mark_consumed("nonce"))
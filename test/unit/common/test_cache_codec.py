@@ -0,0 +1,45 @@
+from __future__ import absolute_import, annotations
+
+import json
+from unittest import TestCase
+
+from common.cache_codec import JsonCodec, MsgpackCodec
+
+
+class TestMsgpackCodec(TestCase):
+
+    PAYLOAD = {
+        "payload": {
+            "task_id": "62a1b2c3d4e5f60718293a4b",
+            "question": "Where can I find a quiet place to study near the campus?",
+            "sensitive": False,
+            "username": "name",
+            "related_buttons": ["a4c1e6a2-0f5e-4c3b-9a51-2f0f5b1f4b7e", "0d3e4f0a-8c63-4bd4-a0a6-6c3c1f44e2bd"],
+        },
+        "intent": "answer_question",
+    }
+
+    def test_encode_decode(self):
+        codec = MsgpackCodec()
+        raw = codec.encode(self.PAYLOAD)
+        self.assertEqual(MsgpackCodec.VERSION_MSGPACK, raw[0])
+        self.assertLess(len(raw), len(json.dumps(self.PAYLOAD)))
+        self.assertEqual(self.PAYLOAD, codec.decode(raw))
+
+    def test_compression(self):
+        codec = MsgpackCodec(zstd_threshold=64)
+        payload = dict(self.PAYLOAD, question="question " * 100)
+        raw = codec.encode(payload)
+        self.assertEqual(MsgpackCodec.VERSION_MSGPACK_ZSTD, raw[0])
+        self.assertLess(len(raw), len(json.dumps(payload)) / 4)
+        self.assertEqual(payload, codec.decode(raw))
+
+    def test_no_compression(self):
+        codec = MsgpackCodec(zstd_threshold=None)
+        payload = dict(self.PAYLOAD, question="question " * 100)
+        self.assertEqual(MsgpackCodec.VERSION_MSGPACK, codec.encode(payload)[0])
+
+    def test_decode_legacy_json(self):
+        codec = MsgpackCodec()
+        self.assertEqual(self.PAYLOAD, codec.decode(JsonCodec().encode(self.PAYLOAD)))
+        self.assertEqual(self.PAYLOAD, codec.decode(json.dumps(self.PAYLOAD)))
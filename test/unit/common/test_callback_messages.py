@@ -0,0 +1,35 @@
+from __future__ import absolute_import, annotations
+
+from unittest import TestCase
+
+from wenet.model.callback_message.message import Message
+
+from common.callback_messages import MessageBuilder, QuestionExpirationMessage, TextualMessage, \
+    TaskProposalNotification, TaskVolunteerNotification, TaskSelectionNotification, TaskConcludedNotification, \
+    IncentiveMessage, IncentiveBadge, QuestionToAnswerMessage, AnsweredQuestionMessage, AnsweredPickedMessage
+from test.unit.common.mock import raw_callback_messages
+
+
+class TestMessageBuilder(TestCase):
+
+    def test_build(self):
+        expected_types = [QuestionExpirationMessage, TextualMessage, TaskProposalNotification,
+                          TaskVolunteerNotification, TaskSelectionNotification, TaskConcludedNotification,
+                          IncentiveMessage, IncentiveMessage, IncentiveBadge, IncentiveBadge, QuestionToAnswerMessage,
+                          AnsweredQuestionMessage, AnsweredPickedMessage, Message]
+        messages = [MessageBuilder.build(raw_message) for raw_message in raw_callback_messages()]
+        self.assertEqual(expected_types, [type(message) for message in messages])
+
+    def test_build_incentive_without_type(self):
+        message = MessageBuilder.build({"appId": "app", "receiverId": "1", "label": "INCENTIVE", "attributes": {}})
+        self.assertEqual(Message, type(message))
+
+    def test_missing_label(self):
+        with self.assertRaises(KeyError):
+            MessageBuilder.build({"appId": "app", "receiverId": "1", "attributes": {}})
+
+    def test_conflicting_registration(self):
+        with self.assertRaises(ValueError):
+            MessageBuilder.register()(TextualMessage)
+        with self.assertRaises(ValueError):
+            MessageBuilder.register("INCENTIVE", discriminator=("IncentiveType", "Badge"))(IncentiveMessage)
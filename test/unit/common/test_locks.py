@@ -0,0 +1,67 @@
+from __future__ import absolute_import, annotations
+
+import threading
+import time
+from unittest import TestCase
+
+from common.locks import StripedLock
+
+
+class TestStripedLock(TestCase):
+
+    def test_same_key_same_stripe(self):
+        lock = StripedLock(16)
+        self.assertEqual(lock.stripe_for("123"), lock.stripe_for("123"))
+        self.assertTrue(0 <= lock.stripe_for("123") < 16)
+
+    def test_invalid_stripes(self):
+        with self.assertRaises(ValueError):
+            StripedLock(0)
+
+    def test_same_key_is_serialized(self):
+        lock = StripedLock(16)
+        inside = []
+        overlaps = []
+
+        def worker():
+            with lock.acquire("user"):
+                inside.append(1)
+                if len(inside) > 1:
+                    overlaps.append(1)
+                time.sleep(0.01)
+                inside.pop()
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], overlaps)
+        stats = lock.stats()[lock.stripe_for("user")]
+        self.assertEqual(5, stats["acquisitions"])
+        self.assertGreater(stats["contentions"], 0)
+        self.assertEqual(5, sum(stats["wait_histogram"].values()))
+
+    def test_different_stripes_run_in_parallel(self):
+        lock = StripedLock(64)
+        first_key = "user_1"
+        second_key = next(f"user_{i}" for i in range(2, 1000) if lock.stripe_for(f"user_{i}") != lock.stripe_for(first_key))
+        entered = threading.Event()
+        release = threading.Event()
+
+        def holder():
+            with lock.acquire(first_key):
+                entered.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        entered.wait(5)
+        with lock.acquire(second_key):
+            acquired_while_held = not release.is_set()
+        release.set()
+        thread.join()
+
+        self.assertTrue(acquired_while_held)
+        self.assertEqual(0, lock.stats()[lock.stripe_for(second_key)]["contentions"])
@@ -0,0 +1,87 @@
+from __future__ import absolute_import, annotations
+
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+
+from wenet.interface.exceptions import RefreshTokenExpiredError
+
+from common.authentication_event import CreationError
+from common.log_shipper import LogShipper
+
+
+class TestLogShipper(TestCase):
+
+    def test_synchronous_without_workers(self):
+        shipper = LogShipper(workers=0).start()
+        service_api = Mock()
+        shipper.ship(service_api, "message")
+        service_api.log_message.assert_called_once_with("message")
+        self.assertEqual(1, shipper.stats()["sent"])
+
+    def test_background_delivery(self):
+        shipper = LogShipper(workers=2, batch_size=5).start()
+        service_api = Mock()
+        for i in range(20):
+            shipper.ship(service_api, f"message_{i}")
+        self.assertTrue(shipper.flush(5))
+        shipper.stop()
+        self.assertEqual(20, service_api.log_message.call_count)
+        self.assertEqual(20, shipper.stats()["sent"])
+
+    def test_retry_and_failure(self):
+        shipper = LogShipper(workers=0, max_retries=2, backoff_sec=0)
+        service_api = Mock()
+        service_api.log_message.side_effect = [ConnectionError(), None]
+        shipper.ship(service_api, "message")
+        self.assertEqual(1, shipper.stats()["retried"])
+        self.assertEqual(1, shipper.stats()["sent"])
+
+        service_api.log_message.side_effect = CreationError(400, "bad request")
+        shipper.ship(service_api, "message")
+        self.assertEqual(1, shipper.stats()["retried"])
+        self.assertEqual(1, shipper.stats()["failed"])
+
+        service_api.log_message.side_effect = CreationError(503, "unavailable")
+        shipper.ship(service_api, "message")
+        self.assertEqual(3, shipper.stats()["retried"])
+        self.assertEqual(2, shipper.stats()["failed"])
+
+    def test_refresh_token_expired(self):
+        on_refresh_token_expired = Mock()
+        shipper = LogShipper(workers=0, on_refresh_token_expired=on_refresh_token_expired)
+        service_api = Mock()
+        service_api.log_message.side_effect = RefreshTokenExpiredError()
+        shipper.ship(service_api, Mock())
+        on_refresh_token_expired.assert_called_once_with(service_api)
+        self.assertEqual(0, shipper.stats()["retried"])
+        self.assertEqual(1, shipper.stats()["failed"])
+
+    def test_drop_oldest_when_full(self):
+        shipper = LogShipper(max_queue_size=2, workers=1).start()
+        release = threading.Event()
+        service_api = Mock()
+        service_api.log_message.side_effect = lambda message: release.wait(5)
+        shipper.ship(service_api, "blocking")
+        deadline = time.monotonic() + 5
+        while shipper.stats()["queued"] > 0 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        for message in ["first", "second", "third"]:
+            shipper.ship(service_api, message)
+        release.set()
+        self.assertTrue(shipper.flush(5))
+        shipper.stop()
+        sent = [call.args[0] for call in service_api.log_message.call_args_list]
+        self.assertEqual(["blocking", "second", "third"], sent)
+        self.assertEqual(1, shipper.stats()["dropped"])
+
+    def test_stop_drains_the_queue(self):
+        shipper = LogShipper(workers=1, batch_size=2).start()
+        service_api = Mock()
+        service_api.log_message.side_effect = lambda message: time.sleep(0.001)
+        for i in range(10):
+            shipper.ship(service_api, f"message_{i}")
+        shipper.stop(5)
+        self.assertEqual([f"message_{i}" for i in range(10)], [call.args[0] for call in service_api.log_message.call_args_list])
+        self.assertEqual({"queued": 0, "sent": 10}, {key: shipper.stats()[key] for key in ["queued", "sent"]})
@@ -0,0 +1,40 @@
+from __future__ import absolute_import, annotations
+
+import json
+from unittest import TestCase
+
+from common.callback_messages import MessageBuilder, IncentiveBadge
+from common.message_envelope import MessageEnvelope
+from test.unit.common.mock import raw_callback_messages
+
+
+class TestMessageEnvelope(TestCase):
+
+    def test_round_trip(self):
+        for raw_message in raw_callback_messages():
+            message = MessageBuilder.build(raw_message)
+            # the envelope travels as json
+            raw_envelope = json.loads(json.dumps(MessageEnvelope.to_repr(message)))
+            built = MessageEnvelope.from_repr(raw_envelope)
+            self.assertIsNotNone(built)
+            self.assertEqual(type(message), type(built))
+            self.assertEqual(message.to_repr(), built.to_repr())
+
+    def test_normalized_fields(self):
+        raw_message = next(raw for raw in raw_callback_messages() if raw["label"] == "INCENTIVE" and raw["attributes"]["IncentiveType"] == "Badge")
+        built = MessageEnvelope.from_repr(json.loads(json.dumps(MessageEnvelope.to_repr(MessageBuilder.build(raw_message)))))
+        self.assertIsInstance(built, IncentiveBadge)
+        self.assertEqual("class", built.badge_class)
+        self.assertEqual("url", built.image_url)
+
+    def test_legacy_representation(self):
+        raw_message = raw_callback_messages()[1]
+        self.assertIsNone(MessageEnvelope.from_repr(raw_message))
+        self.assertEqual(MessageBuilder.build(raw_callback_messages()[1]).to_repr(), MessageEnvelope.build(raw_message).to_repr())
+
+    def test_unsupported_version(self):
+        raw_envelope = MessageEnvelope.to_repr(MessageBuilder.build(raw_callback_messages()[1]))
+        raw_envelope[MessageEnvelope.KEY]["version"] = MessageEnvelope.VERSION + 1
+        self.assertIsNone(MessageEnvelope.from_repr(raw_envelope))
+        # it is still a valid message representation
+        self.assertEqual("TextualMessage", type(MessageEnvelope.build(raw_envelope)).__name__)
@@ -0,0 +1,115 @@
+from __future__ import absolute_import, annotations
+
+import json
+import time
+import urllib.error
+import urllib.request
+from threading import Event
+from unittest import TestCase
+
+from chatbot_core.model.details import TelegramDetails
+from chatbot_core.v3.model.messages import TextualResponse
+from chatbot_core.v3.model.outgoing_event import NotificationEvent
+
+from common.outbound_scheduler import OutboundScheduler, TokenBucket, retry_after_of
+from test.unit.common.fake_telegram import FakeTelegramServer
+
+
+class TestOutboundScheduler(TestCase):
+
+    def setUp(self) -> None:
+        self.server = FakeTelegramServer().start()
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def _send(self, notification: NotificationEvent) -> None:
+        request = urllib.request.Request(
+            f"{self.server.url}/sendMessage",
+            data=json.dumps({"chat_id": notification.social_details.get_user_id(), "text": notification.messages[0].text}).encode("utf-8"),
+            headers={"Content-Type": "application/json"}
+        )
+        try:
+            urllib.request.urlopen(request).read()
+        except urllib.error.HTTPError as e:
+            raise Exception(json.loads(e.read())["description"])
+
+    @staticmethod
+    def _notification(chat_id: int, text: str) -> NotificationEvent:
+        return NotificationEvent(TelegramDetails(chat_id, chat_id, "telegram_bot_id"), [TextualResponse(text)])
+
+    def test_chat_rate_and_order(self):
+        scheduler = OutboundScheduler(self._send, global_rate=1000, global_burst=1000, chat_rate=20, chat_burst=1, workers=4).start()
+        futures = [scheduler.submit(self._notification(chat_id, str(i))) for i in range(5) for chat_id in (1, 2)]
+        for future in futures:
+            future.result(timeout=5)
+        scheduler.stop()
+
+        for chat_id in (1, 2):
+            sent = [(at, params["text"]) for at, params in self.server.requests_of("sendMessage") if params["chat_id"] == chat_id]
+            self.assertEqual([str(i) for i in range(5)], [text for _, text in sent])
+            # one message every 50 milliseconds, with some tolerance for the timers
+            self.assertTrue(all(b[0] - a[0] >= 0.04 for a, b in zip(sent, sent[1:])))
+        self.assertEqual(10, scheduler.stats()["sent"])
+
+    def test_retry_after(self):
+        self.server.throttle_next(1, retry_after=1)
+        scheduler = OutboundScheduler(self._send, workers=2).start()
+        start = time.monotonic()
+        scheduler.submit(self._notification(1, "text")).result(timeout=5)
+        scheduler.stop()
+
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+        self.assertEqual(2, len(self.server.requests_of("sendMessage")))
+        self.assertEqual(1, scheduler.stats()["throttled"])
+        self.assertEqual(1, scheduler.stats()["sent"])
+
+    def test_failure_is_not_retried(self):
+        self.server.fail_next(1)
+        scheduler = OutboundScheduler(self._send, workers=0)
+        with self.assertRaises(Exception):
+            scheduler.submit(self._notification(1, "text")).result()
+        self.assertEqual(1, len(self.server.requests_of("sendMessage")))
+        self.assertEqual(1, scheduler.stats()["failed"])
+
+    def test_stats_are_logged(self):
+        scheduler = OutboundScheduler(lambda notification: None, workers=0, stats_log_interval=2)
+        with self.assertLogs("uhopper.chatbot.wenet.outbound_scheduler", level="INFO") as logs:
+            for i in range(4):
+                scheduler.submit(self._notification(1, str(i))).result()
+        self.assertEqual(2, len(logs.output))
+        self.assertIn("'sent': 4", logs.output[-1])
+
+    def test_priority(self):
+        sent = []
+        release = Event()
+
+        def send(notification: NotificationEvent) -> None:
+            release.wait(5)
+            sent.append(notification.messages[0].text)
+
+        scheduler = OutboundScheduler(send, workers=1).start()
+        scheduler.submit(self._notification(1, "first"), OutboundScheduler.PRIORITY_BATCH)
+        time.sleep(0.1)
+        batch = scheduler.submit(self._notification(2, "batch"), OutboundScheduler.PRIORITY_BATCH)
+        interactive = scheduler.submit(self._notification(3, "interactive"), OutboundScheduler.PRIORITY_INTERACTIVE)
+        self.assertEqual({"interactive": 1, "notification": 0, "batch": 1}, scheduler.stats()["queued_by_priority"])
+        release.set()
+        batch.result(timeout=5)
+        interactive.result(timeout=5)
+        scheduler.stop()
+
+        self.assertEqual(["first", "interactive", "batch"], sent)
+        self.assertEqual(0, scheduler.queue_depth())
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2, now=0)
+        bucket.take(0)
+        bucket.take(0)
+        self.assertEqual(0.5, bucket.wait_time(0))
+        self.assertEqual(0, bucket.wait_time(0.5))
+        self.assertTrue(bucket.is_full(10))
+
+    def test_retry_after_of(self):
+        self.assertEqual(5, retry_after_of(Exception("Too Many Requests: retry after 5")))
+        self.assertIsNone(retry_after_of(Exception("Bad Request: chat not found")))
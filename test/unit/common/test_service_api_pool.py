@@ -0,0 +1,103 @@
+from __future__ import absolute_import, annotations
+
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+
+from wenet.storage.cache import InMemoryCache
+
+from common.service_api_pool import SerializedServiceApi, ServiceApiPool
+
+
+class TestServiceApiPool(TestCase):
+
+    def _pool(self, max_size: int = 10, idle_ttl_sec: float = 600) -> ServiceApiPool:
+        pool = ServiceApiPool("app_id", "client_secret", InMemoryCache(), "auth_url", "instance_url", max_size=max_size, idle_ttl_sec=idle_ttl_sec)
+        pool._create = Mock(side_effect=lambda resource_id: Mock())
+        return pool
+
+    def test_reuse(self):
+        pool = self._pool()
+        service_api = pool.get("user_1")
+        self.assertIs(service_api, pool.get("user_1"))
+        self.assertIsNot(service_api, pool.get("user_2"))
+        self.assertEqual({"size": 2, "hits": 1, "misses": 2, "evicted": 0, "invalidated": 0}, pool.stats())
+
+    def test_lru_eviction(self):
+        pool = self._pool(max_size=2)
+        service_api_1 = pool.get("user_1")
+        pool.get("user_2")
+        pool.get("user_1")
+        pool.get("user_3")
+        self.assertIs(service_api_1, pool.get("user_1"))
+        pool.get("user_2")
+        self.assertEqual(2, pool.stats()["evicted"])
+        self.assertEqual(4, pool._create.call_count)
+
+    def test_idle_ttl(self):
+        pool = self._pool(idle_ttl_sec=0)
+        self.assertIsNot(pool.get("user_1"), pool.get("user_1"))
+
+    def test_invalidate(self):
+        pool = self._pool()
+        service_api_1 = pool.get("user_1")
+        service_api_2 = pool.get("user_2")
+        pool.invalidate("user_1")
+        pool.discard(service_api_2)
+        pool.discard(service_api_2)
+        self.assertIsNot(service_api_1, pool.get("user_1"))
+        self.assertIsNot(service_api_2, pool.get("user_2"))
+        self.assertEqual(2, pool.stats()["invalidated"])
+
+    def test_concurrent_access(self):
+        pool = self._pool(max_size=5)
+
+        def use():
+            for i in range(200):
+                pool.get(f"user_{i % 8}")
+
+        threads = [threading.Thread(target=use) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        self.assertEqual(5, stats["size"])
+        self.assertEqual(800, stats["hits"] + stats["misses"])
+
+    def test_serialized_calls(self):
+
+        class RotatingTokenServiceApi:
+            """
+            Connector refreshing a rotating token at each call, failing when two threads use the same token
+            """
+
+            def __init__(self) -> None:
+                self.refresh_token = 0
+                self.failures = 0
+
+            def get_user_profile(self, wenet_user_id: str) -> str:
+                used_token = self.refresh_token
+                time.sleep(0.001)
+                if self.refresh_token != used_token:
+                    self.failures += 1
+                self.refresh_token = used_token + 1
+                return wenet_user_id
+
+        service_api = RotatingTokenServiceApi()
+        pool = self._pool()
+        pool._create = Mock(return_value=SerializedServiceApi(service_api))
+
+        def use():
+            for _ in range(20):
+                self.assertEqual("user_1", pool.get("user_1").get_user_profile("user_1"))
+
+        threads = [threading.Thread(target=use) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(0, service_api.failures)
+        self.assertEqual(80, service_api.refresh_token)
+        self.assertEqual(1, pool._create.call_count)
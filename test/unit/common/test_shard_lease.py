@@ -0,0 +1,102 @@
+from __future__ import absolute_import, annotations
+
+import time
+from unittest import TestCase
+
+from common.shard_lease import ShardLeaseManager
+
+
+class _FakeRedis:
+    """
+    The subset of the Redis commands used by the lease manager, without expiration
+    """
+
+    def __init__(self) -> None:
+        self.values = {}
+        self.sorted_sets = {}
+        self.renewed = []
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        return 1 if self.values.pop(key, None) is not None else 0
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zremrangebyscore(self, key, min_score, max_score):
+        entries = self.sorted_sets.get(key, {})
+        for member in [member for member, score in entries.items() if score <= max_score]:
+            del entries[member]
+
+    def zcard(self, key):
+        return len(self.sorted_sets.get(key, {}))
+
+    def zrem(self, key, member):
+        self.sorted_sets.get(key, {}).pop(member, None)
+
+    def register_script(self, script):
+        if "PEXPIRE" in script:
+            return lambda keys, args: self.renewed.append(keys[0]) or (1 if self.values.get(keys[0]) == args[0] else 0)
+        return lambda keys, args: self.delete(keys[0]) if self.values.get(keys[0]) == args[0] else 0
+
+
+class TestShardLeaseManager(TestCase):
+
+    def test_without_redis(self):
+        manager = ShardLeaseManager("job", shards=4)
+        self.assertEqual({0, 1, 2, 3}, manager.refresh())
+        self.assertTrue(manager.owns("user"))
+
+    def test_shards_are_shared(self):
+        r = _FakeRedis()
+        first = ShardLeaseManager("job", r, shards=16, owner_id="first")
+        self.assertEqual(16, len(first.refresh()))
+
+        second = ShardLeaseManager("job", r, shards=16, owner_id="second")
+        second.refresh()
+        # the first replica releases the shards above its fair share, then the second one takes them
+        first.refresh()
+        second.refresh()
+        self.assertEqual(8, len(first.owned_shards()))
+        self.assertEqual(8, len(second.owned_shards()))
+        self.assertEqual(set(), first.owned_shards() & second.owned_shards())
+        self.assertEqual(1, len([manager for manager in (first, second) if manager.owns("user")]))
+
+        second.release_all()
+        self.assertEqual(16, len(first.refresh()))
+
+    def test_lost_lease(self):
+        r = _FakeRedis()
+        manager = ShardLeaseManager("job", r, shards=2, owner_id="first")
+        manager.refresh()
+        r.values[manager._lease_key(0)] = "other"
+        self.assertEqual({1}, manager.refresh())
+
+    def test_renew(self):
+        r = _FakeRedis()
+        manager = ShardLeaseManager("job", r, shards=2, lease_ttl_sec=0.2, owner_id="first")
+        manager.refresh()
+        key = "user"
+        shard = manager.shard_of(key)
+        # renewed by the refresh, the lease is not renewed again so soon
+        self.assertTrue(manager.renew(key))
+        self.assertEqual([], r.renewed)
+
+        time.sleep(0.1)
+        self.assertTrue(manager.renew(key))
+        self.assertEqual([manager._lease_key(shard)], r.renewed)
+
+        # taken by another replica after the lease expired
+        time.sleep(0.1)
+        r.values[manager._lease_key(shard)] = "other"
+        self.assertFalse(manager.renew(key))
+        self.assertNotIn(shard, manager.owned_shards())
+        self.assertFalse(manager.renew(key))
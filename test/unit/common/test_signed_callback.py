@@ -0,0 +1,78 @@
+from __future__ import absolute_import, annotations
+
+import base64
+from unittest import TestCase
+
+from common.button_payload import ButtonPayload
+from common.signed_callback import InvalidCallbackDataError, SignedCallbackCodec, is_signed_button
+
+
+class TestSignedCallbackCodec(TestCase):
+
+    SCHEMAS = {
+        "best_answer": ["task_id", "transaction_id", "order"],
+        "ask_more_answers": ["task_id"],
+        "picked_answer": ["task_id", "sensitive", "questioner_name"],
+        "report_abusive": ["task_id", "transaction_id"],
+    }
+
+    def test_encode_decode(self):
+        codec = SignedCallbackCodec(b"secret", self.SCHEMAS)
+        button_ids = codec.encode([
+            ButtonPayload({"task_id": "62a1b2c3d4e5f60718293a4b", "transaction_id": "12", "order": "#1"}, "best_answer"),
+            ButtonPayload({"task_id": "62a1b2c3d4e5f60718293a4b"}, "ask_more_answers"),
+        ])
+        self.assertEqual(2, len(button_ids))
+        for button_id in button_ids:
+            self.assertTrue(is_signed_button(button_id))
+            self.assertLessEqual(len(button_id), 59)
+        best_answer = codec.decode(button_ids[0])
+        more_answers = codec.decode(button_ids[1])
+        self.assertEqual("best_answer", best_answer.button_payload.intent)
+        self.assertEqual({"task_id": "62a1b2c3d4e5f60718293a4b", "transaction_id": "12", "order": "#1"}, best_answer.button_payload.payload)
+        self.assertEqual({"task_id": "62a1b2c3d4e5f60718293a4b"}, more_answers.button_payload.payload)
+        # the buttons of the same group share the nonce
+        self.assertEqual(best_answer.nonce, more_answers.nonce)
+
+    def test_realistic_wenet_ids(self):
+        codec = SignedCallbackCodec(b"secret", self.SCHEMAS)
+        task_id, transaction_id = "62a1b2c3d4e5f60718293a4b", "62a1b2c3d4e5f60718293a4c"
+        best_answers = [ButtonPayload({"task_id": task_id, "transaction_id": transaction_id, "order": f"#{order}"}, "best_answer") for order in range(1, 16)]
+        report = ButtonPayload({"task_id": task_id, "transaction_id": transaction_id}, "report_abusive")
+        for buttons in [best_answers, [report]]:
+            button_ids = codec.encode(buttons)
+            self.assertIsNotNone(button_ids)
+            for button, button_id in zip(buttons, button_ids):
+                self.assertLessEqual(len(button_id), 59)
+                self.assertEqual(button.payload, codec.decode(button_id).button_payload.payload)
+
+    def test_encode_flags_and_text(self):
+        codec = SignedCallbackCodec(b"secret", self.SCHEMAS)
+        button_id, = codec.encode([ButtonPayload({"task_id": "task", "sensitive": True, "questioner_name": "Zoë"}, "picked_answer")])
+        self.assertEqual({"task_id": "task", "sensitive": True, "questioner_name": "Zoë"}, codec.decode(button_id).button_payload.payload)
+
+    def test_not_signed(self):
+        codec = SignedCallbackCodec(b"secret", self.SCHEMAS)
+        self.assertIsNone(codec.encode([ButtonPayload({"task_id": "task_id"}, "unknown_intent")]))
+        self.assertIsNone(codec.encode([ButtonPayload({"task_id": "task_id", "question": "question"}, "ask_more_answers")]))
+        self.assertIsNone(codec.encode([ButtonPayload({"task_id": "task", "sensitive": False, "questioner_name": "a very long name of the questioner"}, "picked_answer")]))
+
+    def test_tampered(self):
+        codec = SignedCallbackCodec(b"secret", self.SCHEMAS)
+        button_id, = codec.encode([ButtonPayload({"task_id": "62a1b2c3d4e5f60718293a4b"}, "ask_more_answers")])
+        data = bytearray(base64.b85decode(button_id[1:]))
+        data[-9] ^= 1
+        with self.assertRaises(InvalidCallbackDataError):
+            codec.decode("." + base64.b85encode(bytes(data)).decode("ascii"))
+        with self.assertRaises(InvalidCallbackDataError):
+            SignedCallbackCodec(b"another_secret", self.SCHEMAS).decode(button_id)
+        with self.assertRaises(InvalidCallbackDataError):
+            codec.decode(".short")
+
+    def test_expired(self):
+        now = [1652884728.0]
+        codec = SignedCallbackCodec(b"secret", self.SCHEMAS, ttl_sec=3600, now=lambda: now[0])
+        button_id, = codec.encode([ButtonPayload({"task_id": "task_id"}, "ask_more_answers")])
+        self.assertIsNotNone(codec.decode(button_id))
+        now[0] += 3600
+        self.assertIsNone(codec.decode(button_id))
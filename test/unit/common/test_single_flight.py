@@ -0,0 +1,71 @@
+from __future__ import absolute_import, annotations
+
+import threading
+import time
+from unittest import TestCase
+
+from common.single_flight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def test_concurrent_calls_are_coalesced(self):
+        single_flight = SingleFlight()
+        calls = []
+        results = []
+
+        def function():
+            calls.append(1)
+            time.sleep(0.05)
+            return "it"
+
+        def worker():
+            results.append(single_flight.do("user", function))
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(["it"] * 5, results)
+        self.assertEqual(4, single_flight.coalesced)
+        self.assertEqual(0, single_flight.in_flight())
+
+    def test_different_keys_are_not_coalesced(self):
+        single_flight = SingleFlight()
+        self.assertEqual("a", single_flight.do("user_a", lambda: "a"))
+        self.assertEqual("b", single_flight.do("user_b", lambda: "b"))
+        self.assertEqual(0, single_flight.coalesced)
+
+    def test_error_is_shared_and_not_cached(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def failing():
+            started.set()
+            release.wait()
+            raise ValueError("unavailable")
+
+        def worker():
+            try:
+                single_flight.do("user", failing)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=worker)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=worker)
+        follower.start()
+        while single_flight.coalesced == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(2, len(errors))
+        self.assertEqual("it", single_flight.do("user", lambda: "it"))
@@ -0,0 +1,45 @@
+from __future__ import absolute_import, annotations
+
+from unittest import TestCase
+
+from common.telegram_api import TelegramApiClient, TelegramApiError
+from test.unit.common.fake_telegram import FakeTelegramServer
+
+
+class TestTelegramApiClient(TestCase):
+
+    def setUp(self) -> None:
+        self.server = FakeTelegramServer("token").start()
+        self.client = TelegramApiClient("token", base_url=self.server.url.rsplit("/", 1)[0], backoff_sec=0.01)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.server.stop()
+
+    def test_get_me(self):
+        self.assertEqual("username", self.client.get_me()["username"])
+
+    def test_get_chat(self):
+        self.assertEqual("user_1", self.client.get_chat(1)["username"])
+        self.assertEqual([{"chat_id": "1"}], [params for _, params in self.server.requests_of("getChat")])
+
+    def test_retry_server_error(self):
+        self.server.fail_next(2)
+        self.assertEqual("username", self.client.get_me()["username"])
+        self.assertEqual(3, len(self.server.requests_of("getMe")))
+        stats = self.client.stats()["getMe"]
+        self.assertEqual(3, stats["calls"])
+        self.assertEqual(2, stats["errors"])
+        self.assertEqual(2, stats["retries"])
+
+    def test_give_up_after_retries(self):
+        self.server.fail_next(3)
+        with self.assertRaises(TelegramApiError):
+            self.client.get_me()
+        self.assertEqual(3, len(self.server.requests_of("getMe")))
+
+    def test_not_retry_client_error(self):
+        with self.assertRaises(TelegramApiError) as context:
+            self.client.call("unknownMethod")
+        self.assertEqual(404, context.exception.error_code)
+        self.assertEqual(1, len(self.server.requests))
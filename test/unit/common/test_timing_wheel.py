@@ -0,0 +1,45 @@
+from __future__ import absolute_import, annotations
+
+import random
+from unittest import TestCase
+
+from common.timing_wheel import TimingWheel
+
+
+class TestTimingWheel(TestCase):
+
+    def test_items_fire_when_due(self):
+        wheel = TimingWheel(0, tick_sec=1, wheel_size=4, levels=2)
+        wheel.add(2.5, "a")
+        wheel.add(10, "b")
+        wheel.add(100, "c")
+        self.assertEqual(3, len(wheel))
+        self.assertEqual([], wheel.advance(2.9))
+        self.assertEqual([(2.5, "a")], wheel.advance(3))
+        self.assertEqual([(10, "b")], wheel.advance(50))
+        self.assertEqual([(100, "c")], wheel.advance(100))
+        self.assertEqual(0, len(wheel))
+
+    def test_overdue_item(self):
+        wheel = TimingWheel(10)
+        wheel.add(5, "a")
+        self.assertEqual([(5, "a")], wheel.advance(10))
+
+    def test_random_schedule(self):
+        rng = random.Random(42)
+        wheel = TimingWheel(1000, tick_sec=1, wheel_size=4, levels=3)
+        now = 1000
+        pending = {}
+        for i in range(2000):
+            due_at = now + rng.uniform(0, 300)
+            pending[i] = due_at
+            wheel.add(due_at, i)
+            previous = now
+            now += rng.choice([0.5, 1, 3])
+            for due_at, item in wheel.advance(now):
+                self.assertLessEqual(due_at, now)
+                # never later than the tick containing the due time, plus the time jumped
+                self.assertLess(now - due_at, 1 + now - previous)
+                del pending[item]
+        wheel.advance(now + 1000)
+        self.assertEqual(0, len(wheel))
@@ -0,0 +1,75 @@
+from __future__ import absolute_import, annotations
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from chatbot_core.model.context import ConversationContext
+from chatbot_core.model.details import TelegramDetails
+from chatbot_core.model.user_context import UserConversationContext
+from wenet.storage.cache import InMemoryCache
+
+from common.user_account_index import UserAccountIndex
+from test.unit.ask_for_help_bot.mock import MockAskForHelpHandler
+
+
+class TestUserAccountIndex(TestCase):
+
+    @staticmethod
+    def _user_context(telegram_id: int, wenet_user_id: str) -> UserConversationContext:
+        return UserConversationContext(
+            social_details=TelegramDetails(telegram_id, telegram_id, "telegram_bot_id"),
+            context=ConversationContext(static_context={"wenet_user_id": wenet_user_id}),
+            version=UserConversationContext.VERSION_V3
+        )
+
+    def test_update_and_get(self):
+        index = UserAccountIndex(InMemoryCache())
+        self.assertIsNone(index.get("1"))
+        index.update(self._user_context(10, "1"))
+        self.assertEqual(TelegramDetails(10, 10, "telegram_bot_id").unique_id(), index.get("1").unique_id())
+
+    def test_update_without_wenet_user(self):
+        index = UserAccountIndex(InMemoryCache())
+        index.update(UserConversationContext(social_details=None, context=ConversationContext(), version=UserConversationContext.VERSION_V3))
+        index.update(UserConversationContext(social_details=TelegramDetails(10, 10, "telegram_bot_id"), context=ConversationContext(), version=UserConversationContext.VERSION_V3))
+        self.assertEqual({}, index.cache._cache)
+
+    def test_stats_are_logged(self):
+        index = UserAccountIndex(InMemoryCache(), stats_log_interval=2)
+        with self.assertLogs("uhopper.chatbot.wenet.user_account_index", level="INFO") as logs:
+            index.record_hit()
+            index.record_miss()
+            index.record_stale()
+            index.record_hit()
+        self.assertEqual(["INFO:uhopper.chatbot.wenet.user_account_index:User account index statistics: {'hits': 1, 'misses': 1, 'stale': 0}",
+                          "INFO:uhopper.chatbot.wenet.user_account_index:User account index statistics: {'hits': 2, 'misses': 2, 'stale': 1}"], logs.output)
+
+    def test_rebuild(self):
+        index = UserAccountIndex(InMemoryCache())
+        connector = Mock()
+        connector.get_user_contexts = Mock(return_value=[self._user_context(10, "1"), self._user_context(20, "2"), UserConversationContext(social_details=TelegramDetails(30, 30, "telegram_bot_id"), context=ConversationContext(), version=UserConversationContext.VERSION_V3)])
+        self.assertEqual(2, index.rebuild(connector, "instance_namespace", "bot_id"))
+        self.assertIsNotNone(index.get("2"))
+
+    def test_handler_hit_and_miss(self):
+        handler = MockAskForHelpHandler()
+        user_context = self._user_context(10, "1")
+        handler._interface_connector.get_user_contexts = Mock(return_value=[user_context])
+        handler._interface_connector.get_user_context = Mock(return_value=user_context)
+
+        self.assertEqual([user_context], handler.get_user_accounts("1"))
+        handler._interface_connector.get_user_context.assert_not_called()
+        self.assertEqual([user_context], handler.get_user_accounts("1"))
+        handler._interface_connector.get_user_contexts.assert_called_once()
+        self.assertEqual({"hits": 1, "misses": 1, "stale": 0}, handler.user_account_index.stats())
+
+    def test_handler_stale_entry(self):
+        handler = MockAskForHelpHandler()
+        handler.user_account_index.update(self._user_context(10, "1"))
+        handler.user_account_index.remove = Mock()
+        handler._interface_connector.get_user_context = Mock(return_value=self._user_context(10, "2"))
+        handler._interface_connector.get_user_contexts = Mock(return_value=[])
+
+        self.assertEqual([], handler.get_user_accounts("1"))
+        handler.user_account_index.remove.assert_called_once_with("1")
+        self.assertEqual({"hits": 0, "misses": 1, "stale": 1}, handler.user_account_index.stats())
@@ -0,0 +1,123 @@
+from __future__ import absolute_import, annotations
+
+import asyncio
+import json
+import threading
+import time
+from typing import List, Optional, Tuple
+from unittest import TestCase
+from unittest.mock import Mock
+
+from messages.asgi import AsyncMessageInterface
+from test.unit.messages.mock import MockMqttPublishHandler
+
+
+class TestAsyncMessageInterface(TestCase):
+
+    RAW_MESSAGE = {
+        "appId": 1,
+        "communityId": "",
+        "label": "TextualMessage",
+        "receiverId": "1",
+        "taskId": "5f773c9e34a5436bf1321ef0",
+        "attributes": {
+            "title": "title",
+            "text": "text"
+        }
+    }
+
+    def setUp(self) -> None:
+        self.mqtt_publisher = MockMqttPublishHandler()
+        self.mqtt_publisher.publish_data = Mock()
+        self.app = AsyncMessageInterface(self.mqtt_publisher, "topic", "namespace", "test", "app_id", "redirect_url", max_queue_size=2, enqueue_timeout_sec=0.1)
+        self.loop = asyncio.new_event_loop()
+        super().setUp()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+        super().tearDown()
+
+    def _request(self, method: str, path: str, body: Optional[object] = None, query_string: str = "") -> Tuple[int, dict, Optional[object]]:
+        messages = [{"type": "http.request", "body": json.dumps(body).encode("utf-8") if body is not None else b"", "more_body": False}]
+        sent: List[dict] = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": query_string.encode("utf-8")}
+        self.loop.run_until_complete(self.app(scope, receive, send))
+        headers = dict(sent[0]["headers"])
+        response_body = json.loads(sent[1]["body"]) if sent[1]["body"] else None
+        return sent[0]["status"], headers, response_body
+
+    def _drain(self) -> None:
+        self.loop.run_until_complete(self.app.stop())
+
+    def test_message(self):
+        status, _, _ = self._request("POST", "/message", self.RAW_MESSAGE)
+        self._drain()
+        self.assertEqual(200, status)
+        self.mqtt_publisher.publish_data.assert_called_once()
+
+    def test_invalid_message(self):
+        status, _, _ = self._request("POST", "/message", {"label": "TextualMessage"})
+        self._drain()
+        self.assertEqual(400, status)
+        self.mqtt_publisher.publish_data.assert_not_called()
+
+    def test_messages(self):
+        status, _, body = self._request("POST", "/messages", [self.RAW_MESSAGE, {"appId": 1}])
+        self._drain()
+        self.assertEqual(200, status)
+        self.assertEqual([200, 400], [item["status"] for item in body["results"]])
+        self.mqtt_publisher.publish_data.assert_called_once()
+
+    def test_auth(self):
+        status, headers, _ = self._request("GET", "/auth", query_string="code=code&external_id=1")
+        self._drain()
+        self.assertEqual(302, status)
+        self.assertEqual(b"redirect_url?app_id=app_id", headers[b"location"])
+        self.mqtt_publisher.publish_data.assert_called_once()
+
+        status, _, _ = self._request("GET", "/auth", query_string="code=code")
+        self.assertEqual(400, status)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        self.mqtt_publisher.publish_data.side_effect = lambda topic, data: release.wait(5)
+        statuses = [self._request("POST", "/message", self.RAW_MESSAGE)[0] for _ in range(4)]
+        release.set()
+        self._drain()
+        # one event is being published, two are queued and the last one does not fit
+        self.assertEqual([200, 200, 200, 503], statuses)
+        self.assertEqual(3, self.mqtt_publisher.publish_data.call_count)
+
+    def test_drain_on_shutdown(self):
+        self.mqtt_publisher.publish_data.side_effect = lambda topic, data: time.sleep(0.01)
+        self._request("POST", "/message", self.RAW_MESSAGE)
+        self._request("POST", "/message", self.RAW_MESSAGE)
+        self._drain()
+        self.assertEqual(2, self.mqtt_publisher.publish_data.call_count)
+
+    def test_publish_retry(self):
+        self.app.retry_backoff_sec = 0.01
+        self.mqtt_publisher.publish_data.side_effect = [Exception("disconnected"), Exception("disconnected"), None]
+        status, _, _ = self._request("POST", "/message", self.RAW_MESSAGE)
+        self._drain()
+        self.assertEqual(200, status)
+        self.assertEqual(3, self.mqtt_publisher.publish_data.call_count)
+
+    def test_rejected_batch_is_not_queued(self):
+        self.app.max_batch_size = 1
+        release = threading.Event()
+        self.mqtt_publisher.publish_data.side_effect = lambda topic, data: release.wait(5)
+        statuses = [self._request("POST", "/message", self.RAW_MESSAGE)[0] for _ in range(3)]
+        status, _, _ = self._request("POST", "/messages", [self.RAW_MESSAGE, self.RAW_MESSAGE])
+        release.set()
+        self._drain()
+        self.assertEqual([200, 200, 200], statuses)
+        self.assertEqual(503, status)
+        self.assertEqual(3, self.mqtt_publisher.publish_data.call_count)
@@ -113,3 +113,40 @@ class TestEndpoint(CommonTestCase):
         result = self.client.post('/message', data=json.dumps(raw_input), content_type='application/json')
         self.assertEqual(result.status_code, 200)
         mock_publish.assert_called_once()
+
+    def test_batch_of_messages(self):
+        self.setUp()
+        mock_publish = Mock()
+        self.mqtt_publisher.publish_data = mock_publish
+        valid_message = {
+            "appId": 1,
+            "communityId": "",
+            "label": "TextualMessage",
+            "receiverId": "1",
+            "taskId": "5f773c9e34a5436bf1321ef0",
+            "attributes": {
+                "title": "title",
+                "text": "text"
+            }
+        }
+        invalid_message = {
+            "appId": 1,
+            "communityId": "",
+            "receiverId": "1"
+        }
+        raw_input = [valid_message, invalid_message, dict(valid_message, receiverId="2")]
+        result = self.client.post('/messages', data=json.dumps(raw_input), content_type='application/json')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([200, 400, 200], [item["status"] for item in result.get_json()["results"]])
+        mock_publish.assert_called_once()
+        published_event = json.dumps(mock_publish.call_args.args[1])
+        self.assertIn("messageBatch", published_event)
+        self.assertEqual(2, published_event.count('"label": "TextualMessage"'))
+
+    def test_batch_not_a_list(self):
+        self.setUp()
+        mock_publish = Mock()
+        self.mqtt_publisher.publish_data = mock_publish
+        result = self.client.post('/messages', data=json.dumps({"label": "TextualMessage"}), content_type='application/json')
+        self.assertEqual(result.status_code, 400)
+        mock_publish.assert_not_called()
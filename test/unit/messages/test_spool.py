@@ -0,0 +1,123 @@
+from __future__ import absolute_import, annotations
+
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import Mock
+
+from messages.spool import MessageSpool, SpoolForwarder, SpooledPublisher
+
+
+class TestMessageSpool(TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+        super().tearDown()
+
+    def test_forward_in_order(self):
+        spool = MessageSpool(self.directory.name, segment_max_bytes=200)
+        for i in range(10):
+            spool.append("topic", {"id": i})
+        publisher = Mock()
+        forwarder = SpoolForwarder(spool, publisher, batch_size=3)
+        forwarded = 0
+        while forwarded < 10:
+            published = forwarder.forward_available(timeout=0)
+            self.assertGreater(published, 0)
+            forwarded += published
+
+        self.assertEqual([{"id": i} for i in range(10)], [call.args[1] for call in publisher.publish_data.call_args_list])
+        self.assertEqual(0, spool.depth_bytes())
+        # only the segment currently written is kept
+        self.assertEqual(1, len([name for name in os.listdir(self.directory.name) if name.endswith(".log")]))
+        spool.close()
+
+    def test_recovery_after_restart(self):
+        spool = MessageSpool(self.directory.name)
+        for i in range(5):
+            spool.append("topic", {"id": i})
+        publisher = Mock()
+        forwarder = SpoolForwarder(spool, publisher, batch_size=2)
+        forwarder.forward_available(timeout=0)
+        spool.close()
+
+        spool = MessageSpool(self.directory.name)
+        publisher = Mock()
+        forwarder = SpoolForwarder(spool, publisher)
+        forwarder.forward_available(timeout=0)
+        self.assertEqual([{"id": i} for i in range(2, 5)], [call.args[1] for call in publisher.publish_data.call_args_list])
+        spool.close()
+
+    def test_retry_failed_publication(self):
+        spool = MessageSpool(self.directory.name)
+        spool.append("topic", {"id": 0})
+        publisher = Mock()
+        publisher.publish_data.side_effect = [ConnectionError(), None]
+        forwarder = SpoolForwarder(spool, publisher, retry_backoff_sec=0.01)
+        self.assertEqual(1, forwarder.forward_available(timeout=0))
+        self.assertEqual(2, publisher.publish_data.call_count)
+        self.assertEqual(1, forwarder.metrics()["failed_attempts"])
+        spool.close()
+
+    def test_concurrent_appends(self):
+        spool = MessageSpool(self.directory.name, segment_max_bytes=1024)
+
+        def writer(writer_id: int):
+            for i in range(50):
+                spool.append("topic", {"writer": writer_id, "id": i})
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        publisher = Mock()
+        forwarder = SpoolForwarder(spool, publisher, batch_size=1000)
+        while forwarder.forward_available(timeout=0) > 0:
+            pass
+        published = [call.args[1] for call in publisher.publish_data.call_args_list]
+        self.assertEqual(200, len(published))
+        for writer_id in range(4):
+            self.assertEqual(list(range(50)), [data["id"] for data in published if data["writer"] == writer_id])
+        spool.close()
+
+    def test_corrupted_record_in_live_segment(self):
+        spool = MessageSpool(self.directory.name)
+        for i in range(3):
+            spool.append("topic", {"id": i})
+        segment = next(name for name in os.listdir(self.directory.name) if name.endswith(".log"))
+        path = os.path.join(self.directory.name, segment)
+        with open(path, "r+b") as f:
+            # the last byte of the payload of the second record
+            size = os.path.getsize(path)
+            f.seek(size * 2 // 3 - 2)
+            f.write(b"X")
+        publisher = Mock()
+        forwarder = SpoolForwarder(spool, publisher)
+        self.assertEqual(1, forwarder.forward_available(timeout=0))
+        # the rest of the corrupted segment is skipped, the messages appended later are still forwarded
+        self.assertEqual(0, forwarder.forward_available(timeout=0))
+        self.assertFalse(spool.has_unread())
+        spool.append("topic", {"id": 3})
+        self.assertEqual(1, forwarder.forward_available(timeout=0))
+        self.assertEqual([{"id": 0}, {"id": 3}], [call.args[1] for call in publisher.publish_data.call_args_list])
+        self.assertTrue(os.path.exists(f"{path}{MessageSpool.CORRUPTED_SUFFIX}"))
+        spool.close()
+
+    def test_claim_slot(self):
+        first_directory, first_lock = SpooledPublisher.claim_slot(self.directory.name, 2)
+        second_directory, second_lock = SpooledPublisher.claim_slot(self.directory.name, 2)
+        self.assertNotEqual(first_directory, second_directory)
+        with self.assertRaises(RuntimeError):
+            SpooledPublisher.claim_slot(self.directory.name, 2)
+        first_lock.close()
+        directory, lock = SpooledPublisher.claim_slot(self.directory.name, 2)
+        self.assertEqual(first_directory, directory)
+        lock.close()
+        second_lock.close()